@@ -1,6 +1,11 @@
+import asyncio
+import json
+import random
 from typing import Annotated
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from litellm import Usage
 import re
@@ -12,19 +17,32 @@ from .llm.annotate import Agent
 
 from .metamodel import ModelType, to_python_type
 from .models import (
+    BatchParseDataRequest,
+    BatchParseItem,
+    BatchParseSummary,
     DefineSchemaRequest,
     DefineSchemaResponse,
     MessageResponse,
     ParseDataRequest,
     ParseDataResponse,
 )
-from .utils import get_parsed_data
+from .utils import get_parsed_data, stream_parsed_data, sum_usage
 from uuid import uuid4
 
 
 router = APIRouter()
 security = HTTPBearer()
 
+ITEM_RETRY_DELAY = 1.0  # seconds before the first retry of a failed batch item, doubled on each retry
+
+
+def to_event_stream(events) -> StreamingResponse:
+    async def format_events():
+        async for event, payload in events:
+            yield f"event: {event}\ndata: {json.dumps(jsonable_encoder(payload))}\n\n"
+
+    return StreamingResponse(format_events(), media_type="text/event-stream")
+
 
 @router.post("/define", response_model_exclude_unset=True)
 async def define_schema(
@@ -46,7 +64,20 @@ async def define_schema(
 
     Raises:
         HTTPException: If an error occurs during the schema generation process.
+
+    With `stream`, the schema is sent as server-sent events instead, see `parse_data`.
     """
+    if request.stream:
+        events = await stream_parsed_data(
+            messages=request.messages,
+            schema=ModelType,
+            model=request.model,
+            api_key=credentials.credentials,
+            temperature=request.temperature,
+            max_tokens=request.max_tokens,
+        )
+        return to_event_stream(events)
+
     schema = await get_parsed_data(
         messages=request.messages,
         schema=ModelType,
@@ -100,8 +131,25 @@ async def parse_data(
     Returns:
         ParseDataResponse: The parsed data conforming to the provided schema
         definition and token usage.
+
+    With `stream`, the response is a stream of server-sent events instead: a
+    `partial` event with the valid fields every time more fields are filled in,
+    then a `done` event with the data, usage and `time_to_first_field` in seconds,
+    or an `error` event if the complete data does not match the schema. Streamed
+    data is not retried on validation errors.
     """
     schema = to_python_type(request.definition)
+    if request.stream:
+        events = await stream_parsed_data(
+            messages=request.messages,
+            schema=schema,
+            model=request.model,
+            api_key=credentials.credentials,
+            temperature=request.temperature,
+            max_tokens=request.max_tokens,
+        )
+        return to_event_stream(events)
+
     data = await get_parsed_data(
         messages=request.messages,
         schema=schema,
@@ -113,3 +161,132 @@ async def parse_data(
     )
 
     return ParseDataResponse[schema](data=data, usage=data._raw_response.usage)
+
+
+def is_retryable_item_error(e: HTTPException) -> bool:
+    return e.status_code == 429 or e.status_code >= 500
+
+
+def get_error_usage(e: HTTPException) -> Usage | None:
+    """The tokens spent by the validation attempts of a failed completion, if known."""
+    if not isinstance(e.detail, dict) or not e.detail.get("total_usage"):
+        return None
+    total_usage = e.detail["total_usage"]
+    return Usage(
+        prompt_tokens=total_usage.get("prompt_tokens", 0),
+        completion_tokens=total_usage.get("completion_tokens", 0),
+        total_tokens=total_usage.get("total_tokens", 0),
+    )
+
+
+async def parse_batch_item(
+    index: int,
+    messages: list,
+    schema,
+    request: BatchParseDataRequest,
+    api_key: str,
+) -> BatchParseItem:
+    # Tokens of all the attempts of the item, the failed ones too
+    usages = []
+    for attempt in range(1, request.item_attempts + 1):
+        try:
+            data = await get_parsed_data(
+                messages=messages,
+                schema=schema,
+                model=request.model,
+                api_key=api_key,
+                temperature=request.temperature,
+                max_tokens=request.max_tokens,
+                max_attempts=request.max_attempts,
+            )
+        except HTTPException as e:
+            error_usage = get_error_usage(e)
+            if error_usage is not None:
+                usages.append(error_usage)
+            if attempt == request.item_attempts or not is_retryable_item_error(e):
+                return BatchParseItem(
+                    index=index,
+                    attempts=attempt,
+                    usage=sum_usage(usages) if usages else None,
+                    error={"status_code": e.status_code, "detail": e.detail},
+                )
+            # Jittered, so items that failed together do not retry together
+            await asyncio.sleep(random.uniform(0.5, 1) * ITEM_RETRY_DELAY * 2 ** (attempt - 1))
+        except Exception as e:
+            # An error of this item only, the rest of the batch goes on
+            return BatchParseItem(
+                index=index,
+                attempts=attempt,
+                usage=sum_usage(usages) if usages else None,
+                error={"status_code": 500, "detail": f"{type(e).__name__}: {e}"},
+            )
+        else:
+            usages.append(data._raw_response.usage)
+            return BatchParseItem(
+                index=index,
+                attempts=attempt,
+                data=data.model_dump(mode="json"),
+                usage=sum_usage(usages),
+            )
+
+
+@router.post("/parse/batch")
+async def parse_data_batch(
+    request: BatchParseDataRequest,
+    credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)],
+) -> StreamingResponse:
+    """Parse many inputs against one schema definition, streaming the results as NDJSON.
+
+    The schema is compiled once for the whole batch, and at most `concurrency` items
+    are parsed at once, each retried up to `item_attempts` times on server and rate
+    limit errors. Each line is a `BatchParseItem`, in the order the items finish, and
+    the last line is a `BatchParseSummary` with the usage of all the items, failed
+    ones included.
+
+    Args:
+        request (BatchParseDataRequest): The inputs, the schema definition, and the
+        model generation and concurrency parameters.
+
+    Returns:
+        StreamingResponse: The `application/x-ndjson` stream of results.
+    """
+    schema = to_python_type(request.definition)
+
+    async def stream_results():
+        items = enumerate(request.inputs)
+        results = asyncio.Queue()
+
+        async def worker():
+            # Takes the next item once done with one, so only `concurrency` are started
+            for index, messages in items:
+                item = await parse_batch_item(
+                    index, messages, schema, request, credentials.credentials
+                )
+                await results.put(item)
+
+        workers = [
+            asyncio.create_task(worker())
+            for _ in range(min(request.concurrency, len(request.inputs)))
+        ]
+        usages = []
+        succeeded = failed = 0
+        try:
+            for _ in request.inputs:
+                item = await results.get()
+                if item.error is None:
+                    succeeded += 1
+                else:
+                    failed += 1
+                if item.usage is not None:
+                    usages.append(item.usage)
+                yield item.model_dump_json(exclude_none=True) + "\n"
+        finally:
+            # The client went away before the end of the batch
+            for worker_task in workers:
+                worker_task.cancel()
+        summary = BatchParseSummary(
+            succeeded=succeeded, failed=failed, usage=sum_usage(usages)
+        )
+        yield summary.model_dump_json() + "\n"
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+
+
+def hash_images(messages: list) -> list:
+    """The messages with the data of inline images replaced by its hash."""
+    hashed = []
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, list):
+            content = [_hash_image(part) for part in content]
+        hashed.append({**message, "content": content})
+    return hashed
+
+
+def _hash_image(part: dict) -> dict:
+    image_url = part.get("image_url")
+    if part.get("type") != "image_url" or not isinstance(image_url, dict):
+        return part
+    url = image_url.get("url", "")
+    if not url.startswith("data:"):
+        return part
+    url = "sha256:" + hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return {**part, "image_url": {**image_url, "url": url}}
+
+
+def get_cache_key(
+    api_key: str,
+    model: str,
+    messages: list,
+    json_schema: dict,
+    temperature: float | None,
+    max_tokens: int | None,
+) -> str:
+    """Content hash of everything that decides the response of a completion.
+
+    The hash of the API key is part of it, so responses are only shared between
+    requests of the same caller, and an invalid key never gets a cached response.
+    """
+    canonical = json.dumps(
+        {
+            "api_key": hashlib.sha256(api_key.encode("utf-8")).hexdigest(),
+            "model": model,
+            "messages": hash_images(messages),
+            "schema": json_schema,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+        },
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResponseCache(ABC):
+    """Stores the JSON of parsed responses by cache key, for `ttl` seconds."""
+
+    def __init__(self, ttl: float = 24 * 3600) -> None:
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def get(self, key: str) -> str | None:
+        value = self._get(key)
+        with self._stats_lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        self._set(key, value, time.time() + self.ttl)
+
+    @abstractmethod
+    def _get(self, key: str) -> str | None:
+        pass
+
+    @abstractmethod
+    def _set(self, key: str, value: str, expires: float) -> None:
+        pass
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+
+class MemoryResponseCache(ResponseCache):
+    """LRU cache of at most `max_size` responses, local to the process."""
+
+    def __init__(self, ttl: float = 24 * 3600, max_size: int = 1024) -> None:
+        super().__init__(ttl)
+        self.max_size = max_size
+        self._entries = OrderedDict()  # key: (expires, value)
+        self._lock = threading.Lock()
+
+    def _get(self, key: str) -> str | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _set(self, key: str, value: str, expires: float) -> None:
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class DiskResponseCache(ResponseCache):
+    """One JSON file per response in `directory`, shared by processes and kept across restarts.
+
+    Every `prune_interval` writes, expired files are deleted, and then the oldest
+    ones while there are more than `max_size`.
+    """
+
+    def __init__(
+        self,
+        directory: str | Path,
+        ttl: float = 24 * 3600,
+        max_size: int = 10000,
+        prune_interval: int = 100,
+    ) -> None:
+        super().__init__(ttl)
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.prune_interval = prune_interval
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json"
+
+    def _get(self, key: str) -> str | None:
+        path = self._path(key)
+        try:
+            entry = json.loads(path.read_text())
+        except (OSError, ValueError):
+            return None
+        if entry["expires"] < time.time():
+            path.unlink(missing_ok=True)
+            return None
+        return entry["value"]
+
+    def _set(self, key: str, value: str, expires: float) -> None:
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        # Written aside and renamed, so readers never see a partial file
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_text(json.dumps({"expires": expires, "value": value}))
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._writes += 1
+            prune = self._writes % self.prune_interval == 0
+        if prune:
+            self.prune()
+
+    def prune(self) -> None:
+        # A file is written when its entry is set, so its age tells if the entry expired
+        now = time.time()
+        files = []
+        for path in self.directory.glob("*/*.json"):
+            try:
+                modified = path.stat().st_mtime
+            except OSError:  # deleted by another process
+                continue
+            if modified + self.ttl < now:
+                path.unlink(missing_ok=True)
+            else:
+                files.append((modified, path))
+        files.sort()
+        for _, path in files[: max(len(files) - self.max_size, 0)]:
+            path.unlink(missing_ok=True)
+
+
+@lru_cache(maxsize=None)
+def get_response_cache() -> ResponseCache | None:
+    """The response cache set by the RESPONSE_CACHE environment variable, "memory" or "disk", off by default.
+
+    Created on first use, once the environment is loaded from `.env`.
+    """
+    backend = os.getenv("RESPONSE_CACHE", "").lower()
+    ttl = float(os.getenv("RESPONSE_CACHE_TTL", 24 * 3600))
+    if backend == "memory":
+        return MemoryResponseCache(
+            ttl=ttl, max_size=int(os.getenv("RESPONSE_CACHE_SIZE", 1024))
+        )
+    if backend == "disk":
+        return DiskResponseCache(
+            os.getenv("RESPONSE_CACHE_DIR", ".response_cache"),
+            ttl=ttl,
+            max_size=int(os.getenv("RESPONSE_CACHE_SIZE", 10000)),
+        )
+    if backend:
+        raise ValueError(f"Unknown RESPONSE_CACHE backend: {backend}")
+    return None
@@ -1,17 +1,32 @@
 import os
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 
 from .api import router as api_router
+from .metamodel import model_cache
+from .cache import get_response_cache
+from .utils import close_http_client
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await close_http_client()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.get("/health")
 async def health_check():
-    return {"status": "OK"}
+    status = {"status": "OK", "schema_cache": model_cache.stats()}
+    response_cache = get_response_cache()
+    if response_cache is not None:
+        status["response_cache"] = response_cache.stats()
+    return status
 
 
 load_dotenv()
@@ -1,3 +1,8 @@
+import hashlib
+import json
+import os
+import re
+import threading
 from collections import OrderedDict
 from decimal import Decimal
 from functools import reduce
@@ -62,6 +67,80 @@ class ModelType(BaseModel):
     fields: OrderedDict[str, FieldTypes] = Field(min_length=1)
 
 
+def _encode_value(value):
+    # Keeps values that dump to the same JSON apart, e.g. Decimal("1") and "1"
+    if isinstance(value, Decimal):
+        return {"$decimal": str(value)}
+    if isinstance(value, re.Pattern):
+        return {"$pattern": value.pattern}
+    raise TypeError(f"Cannot encode {value!r}")
+
+
+def get_type_key(type: ModelType) -> str:
+    """Content hash of a model definition.
+
+    Field order is part of the key, since it is the order of the fields in the
+    generated schema. Unset and explicitly set attributes are kept apart, as
+    `to_python_type` treats them differently.
+    """
+    canonical = json.dumps(
+        type.model_dump(exclude_unset=True),
+        default=_encode_value,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ModelCache:
+    """LRU cache of the models compiled from `ModelType` definitions, by content hash.
+
+    Clients send the same schema with every request, and building a model with
+    `create_model` rebuilds its validators from scratch. Nested models are cached
+    too, so parent schemas that share a sub-model share its compiled model.
+    """
+
+    def __init__(self, max_size: int = 256) -> None:
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                self.misses += 1
+                return None
+            self._models.move_to_end(key)
+            self.hits += 1
+            return model
+
+    def put(self, key: str, model) -> None:
+        with self._lock:
+            self._models[key] = model
+            self._models.move_to_end(key)
+            while len(self._models) > self.max_size:
+                self._models.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._models.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._models),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+model_cache = ModelCache(max_size=int(os.getenv("SCHEMA_CACHE_SIZE", 256)))
+
+
 def to_python_type(type: FieldTypes):
     if isinstance(type, AnnotatedType):
         field_type = to_python_type(type.type)
@@ -93,18 +172,26 @@ def to_python_type(type: FieldTypes):
     elif isinstance(type, list):
         field_type = reduce(or_, (to_python_type(sub_type) for sub_type in type))
     elif isinstance(type, ModelType):
-        subfields = {}
-        for subfield_name, subfield_info in type.fields.items():
-            subfield_type = to_python_type(subfield_info)
-            if get_origin(subfield_type) is not Annotated:
-                subfield_type = Annotated[subfield_type, Field(...)]
-            subfields[subfield_name] = subfield_type
-
-        field_type = create_model(
-            type.name,
-            **subfields,
-        )
+        key = get_type_key(type)
+        field_type = model_cache.get(key)
+        if field_type is None:
+            field_type = _create_model(type)
+            model_cache.put(key, field_type)
     else:
         assert False, f"Unknown type: {type}"
 
     return field_type
+
+
+def _create_model(type: ModelType):
+    subfields = {}
+    for subfield_name, subfield_info in type.fields.items():
+        subfield_type = to_python_type(subfield_info)
+        if get_origin(subfield_type) is not Annotated:
+            subfield_type = Annotated[subfield_type, Field(...)]
+        subfields[subfield_name] = subfield_type
+
+    return create_model(
+        type.name,
+        **subfields,
+    )
@@ -1,4 +1,4 @@
-from typing import Generic, Literal, TypeVar
+from typing import Any, Generic, Literal, TypeVar
 
 from litellm import Usage
 from pydantic import BaseModel, Field, SkipValidation
@@ -8,6 +8,8 @@ from .metamodel import ModelType
 
 T_Model = TypeVar("T_Model", bound=BaseModel)
 
+MAX_BATCH_SIZE = 1000  # items of one /parse/batch request
+
 
 class Message(TypedDict):
     role: Literal["user", "system", "assistant"]
@@ -24,6 +26,7 @@ class DefineSchemaRequest(BaseModel):
     temperature: float = Field(default=0, ge=0, le=1)
     max_tokens: int | None = Field(default=None, ge=1)
     max_attempts: int = Field(default=3, ge=1)
+    stream: bool = False  # stream partial objects as server-sent events
 
     model_config = {
         "json_schema_extra": {
@@ -61,6 +64,28 @@ class ParseDataRequest(BaseModel):
     temperature: float = Field(default=0, ge=0, le=1)
     max_tokens: int | None = Field(default=None, ge=1)
     max_attempts: int = Field(default=3, ge=1)
+    stream: bool = False  # stream partial objects as server-sent events
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [],
+        }
+    }
+
+
+class BatchParseDataRequest(BaseModel):
+    inputs: list[list[Message]] = Field(
+        min_length=1, max_length=MAX_BATCH_SIZE
+    )  # one message list per item, all parsed with the same schema
+    definition: ModelType = Field(title="Schema Definition", alias="schema")
+    model: str = "gpt-4o"
+    temperature: float = Field(default=0, ge=0, le=1)
+    max_tokens: int | None = Field(default=None, ge=1)
+    max_attempts: int = Field(default=3, ge=1)
+    concurrency: int = Field(default=8, ge=1, le=64)
+    item_attempts: int = Field(
+        default=2, ge=1, le=5
+    )  # attempts of an item that failed with a server or rate limit error
 
     model_config = {
         "json_schema_extra": {
@@ -69,6 +94,20 @@ class ParseDataRequest(BaseModel):
     }
 
 
+class BatchParseItem(BaseModel):
+    index: int
+    attempts: int
+    data: dict | None = None
+    usage: Usage | None = None
+    error: Any = None
+
+
+class BatchParseSummary(BaseModel):
+    succeeded: int
+    failed: int
+    usage: Usage
+
+
 class ParseDataResponse(BaseModel, Generic[T_Model]):
     data: SkipValidation[T_Model]
     usage: Usage
@@ -1,10 +1,23 @@
+import asyncio
+import copy
+import importlib.util
+import os
+import time
+from functools import lru_cache, wraps
+from typing import Annotated, Any, AsyncGenerator, NamedTuple, Optional
+
+import httpx
 import instructor
+import litellm
 from fastapi import HTTPException
 from instructor.exceptions import InstructorRetryException
+from instructor.function_calls import OpenAISchema
+from instructor.process_response import handle_response_model
 from instructor.utils import disable_pydantic_error_url
-from litellm import RateLimitError, acompletion
+from litellm import RateLimitError, Usage, acompletion
 from litellm.exceptions import LITELLM_EXCEPTION_TYPES
-from pydantic import ValidationError
+from pydantic import BaseModel, ValidationError, create_model
+from pydantic_core import from_json
 from tenacity import (
     AsyncRetrying,
     RetryError,
@@ -12,10 +25,87 @@ from tenacity import (
     stop_after_attempt,
 )
 
+from .cache import get_cache_key, get_response_cache
 from .models import T_Model
 
 disable_pydantic_error_url()
-aclient = instructor.from_litellm(acompletion, mode=instructor.Mode.MD_JSON)
+
+# One keep-alive connection pool shared by every request, instead of a new one per completion
+http_client = httpx.AsyncClient(
+    http2=importlib.util.find_spec("h2") is not None,
+    limits=httpx.Limits(
+        max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", 64)),
+        max_keepalive_connections=int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", 32)),
+        keepalive_expiry=60,
+    ),
+    timeout=httpx.Timeout(120, connect=10),
+)
+litellm.aclient_session = http_client
+# Maximum number of completions in flight at once, across all endpoints
+llm_semaphore = asyncio.Semaphore(int(os.getenv("LLM_CONCURRENCY", 16)))
+
+MODE = instructor.Mode.MD_JSON
+aclient = instructor.from_litellm(acompletion, mode=MODE)
+
+
+async def close_http_client() -> None:
+    await http_client.aclose()
+
+
+class PrecomputedSchema(OpenAISchema):
+    """An `OpenAISchema` that generates its JSON schema once.
+
+    instructor renders the JSON schema of the response model into the prompt of
+    every completion, and pydantic does not cache it.
+    """
+
+    @classmethod
+    def model_json_schema(cls, *args, **kwargs) -> dict:
+        key = (args, tuple(sorted(kwargs.items())))
+        # Kept on the class itself, and not inherited, so they go away with their response model
+        schemas = cls.__dict__.get("__json_schemas__")
+        if schemas is None:
+            schemas = {}
+            cls.__json_schemas__ = schemas
+        if key not in schemas:
+            schemas[key] = super().model_json_schema(*args, **kwargs)
+        # Copied since instructor edits the schemas it gets
+        return copy.deepcopy(schemas[key])
+
+
+@lru_cache(maxsize=int(os.getenv("SCHEMA_CACHE_SIZE", 256)))
+def get_response_model(schema: type[BaseModel]) -> type[OpenAISchema]:
+    """The response model instructor would wrap `schema` in, built once per schema."""
+    return wraps(schema, updated=())(
+        create_model(schema.__name__, __base__=(schema, PrecomputedSchema))
+    )
+
+
+def add_cache_breakpoint(messages: list, model: str) -> list:
+    """Marks the leading system messages as a cached prompt prefix, for the models that need it.
+
+    Anthropic models only cache a prefix that ends with a `cache_control` breakpoint,
+    OpenAI models cache any repeated prefix on their own. The schema instructions added
+    by instructor go into the first system message, so they are part of the prefix.
+    """
+    if "claude" not in model.lower() and not model.startswith("anthropic/"):
+        return messages
+    last_system = None
+    for index, message in enumerate(messages):
+        if message["role"] != "system":
+            break
+        last_system = index
+    if last_system is None:
+        return messages
+
+    message = messages[last_system]
+    content = message["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    if not content:
+        return messages
+    content = [*content[:-1], {**content[-1], "cache_control": {"type": "ephemeral"}}]
+    return [*messages[:last_system], {**message, "content": content}, *messages[last_system + 1 :]]
 
 
 async def get_parsed_data(
@@ -27,19 +117,68 @@ async def get_parsed_data(
     max_tokens: int | None = None,
     max_attempts: int = 3,
 ) -> T_Model:
-    try:
-        return await aclient.chat.completions.create(
-            model=model,
-            api_key=api_key,
-            messages=messages,
-            response_model=schema,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            max_retries=AsyncRetrying(
-                stop=stop_after_attempt(max_attempts),
-                retry=retry_if_exception_type((ValidationError, RateLimitError)),
-            ),
+    response_model = get_response_model(schema)
+    response_cache = get_response_cache()
+    cache_key = None
+    # Only completions at temperature 0 are expected to give the same response again
+    if response_cache is not None and not temperature:
+        cache_key = get_cache_key(
+            api_key,
+            model,
+            messages,
+            response_model.model_json_schema(),
+            temperature,
+            max_tokens,
         )
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            return load_cached_response(response_model, cached)
+
+    data = await _get_parsed_data(
+        messages, response_model, model, api_key, temperature, max_tokens, max_attempts
+    )
+    if cache_key is not None:
+        response_cache.set(cache_key, data.model_dump_json())
+    return data
+
+
+class CachedCompletion(NamedTuple):
+    usage: Usage
+
+
+def load_cached_response(response_model: type[T_Model], cached: str) -> T_Model:
+    """A response from the cache, with a usage of no tokens flagged as `cached`."""
+    data = response_model.model_validate_json(cached)
+    # Read by the endpoints as instructor sets it on fresh responses
+    data._raw_response = CachedCompletion(
+        usage=Usage(prompt_tokens=0, completion_tokens=0, total_tokens=0, cached=True)
+    )
+    return data
+
+
+async def _get_parsed_data(
+    messages: list,
+    response_model: type[T_Model],
+    model: str,
+    api_key: str,
+    temperature: float | None,
+    max_tokens: int | None,
+    max_attempts: int,
+) -> T_Model:
+    try:
+        async with llm_semaphore:
+            return await aclient.chat.completions.create(
+                model=model,
+                api_key=api_key,
+                messages=add_cache_breakpoint(messages, model),
+                response_model=response_model,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                max_retries=AsyncRetrying(
+                    stop=stop_after_attempt(max_attempts),
+                    retry=retry_if_exception_type((ValidationError, RateLimitError)),
+                ),
+            )
     except tuple(LITELLM_EXCEPTION_TYPES) as e:
         raise HTTPException(status_code=e.status_code, detail=str(e))
     except TypeError as e:
@@ -64,3 +203,145 @@ async def get_parsed_data(
                 else str(root_cause)
             ),
         )
+
+
+@lru_cache(maxsize=int(os.getenv("SCHEMA_CACHE_SIZE", 256)))
+def get_partial_model(schema: type[BaseModel]) -> type[BaseModel]:
+    """`schema` with all its fields optional, to validate an object still being generated."""
+    fields = {}
+    for name, field in schema.model_fields.items():
+        field_type = field.annotation
+        if field.metadata:
+            field_type = Annotated[field_type, *field.metadata]
+        fields[name] = (Optional[field_type], None)
+    return create_model(f"Partial{schema.__name__}", **fields)
+
+
+def get_valid_fields(partial_model: type[BaseModel], obj: Any) -> BaseModel | None:
+    """Validates the fields of `obj` that are valid so far, leaving out the others.
+
+    A field that is still being generated can be invalid until it is complete,
+    e.g. a list shorter than its `min_length`, or a nested object without all
+    its fields.
+    """
+    while isinstance(obj, dict):
+        try:
+            return partial_model.model_validate(obj)
+        except ValidationError as e:
+            invalid = {error["loc"][0] for error in e.errors() if error["loc"]}
+            if not invalid & obj.keys():
+                return None
+            obj = {key: value for key, value in obj.items() if key not in invalid}
+    return None
+
+
+def extract_json(content: str) -> str | None:
+    """The JSON object of a markdown response, complete or not."""
+    start = content.find("{")
+    if start == -1:
+        return None
+    end = content.find("```", start)
+    return content[start:] if end == -1 else content[start:end].rstrip()
+
+
+async def stream_parsed_data(
+    messages: list,
+    schema: type[T_Model],
+    model: str,
+    api_key: str,
+    temperature: float | None = None,
+    max_tokens: int | None = None,
+) -> AsyncGenerator[tuple[str, dict], None]:
+    """Starts a streamed completion of `schema`, and returns the generator of its events.
+
+    The events are `("partial", {"data"})` every time more fields are valid,
+    then `("done", {"data", "usage", "time_to_first_field"})` with the object
+    validated against the whole schema, or `("error", {"error", "last_completion"})`.
+    Objects are validated once complete, so unlike `get_parsed_data` there are no
+    validation retries. Errors of the provider raise before the first event.
+    """
+    response_model = get_response_model(schema)
+    # The same prompt instructor sends, with the schema instructions
+    _, kwargs = handle_response_model(
+        response_model, mode=MODE, messages=add_cache_breakpoint(messages, model)
+    )
+    events = _stream_events(
+        response_model,
+        model=model,
+        api_key=api_key,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        **kwargs,
+    )
+    # Runs up to the start of the stream, so provider errors raise here
+    await anext(events)
+    return events
+
+
+async def _stream_events(response_model, **kwargs):
+    start = time.monotonic()
+    # Held by the generator, so it is released when the generator is closed,
+    # even by a client that disconnects before the end of the stream
+    async with llm_semaphore:
+        try:
+            stream = await acompletion(
+                stream=True, stream_options={"include_usage": True}, **kwargs
+            )
+        except tuple(LITELLM_EXCEPTION_TYPES) as e:
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+        except TypeError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        yield None  # started, see `stream_parsed_data`
+        async for event in _parse_stream(stream, response_model, start):
+            yield event
+
+
+async def _parse_stream(stream, response_model, start: float):
+    partial_model = get_partial_model(response_model)
+    content = ""
+    usage = Usage()
+    last_data = None
+    time_to_first_field = None
+    async for chunk in stream:
+        if getattr(chunk, "usage", None):
+            usage = chunk.usage
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            continue
+        content += chunk.choices[0].delta.content
+        text = extract_json(content)
+        if text is None:
+            continue
+        try:
+            obj = from_json(text, allow_partial=True)
+        except ValueError:
+            continue
+        partial = get_valid_fields(partial_model, obj)
+        if partial is None:
+            continue
+        # Fields not generated yet are None
+        data = partial.model_dump(mode="json", exclude_none=True)
+        if not data or data == last_data:
+            continue
+        if time_to_first_field is None:
+            time_to_first_field = time.monotonic() - start
+        last_data = data
+        yield "partial", {"data": data}
+
+    try:
+        data = response_model.model_validate_json(extract_json(content) or "")
+    except ValidationError as e:
+        yield "error", {"error": str(e), "last_completion": content}
+        return
+    yield "done", {
+        "data": data.model_dump(mode="json"),
+        "usage": usage,
+        "time_to_first_field": time_to_first_field,
+    }
+
+
+def sum_usage(usages: list[Usage]) -> Usage:
+    return Usage(
+        prompt_tokens=sum(usage.prompt_tokens for usage in usages),
+        completion_tokens=sum(usage.completion_tokens for usage in usages),
+        total_tokens=sum(usage.total_tokens for usage in usages),
+    )
@@ -0,0 +1 @@
+# Makes the `app` package importable by the tests, as it is from this directory when the server runs
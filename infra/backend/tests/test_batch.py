@@ -0,0 +1,80 @@
+import json
+from types import SimpleNamespace
+
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from litellm import Usage
+
+from app import api
+from app.main import app
+from app.models import MAX_BATCH_SIZE
+
+DEFINITION = {"name": "Person", "fields": {"name": "string"}}
+
+
+def get_inputs(*texts: str) -> list:
+    return [[{"role": "user", "content": text}] for text in texts]
+
+
+def post_batch(inputs: list, **params) -> list:
+    client = TestClient(app)
+    response = client.post(
+        "/api/parse/batch",
+        json={"inputs": inputs, "schema": DEFINITION, **params},
+        headers={"Authorization": "Bearer key"},
+    )
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def fake_parsed_data(name: str, tokens: int):
+    return SimpleNamespace(
+        _raw_response=SimpleNamespace(
+            usage=Usage(prompt_tokens=tokens, completion_tokens=0, total_tokens=tokens)
+        ),
+        model_dump=lambda mode: {"name": name},
+    )
+
+
+def test_batch_retries_and_summary(monkeypatch):
+    monkeypatch.setattr(api, "ITEM_RETRY_DELAY", 0)
+    calls = {}
+
+    async def fake_get_parsed_data(messages, **kwargs):
+        text = messages[0]["content"]
+        calls[text] = calls.get(text, 0) + 1
+        if text == "flaky" and calls[text] == 1:
+            raise HTTPException(status_code=503, detail="Overloaded")
+        if text == "invalid":
+            raise HTTPException(
+                status_code=500,
+                detail={"error": "Invalid", "total_usage": {"prompt_tokens": 30, "completion_tokens": 5, "total_tokens": 35}},
+            )
+        if text == "bad request":
+            raise HTTPException(status_code=400, detail="Bad request")
+        if text == "bug":
+            raise ValueError("Unexpected")
+        return fake_parsed_data(text, 10)
+
+    monkeypatch.setattr(api, "get_parsed_data", fake_get_parsed_data)
+    lines = post_batch(get_inputs("ok", "flaky", "invalid", "bad request", "bug"), item_attempts=2, concurrency=2)
+
+    items = {line["index"]: line for line in lines[:-1]}
+    assert items[0]["data"] == {"name": "ok"}
+    assert items[1]["attempts"] == 2 and items[1]["data"] == {"name": "flaky"}
+    assert items[2]["attempts"] == 2 and items[2]["usage"]["total_tokens"] == 70
+    assert items[3]["attempts"] == 1 and items[3]["error"]["status_code"] == 400
+    assert items[4]["error"] == {"status_code": 500, "detail": "ValueError: Unexpected"}
+
+    summary = lines[-1]
+    assert summary["succeeded"] == 2 and summary["failed"] == 3
+    assert summary["usage"]["total_tokens"] == 10 + 10 + 70
+
+
+def test_batch_size_is_limited():
+    client = TestClient(app)
+    response = client.post(
+        "/api/parse/batch",
+        json={"inputs": get_inputs(*["x"] * (MAX_BATCH_SIZE + 1)), "schema": DEFINITION},
+        headers={"Authorization": "Bearer key"},
+    )
+    assert response.status_code == 422
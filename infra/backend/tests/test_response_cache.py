@@ -0,0 +1,95 @@
+import asyncio
+
+from litellm import Usage
+
+from app import cache, utils
+from app.cache import DiskResponseCache, MemoryResponseCache, get_cache_key
+from app.metamodel import ModelType, to_python_type
+
+SCHEMA = {"type": "object", "properties": {"name": {"type": "string"}}}
+
+
+def get_messages(image_data: str) -> list:
+    return [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "Parse the image"},
+                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_data}"}},
+            ],
+        }
+    ]
+
+
+def test_cache_key_depends_on_api_key():
+    messages = get_messages("AAAA")
+    key = get_cache_key("key-A", "gpt-4o", messages, SCHEMA, 0, None)
+    assert key == get_cache_key("key-A", "gpt-4o", messages, SCHEMA, 0, None)
+    assert key != get_cache_key("bogus", "gpt-4o", messages, SCHEMA, 0, None)
+
+
+def test_cache_key_hashes_images():
+    key = get_cache_key("key-A", "gpt-4o", get_messages("AAAA"), SCHEMA, 0, None)
+    assert key != get_cache_key("key-A", "gpt-4o", get_messages("BBBB"), SCHEMA, 0, None)
+    hashed = cache.hash_images(get_messages("AAAA" * 1000))
+    assert hashed[0]["content"][1]["image_url"]["url"].startswith("sha256:")
+
+
+def test_memory_cache_lru_and_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "time", lambda: now[0])
+    response_cache = MemoryResponseCache(ttl=10, max_size=2)
+    response_cache.set("a", "1")
+    response_cache.set("b", "2")
+    assert response_cache.get("a") == "1"
+    response_cache.set("c", "3")  # evicts b, the least recently used
+    assert response_cache.get("b") is None
+    now[0] += 11
+    assert response_cache.get("a") is None
+    assert response_cache.stats()["hits"] == 1
+
+
+def test_disk_cache_ttl_and_prune(tmp_path, monkeypatch):
+    response_cache = DiskResponseCache(tmp_path, ttl=10, max_size=3, prune_interval=5)
+    for index in range(5):
+        response_cache.set(f"{index:02d}key", str(index))
+    assert len(list(tmp_path.glob("*/*.json"))) == 3
+    assert response_cache.get("04key") == "4"
+
+    now = cache.time.time()
+    monkeypatch.setattr(cache.time, "time", lambda: now + 11)
+    assert response_cache.get("04key") is None
+    response_cache.prune()
+    assert list(tmp_path.glob("*/*.json")) == []
+
+
+def test_cached_responses_are_not_shared_between_api_keys(monkeypatch):
+    calls = []
+
+    class Completions:
+        async def create(self, response_model, **kwargs):
+            calls.append(kwargs["api_key"])
+            data = response_model(name="Ann")
+            data._raw_response = utils.CachedCompletion(usage=Usage(prompt_tokens=10, completion_tokens=2, total_tokens=12))
+            return data
+
+    class Client:
+        class chat:
+            completions = Completions()
+
+    monkeypatch.setattr(utils, "aclient", Client())
+    response_cache = MemoryResponseCache()
+    monkeypatch.setattr(utils, "get_response_cache", lambda: response_cache)
+    schema = to_python_type(ModelType(name="Person", fields={"name": "string"}))
+    messages = get_messages("AAAA")
+
+    async def parse(api_key):
+        return await utils.get_parsed_data(messages, schema, "gpt-4o", api_key, temperature=0)
+
+    first = asyncio.run(parse("key-A"))
+    second = asyncio.run(parse("key-A"))
+    other = asyncio.run(parse("bogus"))
+    assert calls == ["key-A", "bogus"]
+    assert second.name == first.name
+    assert second._raw_response.usage.cached
+    assert not getattr(other._raw_response.usage, "cached", False)
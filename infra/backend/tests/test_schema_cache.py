@@ -0,0 +1,63 @@
+import gc
+import weakref
+
+from pydantic import create_model
+
+from app import metamodel, utils
+from app.metamodel import ModelCache, ModelType, get_type_key, to_python_type
+
+
+def get_definition(**fields) -> ModelType:
+    return ModelType.model_validate({"name": "Person", "fields": fields})
+
+
+def test_type_key_depends_on_content_and_field_order():
+    key = get_type_key(get_definition(name="string", age="integer"))
+    assert key == get_type_key(get_definition(name="string", age="integer"))
+    assert key != get_type_key(get_definition(age="integer", name="string"))
+    assert key != get_type_key(get_definition(name="string", age="decimal"))
+
+
+def test_type_key_keeps_unset_and_default_attributes_apart():
+    unset = get_definition(name={"type": "string"})
+    explicit = get_definition(name={"type": "string", "optional": False})
+    assert get_type_key(unset) != get_type_key(explicit)
+
+
+def test_equal_definitions_share_a_model(monkeypatch):
+    monkeypatch.setattr(metamodel, "model_cache", ModelCache(max_size=8))
+    model = to_python_type(get_definition(name="string"))
+    assert to_python_type(get_definition(name="string")) is model
+    assert metamodel.model_cache.stats()["hits"] == 1
+
+
+def test_model_cache_evicts_the_least_recently_used():
+    cache = ModelCache(max_size=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+
+def test_json_schema_is_built_once_per_response_model():
+    schema = create_model("Pet", name=(str, ...))
+    response_model = utils.get_response_model(schema)
+    assert utils.get_response_model(schema) is response_model
+
+    first = response_model.model_json_schema()
+    first["edited"] = True  # as instructor does
+    assert "edited" not in response_model.model_json_schema()
+    assert len(response_model.__json_schemas__) == 1
+
+
+def test_response_models_are_not_kept_alive_by_their_schemas():
+    schema = create_model("Pet", name=(str, ...))
+    response_model = utils.get_response_model(schema)
+    response_model.model_json_schema()
+    response_model_ref = weakref.ref(response_model)
+    del response_model
+    utils.get_response_model.cache_clear()
+    gc.collect()
+    assert response_model_ref() is None
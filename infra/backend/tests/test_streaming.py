@@ -0,0 +1,63 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from litellm.exceptions import AuthenticationError
+
+from app import utils
+from app.metamodel import ModelType
+
+MESSAGES = [{"role": "user", "content": "A schema of a person with a name"}]
+RESPONSE = '```json\n{"name": "Person", "fields": {"name": "string"}}\n```'
+
+
+def get_chunk(content: str):
+    return SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=content))])
+
+
+async def fake_acompletion(**kwargs):
+    async def stream():
+        for i in range(0, len(RESPONSE), 8):
+            yield get_chunk(RESPONSE[i : i + 8])
+
+    return stream()
+
+
+async def collect(close_after: int = None) -> list:
+    events = await utils.stream_parsed_data(MESSAGES, ModelType, "gpt-4o", "key")
+    collected = []
+    async for event in events:
+        collected.append(event)
+        if len(collected) == close_after:
+            await events.aclose()  # the client went away
+            break
+    return collected
+
+
+def test_stream_ends_with_the_validated_data(monkeypatch):
+    monkeypatch.setattr(utils, "acompletion", fake_acompletion)
+    events = asyncio.run(collect())
+    assert events[0][0] == "partial"
+    event, payload = events[-1]
+    assert event == "done"
+    assert payload["data"]["name"] == "Person"
+
+
+def test_semaphore_is_released_when_the_client_goes_away(monkeypatch):
+    monkeypatch.setattr(utils, "acompletion", fake_acompletion)
+    monkeypatch.setattr(utils, "llm_semaphore", asyncio.Semaphore(1))
+    asyncio.run(collect(close_after=1))
+    assert not utils.llm_semaphore.locked()
+
+
+def test_provider_errors_raise_before_the_stream(monkeypatch):
+    async def failing_acompletion(**kwargs):
+        raise AuthenticationError("Invalid key", llm_provider="openai", model="gpt-4o")
+
+    monkeypatch.setattr(utils, "acompletion", failing_acompletion)
+    monkeypatch.setattr(utils, "llm_semaphore", asyncio.Semaphore(1))
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(collect())
+    assert e.value.status_code == 401
+    assert not utils.llm_semaphore.locked()
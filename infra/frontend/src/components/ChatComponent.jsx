@@ -6,7 +6,7 @@ import { generateSchemaJSON } from '@/utils/schemaUtils';
 import { CHAT_ROLES, DEFAULT_MODEL_SETTINGS } from '@/utils/constants';
 import ChatMessage from './ChatMessage';
 import ModelSettingsDialog from './ModelSettingsDialog';
-import { chatApi, defineSchema, parseData } from '@/utils/apiClient';
+import { chatApi, defineSchema, parseDataStream } from '@/utils/apiClient';
 import { useToast } from "@/components/ui/use-toast";
 import { Tabs, TabsContent, TabsList, TabsTrigger } from "@/components/ui/tabs";
 
@@ -64,9 +64,26 @@ const ChatComponent = ({ importJson, field = null }) => {
         return { role, content: content.text };
     }
 
+    // Adds the assistant message `id`, or replaces it while its data is streamed
+    const setAssistantMessage = (id, data) => {
+        const assistantMessage = {
+            id,
+            role: CHAT_ROLES.ASSISTANT,
+            content: {
+                type: "text",
+                text: JSON.stringify(data, null, 2)
+            }
+        };
+        currentMessageSetter(prev => prev.some(msg => msg.id === id)
+            ? prev.map(msg => msg.id === id ? assistantMessage : msg)
+            : [...prev, assistantMessage]
+        );
+    };
+
     const sendMessages = async () => {
         if (!runMessages || currentMessages.length < 1) return;
         setIsLoading(true);
+        const assistantMessageId = Date.now();
 
         try {
             const convertedMessages = await Promise.all(
@@ -76,14 +93,15 @@ const ChatComponent = ({ importJson, field = null }) => {
             let response;
             if (activeTab === 'parseData') {
                 const schema = generateSchemaJSON(field);
-                response = await parseData({
+                response = await parseDataStream({
                     messages: convertedMessages,
                     schema,
                     model: modelSettings.model,
                     temperature: modelSettings.temperature,
                     max_tokens: modelSettings.max_tokens,
                     max_attempts: modelSettings.max_attempts,
-                    apiKey: modelSettings.apiKey
+                    apiKey: modelSettings.apiKey,
+                    onPartial: (data) => setAssistantMessage(assistantMessageId, data)
                 });
             } else {
                 // response = await defineSchema({
@@ -105,16 +123,7 @@ const ChatComponent = ({ importJson, field = null }) => {
                 });
             }
 
-            const assistantMessage = {
-                id: Date.now(),
-                role: CHAT_ROLES.ASSISTANT,
-                content: {
-                    type: "text",
-                    text: JSON.stringify(response.data, null, 2)
-                }
-            };
-
-            currentMessageSetter(prev => [...prev, assistantMessage]);
+            setAssistantMessage(assistantMessageId, response.data);
         } catch (error) {
             toast({
                 title: "Error calling API",
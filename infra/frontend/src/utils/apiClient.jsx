@@ -61,4 +61,52 @@ export const parseData = async ({ messages, schema, model, temperature, max_toke
   } catch (error) {
     throw error.response ? error.response.data : error.message;
   }
-};
\ No newline at end of file
+};
+
+// Streams the server-sent events of /define or /parse with `stream: true`, calling
+// onPartial with the valid fields so far. Resolves with the `done` event payload.
+const streamRequest = async (path, body, apiKey, onPartial) => {
+  const response = await fetch(`${API_ENDPOINT}${path}`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+      'Authorization': `Bearer ${apiKey}`,
+    },
+    body: JSON.stringify({ ...body, stream: true }),
+  });
+  if (!response.ok) {
+    throw await response.json().catch(() => response.statusText);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  for (;;) {
+    const { done, value } = await reader.read();
+    if (done) {
+      break;
+    }
+    buffer += decoder.decode(value, { stream: true });
+    const events = buffer.split('\n\n');
+    buffer = events.pop();
+    for (const event of events) {
+      const [eventLine, dataLine] = event.split('\n');
+      const type = eventLine.replace('event: ', '');
+      const payload = JSON.parse(dataLine.replace('data: ', ''));
+      if (type === 'partial') {
+        onPartial?.(payload.data);
+      } else if (type === 'done') {
+        return payload;
+      } else if (type === 'error') {
+        throw payload;
+      }
+    }
+  }
+  throw 'The response ended before the data was complete';
+};
+
+export const defineSchemaStream = ({ messages, model, temperature, max_tokens, max_attempts, apiKey, onPartial }) =>
+  streamRequest('/define', { messages, model, temperature, max_tokens, max_attempts }, apiKey, onPartial);
+
+export const parseDataStream = ({ messages, schema, model, temperature, max_tokens, max_attempts, apiKey, onPartial }) =>
+  streamRequest('/parse', { messages, schema, model, temperature, max_tokens, max_attempts }, apiKey, onPartial);
@@ -1 +1 @@
-from .agent import act
+from .agent import act, act_async
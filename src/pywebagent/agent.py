@@ -1,11 +1,29 @@
-import base64
 from enum import Enum
 import json
 import time
 import logging
+from typing import NamedTuple
 from src.pywebagent.env.browser import BrowserEnv
+from src.pywebagent.env.async_browser import AsyncBrowserEnv
+from src.pywebagent.env.pool import get_default_browser_pool
+from src.pywebagent.llm_clients import get_client_registry
+from src.pywebagent.streaming import StreamingCodeParser
+from src.pywebagent.image import ImagePipeline
+from src.pywebagent.observation_cache import CacheLookup, ObservationCache
+from src.pywebagent.trajectory import start_trajectory
+from src.pywebagent.prompt import PromptBudgeter, get_static_prefix
+from src.pywebagent.prompt_cache import (
+    PromptCacheStats,
+    get_cache_params,
+    get_cached_tokens,
+    get_completion_tokens,
+    get_prompt_tokens,
+    observe_usage,
+    record_usage,
+)
+from src.pywebagent.tracing import count, span, trace_run, traced
+from src.pywebagent.env.action_schema import TOOLS, InvalidActionError, actions_to_code, parse_tool_calls
 from langchain.schema import HumanMessage, SystemMessage
-from langchain.chat_models import ChatOpenAI
 
 logger = logging.getLogger(__name__)
 
@@ -19,8 +37,19 @@ class Task:
         self.args = args
 
 
+class AgentResult(NamedTuple):
+    """Result of an agent run, unpacks as `status, output`."""
+    status: TASK_STATUS
+    output: dict
+
+    @property
+    def succeeded(self) -> bool:
+        return self.status == TASK_STATUS.SUCCESS
+
+
 def get_llm():
-    return ChatOpenAI(
+    # Cached by the registry, all the agents share its keep-alive connections
+    return get_client_registry().chat_model(
         model_name="gpt-4o",
         temperature=1,
         request_timeout=120,
@@ -36,58 +65,73 @@ def get_indexed_html_for_observation(observation):
 
     return indexed_html
 
-def generate_user_message(task, observation, num_history):
+def generate_user_message(task, observation, num_history, image_pipeline=None, visual_change=True, prompt_budgeter=None):
+    # The last num_history actions are sent as they are, the older ones as a bounded digest
+    prompt_budgeter = prompt_budgeter or PromptBudgeter()
+    text_prompt, sections = prompt_budgeter.build(task, observation, num_history)
+    count("prompt_text_tokens", sum(sections.values()))
+
+    if not visual_change:
+        # The page looks as it did before the last action, so the screenshot would tell nothing new
+        text_prompt += """
+        Visual change:
+        None, the last action did not visibly change the webpage. No new screenshot is attached.
+        """
+        prompt_budgeter.log_sections(sections)
+        return HumanMessage(content=[{"type": "text", "text": text_prompt}])
+
+    with span("image.process"):
+        image = (image_pipeline or ImagePipeline()).process(observation.screenshot, observation.marked_elements)
+        image_content = image.to_content()
+    logger.info(f"Screenshot of {image.width}x{image.height} at {image.detail} detail: {image.stats}")
+    prompt_budgeter.log_sections(sections, image.stats.tokens)
+    count("image_tokens", image.stats.tokens)
+    text_content = {"type": "text", "text": text_prompt}
 
-    import pdb; pdb.set_trace()
-    # use last num_history actions
-    if observation.env_state.log_history and num_history > 0:
-        log_history = "\n".join(observation.env_state.log_history[-num_history:])
-    else:
-        log_history = ""
+    return HumanMessage(content=[text_content, image_content])
 
-    marked_elements_tags = ", ".join(
-        [
-            f"({str(i)}) - <{elem['tag'].lower()}>"
-            for i, elem in observation.marked_elements.items()
-        ]
-    )
-    text_prompt = f"""
-        Execution error: 
-        {observation.error_message}
 
-        URL: 
-        {observation.url}
+SINGLE_ACTION_RULES = """IMPORTANT: ONLY ONE WEBPAGE FUNCTION CALL IS ALLOWED, EXCEPT FOR FORMS WHERE MULTIPLE CALLS ARE ALLOWED TO FILL MULTIPLE FIELDS! NOTHING IS ALLOWED AFTER THE "```" ENDING THE CODE BLOCK"""
 
-        Marked elements tags:
-        {marked_elements_tags}
-        
-        Task: 
-        {task.task}
+SINGLE_ACTION_CODE_EXAMPLE = """# a single webpage function call. 
+    actions.func_name(args..)"""
 
-        Log of last actions:
-        {log_history}
+PLAN_RULES = """IMPORTANT: YOU MAY WRITE A PLAN OF SEVERAL WEBPAGE FUNCTION CALLS, ONE PER LINE, EXECUTED IN ORDER WITHOUT A NEW SCREENSHOT BETWEEN THEM. ONLY PLAN ACTIONS ON ELEMENTS VISIBLE IN THE CURRENT SCREENSHOT THAT DO NOT DEPEND ON EACH OTHER'S RESULTS, FOR EXAMPLE FILLING ALL THE FIELDS OF A FORM AND THEN CLICKING ITS SUBMIT BUTTON. AN ACTION THAT NAVIGATES OR OPENS SOMETHING NEW MUST BE THE LAST ONE. IF THE PAGE CHANGES UNEXPECTEDLY THE REST OF THE PLAN IS SKIPPED AND YOU GET A NEW SCREENSHOT. NOTHING IS ALLOWED AFTER THE "```" ENDING THE CODE BLOCK"""
 
-        Task Arguments:
-        {json.dumps(task.args, indent=4)}
-        
-    """
+PLAN_CODE_EXAMPLE = """# one or more webpage function calls, the page changing one last.
+    actions.func_name(args..)
+    actions.func_name(args..)"""
 
-    screenshot_binary = observation.screenshot
-    base64_image = base64.b64encode(screenshot_binary).decode("utf-8")
-    image_content = {
-        "type": "image_url",
-        "image_url": {
-            "url": f"data:image/jpeg;base64,{base64_image}",
-            "detail": "high",  # low, high or auto
-        },
-    }
-    text_content = {"type": "text", "text": text_prompt}
 
-    return HumanMessage(content=[text_content, image_content])
+TOOLS_SINGLE_ACTION_RULES = """IMPORTANT: CALL ONLY ONE ACTION, EXCEPT FOR FORMS WHERE SEVERAL input_text AND combobox_select CALLS ARE ALLOWED TO FILL MULTIPLE FIELDS!"""
+
+TOOLS_PLAN_RULES = """IMPORTANT: YOU MAY CALL SEVERAL ACTIONS, EXECUTED IN ORDER WITHOUT A NEW SCREENSHOT BETWEEN THEM. ONLY PLAN ACTIONS ON ELEMENTS VISIBLE IN THE CURRENT SCREENSHOT THAT DO NOT DEPEND ON EACH OTHER'S RESULTS, FOR EXAMPLE FILLING ALL THE FIELDS OF A FORM AND THEN CLICKING ITS SUBMIT BUTTON. AN ACTION THAT NAVIGATES OR OPENS SOMETHING NEW MUST BE THE LAST ONE. IF THE PAGE CHANGES UNEXPECTEDLY THE REST OF THE PLAN IS SKIPPED AND YOU GET A NEW SCREENSHOT."""
 
+ACTION_PROTOCOLS = ("code", "tools")
+MAX_INVALID_RESPONSES = 3  # attempts to get valid actions from the llm, with the tools protocol
 
-def generate_system_message():
-    system_prompt = """
+
+def generate_tools_system_message(plan_mode=False, task=None):
+    rules = TOOLS_PLAN_RULES if plan_mode else TOOLS_SINGLE_ACTION_RULES
+    system_prompt = f"""
+    You are an AI agent that controls a webpage by calling actions, in order to achieve a task.
+    You are provided a screenshot of the webpage at each timeframe, and you decide on the next action to take.
+    element_id is always an integer, and is visible as a green label with white number around the TOP-LEFT CORNER OF EACH ELEMENT. Make sure to examine all green highlighted elements before choosing one to interact with.
+    log_message is a short one sentence explanation of what the action does.
+
+    {rules}
+    IMPORTANT: LOOK FOR CUES IN THE SCREENSHOTS TO SEE WHAT PARTS OF THE TASK ARE COMPLETED AND WHAT PARTS ARE NOT. FOR EXAMPLE, IF YOU ARE ASKED TO BUY A PRODUCT, LOOK FOR CUES THAT THE PRODUCT IS IN THE CART.
+    Before calling the actions, briefly explain the next action, particularly focusing on interpreting the attached screenshot image.
+    """
+    if task is not None:
+        system_prompt = get_static_prefix(system_prompt, task)
+    return SystemMessage(content=system_prompt)
+
+
+def generate_system_message(plan_mode=False, task=None):
+    rules = PLAN_RULES if plan_mode else SINGLE_ACTION_RULES
+    code_example = PLAN_CODE_EXAMPLE if plan_mode else SINGLE_ACTION_CODE_EXAMPLE
+    system_prompt = f"""
     You are an AI agent that controls a webpage using python code, in order to achieve a task.
     You are provided a screenshot of the webpage at each timeframe, and you decide on the next python line to execute.
     You can use the following functions:
@@ -104,7 +148,7 @@ def generate_system_message():
     Do not use keyword arguments, all arguments are positional.
 
     
-    IMPORTANT: ONLY ONE WEBPAGE FUNCTION CALL IS ALLOWED, EXCEPT FOR FORMS WHERE MULTIPLE CALLS ARE ALLOWED TO FILL MULTIPLE FIELDS! NOTHING IS ALLOWED AFTER THE "```" ENDING THE CODE BLOCK
+    {rules}
     IMPORTANT: LOOK FOR CUES IN THE SCREENSHOTS TO SEE WHAT PARTS OF THE TASK ARE COMPLETED AND WHAT PARTS ARE NOT. FOR EXAMPLE, IF YOU ARE ASKED TO BUY A PRODUCT, LOOK FOR CUES THAT THE PRODUCT IS IN THE CART.
     Response format:
 
@@ -115,47 +159,252 @@ def generate_system_message():
     ```python
     # variable definitions and non-webpage function calls are allowed
     ...
-    # a single webpage function call. 
-    actions.func_name(args..)
+    {code_example}
     ```
     """
+    if task is not None:
+        # The task does not change between steps, so it belongs to the static prefix rather than the user message
+        system_prompt = get_static_prefix(system_prompt, task)
     return SystemMessage(content=system_prompt)
 
 
-def extract_code(text):
+def _log_streamed_response(parser, start):
+    logger.info(f"AI message: {parser.text}")
+    if parser.early:
+        logger.info(f"Code was ready after {time.monotonic() - start:.2f}s, before the end of the response")
+
+
+def _get_tool_request(llm, system_message, user_message, cache_params):
+    """Arguments of a chat completion that answers with action tool calls."""
+    return dict(
+        model=llm.model_name,
+        messages=[
+            {"role": "system", "content": system_message.content},
+            {"role": "user", "content": user_message.content},
+        ],
+        tools=TOOLS,
+        tool_choice="required",
+        temperature=llm.temperature,
+        max_tokens=llm.max_tokens,
+        **cache_params,
+    )
+
+
+def _parse_tool_response(response):
+    observe_usage(response.usage)
+    message = response.choices[0].message
+    logger.info(f"AI message: {message.content}")
+    actions = parse_tool_calls(message.tool_calls)
+    logger.info(f"Actions: {actions_to_code(actions)}")
+    return actions
+
+
+def request_tool_actions(llm, system_message, user_message, cache_params):
     """
-    Extracts all text in a string following the pattern "'\nCode:\n".
+    Asks the llm for typed actions through tool calling. The arguments are validated as they are
+    parsed, and a response with invalid actions is asked again, which strict tool schemas make rare.
     """
-    pattern = "\nCode:\n```python\n"
-    start_index = text.find(pattern)
-    if start_index == -1:
-        raise Exception("Code not found")
+    registry = get_client_registry()
+    params = _get_tool_request(llm, system_message, user_message, cache_params)
+
+    def request():
+        with registry.limit("openai"):
+            response = registry.openai().chat.completions.create(**params)
+        return _parse_tool_response(response)
+
+    for attempt in range(MAX_INVALID_RESPONSES):
+        try:
+            return registry.scheduler.call(llm.model_name, request, estimated_tokens=llm.max_tokens)
+        except InvalidActionError as e:
+            if attempt + 1 == MAX_INVALID_RESPONSES:
+                raise
+            logger.warning(f"Invalid actions in the response, asking again: {e}")
+
+
+async def request_tool_actions_async(llm, system_message, user_message, cache_params):
+    registry = get_client_registry()
+    params = _get_tool_request(llm, system_message, user_message, cache_params)
+
+    async def request():
+        async with registry.async_limit("openai"):
+            response = await registry.async_openai().chat.completions.create(**params)
+        return _parse_tool_response(response)
+
+    for attempt in range(MAX_INVALID_RESPONSES):
+        try:
+            return await registry.scheduler.acall(llm.model_name, request, estimated_tokens=llm.max_tokens)
+        except InvalidActionError as e:
+            if attempt + 1 == MAX_INVALID_RESPONSES:
+                raise
+            logger.warning(f"Invalid actions in the response, asking again: {e}")
+
+
+@traced("agent.build_prompt")
+def _generate_messages(task, observation, num_history, image_pipeline, visual_change, plan_mode, prompt_budgeter, action_protocol):
+    if action_protocol not in ACTION_PROTOCOLS:
+        raise ValueError(f"action_protocol must be one of {ACTION_PROTOCOLS}")
+    if action_protocol == "tools":
+        system_message = generate_tools_system_message(plan_mode, task)
+    else:
+        system_message = generate_system_message(plan_mode, task)
+    user_message = generate_user_message(
+        task, observation, num_history, image_pipeline, visual_change, prompt_budgeter
+    )
+    return system_message, user_message
 
-    # Extract the text following the pattern, without the trailing "```"
-    extracted_text = text[start_index + len(pattern) : -3]
 
-    return extracted_text
+def _count_request(system_message, user_message) -> None:
+    """Counts the size of a request, its base64 screenshot included, for the trace."""
+    count("request_bytes", len(json.dumps([system_message.content, user_message.content])))
 
 
-def calculate_next_action(task, observation, num_history):
-    llm = get_llm()
+def _count_usage(usage_reports: list) -> None:
+    for usage in usage_reports:
+        count("prompt_tokens", get_prompt_tokens(usage))
+        count("cached_tokens", get_cached_tokens(usage))
+        count("completion_tokens", get_completion_tokens(usage))
 
-    system_message = generate_system_message()
-    user_message = generate_user_message(task, observation, num_history)
 
-    try:
-        ai_message = llm([system_message, user_message])
-    except:
-        # This sometimes solves the RPM limit issue
-        logger.warning("Failed to get response from OpenAI, trying again in 30 seconds")
-        time.sleep(30)
-        ai_message = llm([system_message, user_message])
+class _StepRequest(NamedTuple):
+    cached: CacheLookup
+    system_message: SystemMessage = None
+    user_message: HumanMessage = None
+    cache_params: dict = None
+    start: float = None
 
-    logger.info(f"AI message: {ai_message.content}")
 
-    code_to_execute = extract_code(ai_message.content)
+def _prepare_step_request(
+    llm, task, observation, num_history, image_pipeline, observation_cache, plan_mode, prompt_budgeter, action_protocol
+):
+    """
+    The part of a step before the llm request, shared by the sync and async agents. The request has
+    no messages when the observation cache gave the code of the step.
+    """
+    cached = (observation_cache or ObservationCache(policy="off")).lookup(task, observation)
+    if cached.code is not None:
+        logger.info("Observation matches a previous one, reusing its code without calling the llm")
+        count("observation_cache_hits", 1)
+        # The reused code is the last decision now, so that it is not reused again if it changes nothing
+        observation_cache.record_hit(cached.fingerprint, cached.code)
+        return _StepRequest(cached)
+
+    system_message, user_message = _generate_messages(
+        task, observation, num_history, image_pipeline, cached.visual_change, plan_mode, prompt_budgeter, action_protocol
+    )
 
-    return code_to_execute
+    # The system message is the static prefix of the prompt, the same for every step of the task
+    cache_params = get_cache_params(system_message.content, llm.model_name)
+    _count_request(system_message, user_message)
+    return _StepRequest(cached, system_message, user_message, cache_params, time.monotonic())
+
+
+def _finish_step_request(step_request, code, usage_reports, observation_cache, prompt_cache_stats):
+    """The part of a step after the llm request, shared by the sync and async agents."""
+    _count_usage(usage_reports)
+    if prompt_cache_stats is not None:
+        prompt_cache_stats.record(usage_reports)
+
+    if observation_cache is not None:
+        observation_cache.store(step_request.cached.fingerprint, code)
+    return code
+
+
+@traced("agent.next_action")
+def calculate_next_action(
+    task,
+    observation,
+    num_history,
+    image_pipeline=None,
+    observation_cache=None,
+    plan_mode=False,
+    prompt_budgeter=None,
+    prompt_cache_stats=None,
+    action_protocol="code",
+):
+    """
+    The next step: python code calling `actions` with the "code" protocol, or a list of validated
+    `Action`s with the "tools" protocol.
+    """
+    llm = get_llm()
+    step_request = _prepare_step_request(
+        llm, task, observation, num_history, image_pipeline, observation_cache, plan_mode, prompt_budgeter, action_protocol
+    )
+    if step_request.cached.code is not None:
+        return step_request.cached.code
+    system_message, user_message, cache_params = step_request.system_message, step_request.user_message, step_request.cache_params
+    registry = get_client_registry()
+
+    def request():
+        # The response is streamed, and the step starts as soon as its first action call is complete,
+        # or once the whole plan is read in plan mode
+        parser = StreamingCodeParser(early=not plan_mode)
+        with registry.limit("openai"):
+            stream = llm.stream([system_message, user_message], **cache_params)
+            try:
+                for chunk in stream:
+                    if parser.feed(chunk.content):
+                        break
+            finally:
+                stream.close()
+        return parser
+
+    with record_usage() as usage_reports, span("llm.request", model=llm.model_name, protocol=action_protocol):
+        if action_protocol == "tools":
+            code = request_tool_actions(llm, system_message, user_message, cache_params)
+        else:
+            # Waits for the rate limit budget of the model and retries rate limited or failed requests
+            parser = registry.scheduler.call(llm.model_name, request, estimated_tokens=llm.max_tokens)
+            _log_streamed_response(parser, step_request.start)
+            code = parser.finish()
+    return _finish_step_request(step_request, code, usage_reports, observation_cache, prompt_cache_stats)
+
+
+@traced("agent.next_action")
+async def calculate_next_action_async(
+    task,
+    observation,
+    num_history,
+    image_pipeline=None,
+    observation_cache=None,
+    plan_mode=False,
+    prompt_budgeter=None,
+    prompt_cache_stats=None,
+    action_protocol="code",
+):
+    llm = get_llm()
+    step_request = _prepare_step_request(
+        llm, task, observation, num_history, image_pipeline, observation_cache, plan_mode, prompt_budgeter, action_protocol
+    )
+    if step_request.cached.code is not None:
+        return step_request.cached.code
+    system_message, user_message, cache_params = step_request.system_message, step_request.user_message, step_request.cache_params
+    registry = get_client_registry()
+
+    async def request():
+        parser = StreamingCodeParser(early=not plan_mode)
+        async with registry.async_limit("openai"):
+            stream = llm.astream([system_message, user_message], **cache_params)
+            try:
+                async for chunk in stream:
+                    if parser.feed(chunk.content):
+                        break
+            finally:
+                await stream.aclose()
+        return parser
+
+    with record_usage() as usage_reports, span("llm.request", model=llm.model_name, protocol=action_protocol):
+        if action_protocol == "tools":
+            code = await request_tool_actions_async(llm, system_message, user_message, cache_params)
+        else:
+            parser = await registry.scheduler.acall(llm.model_name, request, estimated_tokens=llm.max_tokens)
+            _log_streamed_response(parser, step_request.start)
+            code = parser.finish()
+    return _finish_step_request(step_request, code, usage_reports, observation_cache, prompt_cache_stats)
+
+
+def get_action_code(action):
+    """The code of a step, for the steps decided as typed actions too."""
+    return action if isinstance(action, str) else actions_to_code(action)
 
 
 def get_task_status(observation):
@@ -167,18 +416,179 @@ def get_task_status(observation):
         return TASK_STATUS.IN_PROGRESS
 
 
-def act(url, task, num_history, max_actions=40, **kwargs):
-    task = Task(task=task, args=kwargs)
+class _AgentRun:
+    """The bookkeeping of a run of `act` or `act_async`, everything but the browser and llm calls."""
 
-    browser = BrowserEnv(headless=False)
-    observation = browser.reset(url)
-
-    for i in range(max_actions):
-        action = calculate_next_action(task, observation, num_history)
-        observation = browser.step(action, observation.marked_elements)
+    def __init__(self, url, task, trajectory_store) -> None:
+        self.task = task
+        self.trajectory = start_trajectory(trajectory_store, url, task)
+        self.total_settle_time = 0.0
+        self.num_actions = 0
+
+    def start(self, observation) -> None:
+        self.total_settle_time = observation.settle_time
+
+    def get_replayed_action(self, observation, step_span):
+        # Known steps of the task are replayed, the llm only decides the others
+        action = self.trajectory.next_action(observation)
+        step_span.set(replayed=action is not None)
+        return action
+
+    def end_step(self, action, previous_observation, observation):
+        """Records a step, returns the result of the run once the task succeeded or failed, None before."""
+        self.num_actions += 1
+        self.trajectory.record(get_action_code(action), previous_observation.marked_elements, previous_observation.url, observation.error_message)
+        self.total_settle_time += observation.settle_time
         task_status = get_task_status(observation)
-        if task_status in [TASK_STATUS.SUCCESS, TASK_STATUS.FAILED]:
-            return task_status, observation.env_state.output
-
-    logger.warning(f"Reached {i} actions without completing the task.")
-    return TASK_STATUS.FAILED, observation.env_state.output
+        if task_status not in [TASK_STATUS.SUCCESS, TASK_STATUS.FAILED]:
+            return None
+        self._log_settle_time()
+        self.trajectory.finish(task_status == TASK_STATUS.SUCCESS)
+        return AgentResult(task_status, observation.env_state.output)
+
+    def give_up(self, observation):
+        self._log_settle_time()
+        logger.warning(f"Reached {self.num_actions} actions without completing the task.")
+        self.trajectory.finish(False)
+        return AgentResult(TASK_STATUS.FAILED, observation.env_state.output)
+
+    def _log_settle_time(self) -> None:
+        logger.info(f"Spent {self.total_settle_time:.2f}s waiting for pages to settle over {self.num_actions} actions")
+
+
+def act(
+    url,
+    task,
+    num_history,
+    max_actions=40,
+    browser=None,
+    browser_pool=None,
+    image_pipeline=None,
+    observation_cache=None,
+    trajectory_store=None,
+    plan_mode=False,
+    prompt_budgeter=None,
+    prompt_cache_stats=None,
+    action_protocol="code",
+    highlight_actions=False,
+    tracer=None,
+    task_args=None,
+    **kwargs,
+):
+    """
+    Runs the agent on a context leased from `browser_pool`, or created in a sync playwright `browser`
+    of the current thread, or else leased from a default pool of warm browsers shared by all the runs
+    of the current thread. Every observation is sent with its
+    screenshot, unless an `ObservationCache` is passed: its "text_only" policy sends observations that
+    did not visibly change without screenshot, and "reuse" also shares decisions between runs.
+    With a `trajectory_store`, such as `get_default_trajectory_store()`, successful runs are stored and
+    replayed by later runs of the same task on the same domain. Nothing is stored without one.
+    With `plan_mode`, the llm may answer with several independent actions, such as all the fields of a
+    form and its submit button, which run in one step with quick checks of the page between them.
+    The user message of every step is kept within the token budget of `prompt_budgeter`, after a
+    static prefix that providers cache between steps and runs. The cached tokens of each step are
+    logged and added up in `prompt_cache_stats`.
+    With `action_protocol="tools"`, the llm answers with typed action tool calls, validated and
+    dispatched to the actions directly, instead of python code executed by the environment.
+    `highlight_actions` shows the element of every action in red while it runs, for debugging and
+    recordings. It is off by default, so actions do not wait for the highlight to be seen.
+    Every step is traced: the llm request, the actions, settling, marking and screenshots are timed
+    spans with their token and byte counts, and the summary is logged at the end of the run. Pass a
+    `Tracer` as `tracer` to export the trace afterwards, as a Chrome trace or OpenTelemetry json.
+    The arguments of the task are the extra keyword arguments, and the items of `task_args`, which
+    may have any name, including the name of an option above.
+    """
+    task = Task(task=task, args={**kwargs, **(task_args or {})})
+    prompt_budgeter = prompt_budgeter or PromptBudgeter()
+    prompt_cache_stats = prompt_cache_stats or PromptCacheStats()
+    run = _AgentRun(url, task, trajectory_store)
+
+    if browser is None and browser_pool is None:
+        browser_pool = get_default_browser_pool(headless=False)
+    env = BrowserEnv(
+        browser=browser,
+        pool=browser_pool,
+        image_pipeline=image_pipeline,
+        highlight_actions=highlight_actions,
+    )
+    with trace_run(tracer, url=url, task=task.task):
+        try:
+            observation = env.reset(url)
+            run.start(observation)
+
+            for i in range(max_actions):
+                with span("agent.step", index=i) as step_span:
+                    action = run.get_replayed_action(observation, step_span)
+                    if action is None:
+                        action = calculate_next_action(
+                            task, observation, num_history, env.image_pipeline, observation_cache, plan_mode,
+                            prompt_budgeter, prompt_cache_stats, action_protocol,
+                        )
+                    previous_observation = observation
+                    observation = env.step(action, observation.marked_elements)
+                    result = run.end_step(action, previous_observation, observation)
+                    if result is not None:
+                        return result
+
+            return run.give_up(observation)
+        finally:
+            env.close()
+
+
+async def act_async(
+    url,
+    task,
+    num_history,
+    max_actions=40,
+    browser=None,
+    browser_pool=None,
+    image_pipeline=None,
+    observation_cache=None,
+    trajectory_store=None,
+    plan_mode=False,
+    prompt_budgeter=None,
+    prompt_cache_stats=None,
+    action_protocol="code",
+    highlight_actions=False,
+    tracer=None,
+    task_args=None,
+    **kwargs,
+):
+    """
+    Same as `act`, on the async playwright api. Many agents can run concurrently on one event loop,
+    and share Chromium processes by passing the same async playwright `browser` or `AsyncBrowserPool`.
+    """
+    task = Task(task=task, args={**kwargs, **(task_args or {})})
+    prompt_budgeter = prompt_budgeter or PromptBudgeter()
+    prompt_cache_stats = prompt_cache_stats or PromptCacheStats()
+    run = _AgentRun(url, task, trajectory_store)
+
+    env = AsyncBrowserEnv(
+        headless=False,
+        browser=browser,
+        pool=browser_pool,
+        image_pipeline=image_pipeline,
+        highlight_actions=highlight_actions,
+    )
+    with trace_run(tracer, url=url, task=task.task):
+        try:
+            observation = await env.reset(url)
+            run.start(observation)
+
+            for i in range(max_actions):
+                with span("agent.step", index=i) as step_span:
+                    action = run.get_replayed_action(observation, step_span)
+                    if action is None:
+                        action = await calculate_next_action_async(
+                            task, observation, num_history, env.image_pipeline, observation_cache, plan_mode,
+                            prompt_budgeter, prompt_cache_stats, action_protocol,
+                        )
+                    previous_observation = observation
+                    observation = await env.step(action, observation.marked_elements)
+                    result = run.end_step(action, previous_observation, observation)
+                    if result is not None:
+                        return result
+
+            return run.give_up(observation)
+        finally:
+            await env.close()
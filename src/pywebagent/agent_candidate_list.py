@@ -1,21 +1,34 @@
-import base64
-import re
+import ast
+import asyncio
 from enum import Enum
-import os
-import json
-import time
 import logging
-from pywebagent.env.browser import BrowserEnv
-from openai import OpenAI
+from typing import NamedTuple
+from src.pywebagent.env.actions import ELEMENT_ACTIONS, get_action_call
+from src.pywebagent.env.async_browser import AsyncBrowserEnv
+from src.pywebagent.llm_clients import get_client_registry
+from src.pywebagent.image import ImagePipeline
+from src.pywebagent.observation_cache import get_perceptual_hash, get_hash_distance
+from src.pywebagent.prompt import PromptBudgeter, get_static_prefix
+from src.pywebagent.prompt_cache import PromptCacheStats, build_messages, get_cache_params
+from src.pywebagent.streaming import StreamingCodeParser
+from src.pywebagent.trajectory import get_locator, locate_element
 
-from langchain.schema import HumanMessage, SystemMessage
-from langchain.chat_models import ChatOpenAI
 
 logger = logging.getLogger(__name__)
 
 
 TASK_STATUS = Enum("TASK_STATUS", "IN_PROGRESS SUCCESS FAILED")
 
+# Candidates are not executed speculatively when their action has no effect on the page to compare,
+# or an effect outside of it
+UNSPECULATED_ACTIONS = {"finish", "act", "upload_files"}
+# The rank the llm gave a candidate leads its score. The page change only tells candidates that
+# visibly did something from those that did not, it is no measure of progress
+RANK_WEIGHT = 1.0
+CHANGE_WEIGHT = 0.6
+# Share of changed elements, or of the screenshot hash bits, from which a change is certainly visible
+VISIBLE_CHANGE = 0.1
+
 
 class Task:
     def __init__(self, task, args) -> None:
@@ -24,7 +37,7 @@ class Task:
 
 
 def get_llm():
-    return ChatOpenAI(
+    return get_client_registry().chat_model(
         model_name="gpt-4o",
         temperature=1,
         request_timeout=120,
@@ -32,53 +45,21 @@ def get_llm():
     )
 
 
-def generate_user_message(task, observation):
-    log_history = "\n".join(
-        observation.env_state.log_history if observation.env_state.log_history else []
-    )
-    marked_elements_tags = ", ".join(
-        [
-            f"({str(i)}) - <{elem['tag'].lower()}>"
-            for i, elem in observation.marked_elements.items()
-        ]
-    )
-    text_prompt = f"""
-        Execution error: 
-        {observation.error_message}
-
-        URL: 
-        {observation.url}
-
-        Marked elements tags:
-        {marked_elements_tags}
-        
-        Task: 
-        {task.task}
-
-        Log of last actions:
-        {log_history}
-
-        Task Arguments:
-        {json.dumps(task.args, indent=4)}
-        
-    """
+def generate_user_message(task, observation, prompt_budgeter=None):
+    prompt_budgeter = prompt_budgeter or PromptBudgeter()
+    text_prompt, sections = prompt_budgeter.build(task, observation)
 
-    screenshot_binary = observation.screenshot
-    base64_image = base64.b64encode(screenshot_binary).decode("utf-8")
-    image_content = {
-        "type": "image_url",
-        "image_url": {
-            "url": f"data:image/jpeg;base64,{base64_image}",
-            "detail": "high",  # low, high or auto
-        },
-    }
+    image = ImagePipeline().process(observation.screenshot, observation.marked_elements)
+    logger.info(f"Screenshot of {image.width}x{image.height} at {image.detail} detail: {image.stats}")
+    prompt_budgeter.log_sections(sections, image.stats.tokens)
+    image_content = image.to_content()
     text_content = {"type": "text", "text": text_prompt}
 
     # return HumanMessage(content=[text_content, image_content])
     return text_content, image_content
 
 
-def generate_system_message():
+def generate_system_message(task=None):
     # IMPORTANT: ONLY ONE WEBPAGE FUNCTION CALL IS ALLOWED, EXCEPT FOR FORMS WHERE MULTIPLE CALLS ARE ALLOWED TO FILL MULTIPLE FIELDS! NOTHING IS ALLOWED AFTER THE "```" ENDING THE CODE BLOCK
     system_prompt = """
     You are an AI agent that controls a webpage using python code, in order to achieve a task.
@@ -121,103 +102,234 @@ def generate_system_message():
     ```
     """
     # return SystemMessage(content=system_prompt)
+    if task is not None:
+        system_prompt = get_static_prefix(system_prompt, task)
     return system_prompt
 
 
-def extract_code(text):
+
+def extract_candidates(text):
+    """
+    The candidate actions of a response, in the order the llm listed them, without duplicates. Each
+    candidate is the code of one webpage function call, after the other statements of the code block.
+    """
+    parser = StreamingCodeParser(early=False)
+    parser.feed(text)
+    code = parser.finish()
+    try:
+        statements = ast.parse(code).body
+    except SyntaxError:
+        # A truncated or malformed line should not cost the other candidates
+        statements = []
+        for line in code.splitlines():
+            try:
+                statements.extend(ast.parse(line.strip()).body)
+            except SyntaxError:
+                logger.warning(f"Skipping candidate line that does not parse: {line}")
+
+    prefix = []
+    candidates = []
+    for statement in statements:
+        if get_action_call(statement) is None:
+            prefix.append(ast.unparse(statement))
+            continue
+        candidate = ast.unparse(statement)
+        if candidate not in candidates:
+            candidates.append(candidate)
+    return ["\n".join(prefix + [candidate]) for candidate in candidates]
+
+
+def get_candidate_action(code):
+    """Name of the webpage function the candidate calls."""
+    for statement in ast.parse(code).body:
+        call = get_action_call(statement)
+        if call is not None:
+            return call.func.attr
+    return None
+
+
+class _RemapElementIds(ast.NodeTransformer):
+    def __init__(self, marked_elements: dict, clone_marked_elements: dict) -> None:
+        self.marked_elements = marked_elements
+        self.clone_marked_elements = clone_marked_elements
+        self.remapped = True
+
+    def visit_Call(self, node):
+        if isinstance(node.func, ast.Attribute) and node.func.attr in ELEMENT_ACTIONS and node.args:
+            element_id = node.args[0]
+            clone_id = None
+            if isinstance(element_id, ast.Constant) and element_id.value in self.marked_elements:
+                clone_id = locate_element(get_locator(self.marked_elements[element_id.value]), self.clone_marked_elements)
+            if clone_id is None:
+                self.remapped = False
+            else:
+                node.args[0] = ast.Constant(clone_id)
+        return self.generic_visit(node)
+
+
+def remap_candidate(code, marked_elements, clone_marked_elements):
     """
-    Extracts all text in a string following the pattern "'\nCode:\n".
+    The candidate with the ids of its elements in the clone of the page, which marks them anew,
+    or None if one of them cannot be found there.
     """
-    pattern = "\nCode:\n```python\n"
-    start_index = text.find(pattern)
-    if start_index == -1:
-        raise Exception("Code not found")
+    remap = _RemapElementIds(marked_elements, clone_marked_elements)
+    tree = remap.visit(ast.parse(code))
+    return ast.unparse(tree) if remap.remapped else None
 
-    # Extract the text following the pattern, without the trailing "```"
-    extracted_text = text[start_index + len(pattern) : -3]
 
-    return extracted_text
+class CandidateOutcome(NamedTuple):
+    code: str  # the candidate, with the element ids of the main page
+    rank: int
+    observation: object = None  # observation of the clone after the candidate, None if not evaluated
+    score: float = float("-inf")
 
 
-def extract_code_many_actions(text):
+def score_outcome(before, after, rank, num_candidates):
     """
-    Extracts all text in a string following the pattern "'\nCode:\n".
+    The rank the llm gave the candidate, plus a cheap signal that it changed the page: navigation, the
+    share of marked elements that appeared or disappeared, or the perceptual distance of the screenshots.
+    The signal saturates at a visible change, so among candidates that all did something the ranking
+    decides, and navigating away is not favored over typing in a field. Candidates that failed score lowest.
     """
-    pattern = "\nCode:\n```python\n"
-    start_index = text.find(pattern)
-    if start_index == -1:
-        raise Exception("Code not found")
+    if after.error_message is not None:
+        return float("-inf")
+    change = 1.0 if after.url != before.url else 0.0
+    before_xpaths = {element["xpath"] for element in before.marked_elements.values()}
+    after_xpaths = {element["xpath"] for element in after.marked_elements.values()}
+    if before_xpaths | after_xpaths:
+        change = max(change, 1 - len(before_xpaths & after_xpaths) / len(before_xpaths | after_xpaths))
+    distance = get_hash_distance(get_perceptual_hash(before.screenshot), get_perceptual_hash(after.screenshot))
+    change = min(max(change, distance / 64) / VISIBLE_CHANGE, 1.0)
+    return RANK_WEIGHT * (num_candidates - rank) / num_candidates + CHANGE_WEIGHT * change
+
+
+def make_llm_judge(model_name="gpt-4o-mini"):
+    """
+    A judge that asks a small model how much the outcome of a candidate progresses the task, from 0 to 1.
+    It sees the outcome screenshot at low detail, so a verdict costs a fixed few hundred tokens.
+    """
+    image_pipeline = ImagePipeline(detail="low")
 
-    # Extract the text following the pattern, without the trailing "```"
-    extracted_text = text[start_index + len(pattern) : -3]
+    async def judge(task, code, before, after):
+        registry = get_client_registry()
+        image = image_pipeline.process(after.screenshot, after.marked_elements)
+        prompt = f"""
+        Task:
+        {task.task}
 
-    actions = extracted_text.split("\n")
-    import pdb
+        Action taken on {before.url}:
+        {code}
 
-    pdb.set_trace()
+        The attached screenshot is the page after the action, now at {after.url}.
+        How much closer to completing the task is the page after this action? Answer with a single
+        number between 0 (no progress or wrong direction) and 10 (the task can now be completed).
+        """
 
-    return extracted_text
+        async def request():
+            async with registry.async_limit("openai"):
+                return await registry.async_openai().chat.completions.create(
+                    model=model_name,
+                    messages=[{"role": "user", "content": [{"type": "text", "text": prompt}, image.to_content()]}],
+                    max_tokens=5,
+                    temperature=0,
+                )
 
+        response = await registry.scheduler.acall(model_name, request, estimated_tokens=image.stats.tokens + 200)
+        try:
+            return min(max(float(response.choices[0].message.content.strip()) / 10, 0), 1)
+        except ValueError:
+            logger.warning(f"Judge answered {response.choices[0].message.content!r}, ignoring it")
+            return 0
 
-def get_gpt4_response(system_message, text_content, image_content):
-    client = OpenAI(
-        # This is the default and can be omitted
-        api_key=os.environ.get("OPENAI_API_KEY"),
-    )
+    return judge
+
+
+async def get_gpt4_response(system_message, text_content, image_content):
+    registry = get_client_registry()
+    client = registry.async_openai()
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "system",
-                    "content": [{"type": "text", "text": system_message}],
-                },
-                {
-                    "role": "user",
-                    "content": [text_content, image_content],
-                },
-            ],
-            # response_format={"type": "json_object"} if "json" in prompt.lower() else None,
-            # temperature=temperature,
-            max_tokens=4_096,
-        )
+        async with registry.async_limit("openai"):
+            response = await client.chat.completions.create(
+                model="gpt-4o",
+                # The system message is the static prefix of the prompt, cached by the provider between steps
+                messages=build_messages(system_message, [text_content, image_content], "gpt-4o"),
+                # response_format={"type": "json_object"} if "json" in prompt.lower() else None,
+                # temperature=temperature,
+                max_tokens=4_096,
+                **get_cache_params(system_message, "gpt-4o"),
+            )
     except Exception as e:
         logger.error(f"Failed to get response from OpenAI: {e}")
         raise e
     return response
 
 
-def calcualte_next_action(task, observation):
-    llm = get_llm()
-
-    system_message = generate_system_message()
-    user_message = generate_user_message(task, observation)
-
-    try:
-        # ai_message = llm([system_message, user_message])
-        # Before subing out this `llm` for a standard gpt-4o call, see what it spits out
-        ai_message = get_gpt4_response(system_message, user_message[0], user_message[1])
-    except:
-        # This sometimes solves the RPM limit issue
-        logger.warning("Failed to get response from OpenAI, trying again in 30 seconds")
-        exit(0)
-        time.sleep(30)
-        # ai_message = llm([system_message, user_message])
+async def calculate_candidate_actions(task, observation, prompt_budgeter=None, prompt_cache_stats=None):
+    system_message = generate_system_message(task)
+    text_content, image_content = generate_user_message(task, observation, prompt_budgeter)
 
-    # logger.info(f"AI message: {ai_message.content}")
-    # code_to_execute = extract_code(ai_message.content)
-
-    # Extract code for many actions
-    # command_options = extract_code_many_actions(ai_message.choices[0].message.content)
-    pattern = r"actions\.\w+\([^()]*\)"
-    # Find all matches in the text
-
-    matches = re.findall(pattern, ai_message.choices[0].message.content)
-    import pdb
+    ai_message = await get_client_registry().scheduler.acall(
+        "gpt-4o",
+        lambda: get_gpt4_response(system_message, text_content, image_content),
+        estimated_tokens=4_096,
+    )
+    if prompt_cache_stats is not None:
+        prompt_cache_stats.record([ai_message.usage])
+    content = ai_message.choices[0].message.content
+    logger.info(f"AI message: {content}")
+    return extract_candidates(content)
 
-    pdb.set_trace()
 
-    return code_to_execute
+async def evaluate_candidate(env, observation, code, rank, num_candidates, task=None, judge=None):
+    """Executes the candidate in a fork of `env`, and scores the page it leads to."""
+    clone, clone_observation = await env.fork()
+    try:
+        clone_code = remap_candidate(code, observation.marked_elements, clone_observation.marked_elements)
+        if clone_code is None:
+            logger.info(f"Candidate {rank} refers to elements not found in its clone: {code}")
+            return CandidateOutcome(code, rank)
+        after = await clone.step(clone_code, clone_observation.marked_elements)
+        score = score_outcome(clone_observation, after, rank, num_candidates)
+        if judge is not None and after.error_message is None:
+            score += await judge(task, code, clone_observation, after)
+        return CandidateOutcome(code, rank, after, score)
+    finally:
+        await clone.close()
+
+
+async def choose_candidate(env, task, observation, candidates, max_parallel=4, judge=None):
+    """
+    Picks the candidate to commit to `env`. The top `max_parallel` candidates are executed at the same
+    time, each in its own fork of the page, and the one whose outcome scores best wins. The llm's own
+    first choice is taken as is when there is nothing to compare.
+    Speculation really executes the candidates in the forks: keep it away from tasks where an action
+    cannot be taken twice, such as placing an order.
+    """
+    speculated = [
+        (rank, code) for rank, code in enumerate(candidates[:max_parallel])
+        if get_candidate_action(code) not in UNSPECULATED_ACTIONS
+    ]
+    if len(speculated) < 2 or speculated[0][0] != 0:
+        return candidates[0]
+
+    outcomes = await asyncio.gather(
+        *[
+            evaluate_candidate(env, observation, code, rank, len(speculated), task=task, judge=judge)
+            for rank, code in speculated
+        ],
+        return_exceptions=True,
+    )
+    scored = []
+    for (rank, code), outcome in zip(speculated, outcomes):
+        if isinstance(outcome, Exception):
+            logger.warning(f"Evaluating candidate {rank} failed: {outcome}")
+            continue
+        logger.info(f"Candidate {rank} scored {outcome.score:.2f}: {code}")
+        scored.append(outcome)
+    if not scored:
+        return candidates[0]
+    best = max(scored, key=lambda outcome: outcome.score)
+    return best.code if best.score > float("-inf") else candidates[0]
 
 
 def get_task_status(observation):
@@ -229,18 +341,32 @@ def get_task_status(observation):
         return TASK_STATUS.IN_PROGRESS
 
 
-def act(url, task, max_actions=40, **kwargs):
+async def act_async(url, task, max_actions=40, max_parallel=4, judge=None, browser=None, **kwargs):
+    """
+    Runs the task, choosing each action among the candidates of the llm by their speculative outcomes.
+    Pass `judge` (see `make_llm_judge`) to add the verdict of a small model to the page change signal.
+    """
     task = Task(task=task, args=kwargs)
+    prompt_budgeter = PromptBudgeter()
+    prompt_cache_stats = PromptCacheStats()
+
+    env = AsyncBrowserEnv(headless=False, browser=browser)
+    try:
+        observation = await env.reset(url)
+
+        for i in range(max_actions):
+            candidates = await calculate_candidate_actions(task, observation, prompt_budgeter, prompt_cache_stats)
+            action = await choose_candidate(env, task, observation, candidates, max_parallel=max_parallel, judge=judge)
+            observation = await env.step(action, observation.marked_elements)
+            task_status = get_task_status(observation)
+            if task_status in [TASK_STATUS.SUCCESS, TASK_STATUS.FAILED]:
+                return task_status, observation.env_state.output
 
-    browser = BrowserEnv(headless=False)
-    observation = browser.reset(url)
+        logger.warning(f"Reached {i} actions without completing the task.")
+        return TASK_STATUS.FAILED, observation.env_state.output
+    finally:
+        await env.close()
 
-    for i in range(max_actions):
-        action = calcualte_next_action(task, observation)
-        observation = browser.step(action, observation.marked_elements)
-        task_status = get_task_status(observation)
-        if task_status in [TASK_STATUS.SUCCESS, TASK_STATUS.FAILED]:
-            return task_status, observation.env_state.output
 
-    logger.warning(f"Reached {i} actions without completing the task.")
-    return TASK_STATUS.FAILED, observation.env_state.output
+def act(url, task, max_actions=40, max_parallel=4, judge=None, **kwargs):
+    return asyncio.run(act_async(url, task, max_actions=max_actions, max_parallel=max_parallel, judge=judge, **kwargs))
@@ -0,0 +1,170 @@
+from typing import ClassVar, Literal
+
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+
+
+class InvalidActionError(Exception):
+    pass
+
+
+class Action(BaseModel):
+    """
+    A typed call of one of the `Actions` methods. The fields are the positional arguments of the
+    method, in order, so an action is dispatched without generating or executing any python code.
+    """
+    model_config = ConfigDict(extra="forbid")
+
+    name: ClassVar[str]
+    # Strict tool schemas constrain the decoding of the arguments, which needs a closed schema
+    strict: ClassVar[bool] = True
+
+    def call_args(self) -> tuple:
+        return tuple(getattr(self, field) for field in type(self).model_fields)
+
+    def call_kwargs(self) -> dict:
+        return {}
+
+    def dispatch(self, actions):
+        """Calls the action on `actions`. Returns a coroutine for `AsyncActions`."""
+        return getattr(actions, self.name)(*self.call_args(), **self.call_kwargs())
+
+    def to_code(self) -> str:
+        """The equivalent line of the code protocol, for logs, stored trajectories and the observation cache."""
+        args = [repr(arg) for arg in self.call_args()]
+        args += [f"{key}={value!r}" for key, value in self.call_kwargs().items()]
+        return f"actions.{self.name}({', '.join(args)})"
+
+
+class Click(Action):
+    """Click on an element."""
+    name: ClassVar[str] = "click"
+    element_id: int
+    log_message: str
+
+
+class InputText(Action):
+    """Type text in an element. Use clear_before_input=true to replace the text instead of appending to it. Never use this on a combobox."""
+    name: ClassVar[str] = "input_text"
+    element_id: int
+    text: str
+    clear_before_input: bool
+    log_message: str
+
+
+class UploadFiles(Action):
+    """Use this instead of click if clicking is expected to open a file picker."""
+    name: ClassVar[str] = "upload_files"
+    element_id: int
+    files: list[str]
+    log_message: str
+
+
+class Scroll(Action):
+    """Scroll the page up or down by one screen."""
+    name: ClassVar[str] = "scroll"
+    direction: Literal["up", "down"]
+    log_message: str
+
+
+class ComboboxSelect(Action):
+    """Select an option from a combobox."""
+    name: ClassVar[str] = "combobox_select"
+    element_id: int
+    option: str
+    log_message: str
+
+
+class Finish(Action):
+    """The task is complete, with did_succeed true or false, a text reason, and the output values if the task succeeded."""
+    name: ClassVar[str] = "finish"
+    strict: ClassVar[bool] = False  # output is a free form object
+    did_succeed: bool
+    output: dict = Field(default_factory=dict)
+    reason: str
+
+
+class Act(Action):
+    """
+    Run another agent on a different webpage, until it finishes with a result you can use later, e.g. to get
+    auth details from an email. Describe the task in natural language and provide in args ALL the arguments
+    the sub-agent needs, otherwise it will fail.
+    """
+    name: ClassVar[str] = "act"
+    strict: ClassVar[bool] = False  # args is a free form object
+    url: str
+    task: str
+    log_message: str
+    args: dict = Field(default_factory=dict)
+
+    def call_args(self) -> tuple:
+        return self.url, self.task, self.log_message
+
+    def call_kwargs(self) -> dict:
+        # One mapping, so that an argument of the llm cannot set an option of the sub agent run
+        return {"task_args": self.args}
+
+
+ACTION_TYPES = {action_type.name: action_type for action_type in (Click, InputText, UploadFiles, Scroll, ComboboxSelect, Finish, Act)}
+
+
+def _get_parameters(action_type) -> dict:
+    schema = action_type.model_json_schema()
+    schema.pop("title", None)
+    schema.pop("description", None)
+    for field_schema in schema["properties"].values():
+        field_schema.pop("title", None)
+        field_schema.pop("default", None)
+    if action_type.strict:
+        schema["required"] = list(schema["properties"])
+        schema["additionalProperties"] = False
+    return schema
+
+
+def get_tools() -> list:
+    """The actions as tools of the OpenAI chat completions api."""
+    return [
+        {
+            "type": "function",
+            "function": {
+                "name": name,
+                "description": " ".join(action_type.__doc__.split()),
+                "parameters": _get_parameters(action_type),
+                "strict": action_type.strict,
+            },
+        }
+        for name, action_type in ACTION_TYPES.items()
+    ]
+
+
+TOOLS = get_tools()
+
+
+def parse_action(name: str, arguments) -> Action:
+    """Validates a tool call, given its name and its json (or already decoded) arguments."""
+    action_type = ACTION_TYPES.get(name)
+    if action_type is None:
+        raise InvalidActionError(f"Unknown action {name}")
+    try:
+        if isinstance(arguments, str):
+            return action_type.model_validate_json(arguments or "{}")
+        return action_type.model_validate(arguments)
+    except ValidationError as e:
+        raise InvalidActionError(f"Invalid arguments for {name}: {e}") from e
+
+
+def parse_tool_calls(tool_calls) -> list:
+    """The actions of the tool calls of a completion message, in order."""
+    if not tool_calls:
+        raise InvalidActionError("The response has no action")
+    actions = []
+    for tool_call in tool_calls:
+        function = tool_call["function"] if isinstance(tool_call, dict) else tool_call.function
+        if isinstance(function, dict):
+            actions.append(parse_action(function["name"], function["arguments"]))
+        else:
+            actions.append(parse_action(function.name, function.arguments))
+    return actions
+
+
+def actions_to_code(actions: list) -> str:
+    return "\n".join(action.to_code() for action in actions)
@@ -1,11 +1,35 @@
+import ast
 import time
 import logging
 from attr import dataclass
 import playwright
-import subprocess
+from src.pywebagent.tracing import traced
 
 logger = logging.getLogger(__name__)
 
+# Actions whose first argument is the id of a marked element
+ELEMENT_ACTIONS = {"click", "input_text", "upload_files", "combobox_select"}
+
+# Seconds a highlighted element stays red before it is acted on, so that recordings show it
+HIGHLIGHT_DELAY = 0.5
+# Recolors the border and the label of a marked element in one call
+SET_HIGHLIGHT_JS = """([id, color]) => {
+    const border = document.getElementById(`item_id_border__${id}`);
+    const label = document.getElementById(`item_id_label__${id}`);
+    if (border) border.style.borderColor = color;
+    if (label) label.style.backgroundColor = color;
+}"""
+
+
+def get_action_call(statement):
+    """Returns the call if `statement` is a top level `actions.<name>(...)` call, None otherwise."""
+    if not isinstance(statement, ast.Expr) or not isinstance(statement.value, ast.Call):
+        return None
+    func = statement.value.func
+    if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id == "actions":
+        return statement.value
+    return None
+
 @dataclass
 class EnvState:
     has_successfully_completed: bool = False
@@ -15,18 +39,55 @@ class EnvState:
     log_history: list[str] = []
 
 
-class Actions:
-    def __init__(self, page, marked_elements: list, env_state: EnvState) -> None:
+# Attribute the marking pass tags every marked element with, set to its id until the marks are removed
+MARK_ID_ATTRIBUTE = "data-pywebagent-id"
+
+
+def get_marked_element_locators(element_info: dict) -> tuple:
+    """
+    Locators of a marked element: by the id it was tagged with when marked, and by its xpath, for when
+    the page replaced the element since. Playwright resolves them in the page as part of the action itself.
+    """
+    frame = element_info['iframe']
+    by_id = frame.locator(f'[{MARK_ID_ATTRIBUTE}="{element_info["id"]}"]')
+    return by_id, frame.locator(f"xpath={element_info['xpath']}").first
+
+
+def get_marked_element_locator(element_info: dict):
+    """A locator matching the element by either of its locators, to check that it is still there."""
+    by_id, by_xpath = get_marked_element_locators(element_info)
+    return by_id.or_(by_xpath).first
+
+
+def get_element_info(marked_elements: dict, item_id: int) -> dict:
+    if item_id not in marked_elements:
+        raise Exception(f"Element with id {item_id} is not marked in the webpage.")
+    return marked_elements[item_id]
+
+
+class BaseActions:
+    """State and page-independent logic shared by the sync and the async actions."""
+
+    def __init__(self, page, marked_elements: list, env_state: EnvState, browser=None, pool=None, highlight=False) -> None:
         self.env_state = env_state
         self.page = page
         self.marked_elements = marked_elements
+        # Sub agents run on a new context of the same browser, or of the same browser pool
+        self.browser = browser
+        self.pool = pool
+        # Debug and recording mode, the element turns red while it is acted on
+        self.highlight = highlight
+        self._locators = {}
 
-    def finish(self, success, output: dict, reason: str) -> None:
+    def set_page(self, page):
+        self.page = page
+
+    def _finish(self, success, output: dict) -> None:
         self.env_state.has_successfully_completed = success
         self.env_state.has_failed = not success
         self.env_state.output = output
 
-    def act(self, url, task, log_message, **kwargs) -> None:
+    def _start_sub_agent(self, url, log_message) -> None:
         # if url is not valid
         if not url.startswith("https://"):
             raise Exception("URL must start with https://")
@@ -39,52 +100,90 @@ class Actions:
 
         if log_message:
             self.env_state.log_history.append(log_message)
-        process = subprocess.Popen(["python", "run.py", "--url", url, "--task", task, "--kwargs", str(kwargs)], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        stdout, stderr = process.communicate()
-        if process.returncode != 0:
-            raise Exception("Error running ai agent:", stderr)
-        stdout = stdout.split("\n")
-        status = stdout[-3][len("Status: "):]
-        assert status == "TASK_STATUS.SUCCESS", f"AI agent failed with status {status}"
-        output = stdout[-2][len("Output: "):]
-        try:
-            output = eval(output)
-        except Exception as e:
-            raise Exception("Failed to parse output as JSON from AI agent:", stdout, e)
 
-        self.env_state.log_history.append(f"Sub agent finished successfully with output: {output}")
-        return output
+    def _end_sub_agent(self, result):
+        if not result.succeeded:
+            raise Exception(f"AI agent failed with status {result.status}")
+
+        self.env_state.log_history.append(f"Sub agent finished successfully with output: {result.output}")
+        return result.output
+
+    def _get_click_retry(self, click_exception, force) -> bool:
+        """
+        Called when no file chooser opened during a click: False if the click succeeded, True to retry an
+        unstable element with force, and raises the error of the click otherwise.
+        """
+        if click_exception is None:
+            return False  # Expected scenario: file chooser did not open.
+        if self._is_unstable_element_exception(click_exception) and not force:
+            return True
+        raise click_exception
+
+    @staticmethod
+    def _get_scroll_script(direction: str) -> str:
+        if direction not in ["up", "down"]:
+            raise Exception("direction must be either 'up' or 'down'")
         
-    def set_page(self, page):
-        self.page = page
+        # Scroll by the height of the viewport for page down/up
+        scroll_height = "window.innerHeight"  # Gets the height of the viewport
+        if direction == "up":
+            return f"window.scrollBy(0, -{scroll_height})"
+        return f"window.scrollBy(0, {scroll_height})"
+
+    @staticmethod
+    def _get_input_method(clear_before_input: bool) -> str:
+        return "fill" if clear_before_input else "type"
+
+    @staticmethod
+    def _is_unstable_element_exception(e):
+        e_lines = str(e).split('\n')
+        print(e_lines)
+        return (isinstance(e, playwright._impl._api_types.TimeoutError)
+                and "element is not stable - waiting..." in e_lines[-2] 
+                and "==============" in e_lines[-1])
+
+
+class Actions(BaseActions):
+    @traced("actions.finish")
+    def finish(self, success, output: dict, reason: str) -> None:
+        self._finish(success, output)
+
+    @traced("actions.act")
+    def act(self, url, task, log_message, task_args=None, **kwargs) -> None:
+        self._start_sub_agent(url, log_message)
+
+        # The sub agent runs in this process and thread, on a new context of the same browser or pool
+        from src.pywebagent.agent import act
+        # The arguments of the llm are always arguments of the task, never options of the run
+        result = act(
+            url, task, num_history=0, browser=self.browser, browser_pool=self.pool,
+            task_args={**kwargs, **(task_args or {})},
+        )
+        return self._end_sub_agent(result)
+
+    def _get_locator(self, item_id: int):
+        locator = self._locators.get(item_id)
+        if locator is None:
+            by_id, by_xpath = get_marked_element_locators(get_element_info(self.marked_elements, item_id))
+            locator = self._locators[item_id] = by_id if by_id.count() else by_xpath
+        return locator
+
+    def _set_highlight(self, item_id: int, color: str) -> None:
+        self.marked_elements[item_id]['iframe'].evaluate(SET_HIGHLIGHT_JS, [item_id, color])
 
     def _visualized_interact(self, item_id: int, func: str, *args, **kwargs) -> None:
-        """Mark element border with red and executes the given function."""
-        if item_id not in self.marked_elements:
-            raise Exception(f"Element with id {item_id} is not marked in the webpage.")
-        element_info = self.marked_elements[item_id]
-        xpath = element_info['xpath']
-        iframe = element_info['iframe']
-        element = iframe.evaluate_handle(
-            f"document.evaluate('{xpath}', document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue")
-        
+        """Executes the given function on the element, marking its border with red first in highlight mode."""
+        locator = self._get_locator(item_id)
+        if self.highlight:
+            self._set_highlight(item_id, "red")
+            time.sleep(HIGHLIGHT_DELAY)
 
-        border = iframe.evaluate_handle(f"document.getElementById('item_id_border__{item_id}')")
-        label = iframe.evaluate_handle(f"document.getElementById('item_id_label__{item_id}')")
-        border.evaluate(f"(element) => element.style.borderColor = 'red'")
-        label.evaluate(f"(element) => element.style.backgroundColor = 'red'")
-        
-        time.sleep(1)  # Wait a bit for the color change to be visible
-
-        # str func to element func
-        element_func = getattr(element, func)
-        assert element_func, f"Element with id {id} does not have a function {func}."
-        element_func(*args, **kwargs)
-        border.evaluate(f"(element) => element.style.borderColor = 'green'")
-        label.evaluate(f"(element) => element.style.backgroundColor = 'green'")
-        
-        element.dispose()
-    
+        getattr(locator, func)(*args, **kwargs)
+
+        if self.highlight:
+            self._set_highlight(item_id, "green")
+
+    @traced("actions.click")
     def click(self, item_id: int, log_message: str, force=False) -> None:
         """
         Attempts to click an element identified by `item_id`.
@@ -94,53 +193,38 @@ class Actions:
         if log_message:
             self.env_state.log_history.append(log_message)
         try:
-            inner_exception_raised = False
+            inner_exception = None
             with self.page.expect_file_chooser(timeout=1200):
                 try:
                     self._visualized_interact(item_id, "click", timeout=5000, force=force, no_wait_after=True)
                 except Exception as e_click:
-                    inner_exception_raised = True
                     inner_exception = e_click
 
         except playwright._impl._api_types.TimeoutError:
-            if not inner_exception_raised:
-                return  # Expected scenario: file chooser did not open.
-
-            # Handle click-related exceptions.
-            if inner_exception_raised:
-                if self._is_unstable_element_exception(inner_exception) and not force:
-                    return self.click(item_id, log_message="", force=True)
-                else:
-                    raise inner_exception
+            if self._get_click_retry(inner_exception, force):
+                return self.click(item_id, log_message="", force=True)
+            return
         except Exception as e:
             assert False, f"Unexpected exception raised: {e}"  # Unexpected exception outside the file chooser context.
 
         raise Exception("filechooser event was triggered unexpectedly. Consider using upload_files() instead of click() for this element.")
 
+    @traced("actions.scroll")
     def scroll(self, direction: str, log_message: str) -> None:
         self.env_state.log_history.append(log_message)
-        if direction not in ["up", "down"]:
-            raise Exception("direction must be either 'up' or 'down'")
-        
-        # Scroll by the height of the viewport for page down/up
-        scroll_height = "window.innerHeight"  # Gets the height of the viewport
-
-        if direction == "up":
-            self.page.evaluate(f"window.scrollBy(0, -{scroll_height})")
-        else:
-            self.page.evaluate(f"window.scrollBy(0, {scroll_height})")
+        self.page.evaluate(self._get_scroll_script(direction))
 
+    @traced("actions.combobox_select")
     def combobox_select(self, item_id: int, option: str, log_message: str) -> None:
         self.env_state.log_history.append(log_message)
         self._visualized_interact(item_id, "select_option", option)
 
+    @traced("actions.input_text")
     def input_text(self, item_id: int, text: str, clear_before_input: bool, log_message: str):
         self.env_state.log_history.append(log_message)
-        if clear_before_input:
-            self._visualized_interact(item_id, "fill", text)
-        else:
-            self._visualized_interact(item_id, "type", text)
+        self._visualized_interact(item_id, self._get_input_method(clear_before_input), text)
 
+    @traced("actions.upload_files")
     def upload_files(self, item_id: int, files: list, log_message: str) -> None:
         self.env_state.log_history.append(log_message)
         try: 
@@ -169,11 +253,3 @@ class Actions:
                 raise click_exception
             else:
                 raise e
-            
-    @staticmethod
-    def _is_unstable_element_exception(e):
-        e_lines = str(e).split('\n')
-        print(e_lines)
-        return (isinstance(e, playwright._impl._api_types.TimeoutError)
-                and "element is not stable - waiting..." in e_lines[-2] 
-                and "==============" in e_lines[-1])
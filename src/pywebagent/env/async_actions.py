@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import playwright
+from src.pywebagent.tracing import traced
+from src.pywebagent.env.actions import (
+    BaseActions,
+    EnvState,
+    HIGHLIGHT_DELAY,
+    SET_HIGHLIGHT_JS,
+    get_element_info,
+    get_marked_element_locators,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncActions(BaseActions):
+    """The actions of `Actions`, for pages of the async playwright api."""
+
+    @traced("actions.finish")
+    async def finish(self, success, output: dict, reason: str) -> None:
+        self._finish(success, output)
+
+    @traced("actions.act")
+    async def act(self, url, task, log_message, task_args=None, **kwargs) -> None:
+        self._start_sub_agent(url, log_message)
+
+        # The sub agent runs on the same event loop, other agents keep running while it works
+        from src.pywebagent.agent import act_async
+        # The arguments of the llm are always arguments of the task, never options of the run
+        result = await act_async(
+            url, task, num_history=0, browser=self.browser, browser_pool=self.pool,
+            task_args={**kwargs, **(task_args or {})},
+        )
+        return self._end_sub_agent(result)
+
+    async def _get_locator(self, item_id: int):
+        locator = self._locators.get(item_id)
+        if locator is None:
+            by_id, by_xpath = get_marked_element_locators(get_element_info(self.marked_elements, item_id))
+            locator = self._locators[item_id] = by_id if await by_id.count() else by_xpath
+        return locator
+
+    async def _set_highlight(self, item_id: int, color: str) -> None:
+        await self.marked_elements[item_id]['iframe'].evaluate(SET_HIGHLIGHT_JS, [item_id, color])
+
+    async def _visualized_interact(self, item_id: int, func: str, *args, **kwargs) -> None:
+        """Executes the given function on the element, marking its border with red first in highlight mode."""
+        locator = await self._get_locator(item_id)
+        if self.highlight:
+            await self._set_highlight(item_id, "red")
+            await asyncio.sleep(HIGHLIGHT_DELAY)
+
+        await getattr(locator, func)(*args, **kwargs)
+
+        if self.highlight:
+            await self._set_highlight(item_id, "green")
+
+    @traced("actions.click")
+    async def click(self, item_id: int, log_message: str, force=False) -> None:
+        """
+        Attempts to click an element identified by `item_id`.
+        Checks if a file chooser dialog opens as a result of the click, which is unexpected behavior.
+        If the element is not clickable and `force` is False, retries with force click.
+        """
+        if log_message:
+            self.env_state.log_history.append(log_message)
+        try:
+            inner_exception = None
+            async with self.page.expect_file_chooser(timeout=1200):
+                try:
+                    await self._visualized_interact(item_id, "click", timeout=5000, force=force, no_wait_after=True)
+                except Exception as e_click:
+                    inner_exception = e_click
+
+        except playwright._impl._api_types.TimeoutError:
+            if self._get_click_retry(inner_exception, force):
+                return await self.click(item_id, log_message="", force=True)
+            return
+        except Exception as e:
+            assert False, f"Unexpected exception raised: {e}"  # Unexpected exception outside the file chooser context.
+
+        raise Exception("filechooser event was triggered unexpectedly. Consider using upload_files() instead of click() for this element.")
+
+    @traced("actions.scroll")
+    async def scroll(self, direction: str, log_message: str) -> None:
+        self.env_state.log_history.append(log_message)
+        await self.page.evaluate(self._get_scroll_script(direction))
+
+    @traced("actions.combobox_select")
+    async def combobox_select(self, item_id: int, option: str, log_message: str) -> None:
+        self.env_state.log_history.append(log_message)
+        await self._visualized_interact(item_id, "select_option", option)
+
+    @traced("actions.input_text")
+    async def input_text(self, item_id: int, text: str, clear_before_input: bool, log_message: str):
+        self.env_state.log_history.append(log_message)
+        await self._visualized_interact(item_id, self._get_input_method(clear_before_input), text)
+
+    @traced("actions.upload_files")
+    async def upload_files(self, item_id: int, files: list, log_message: str) -> None:
+        self.env_state.log_history.append(log_message)
+        try:
+            async with self.page.expect_file_chooser(timeout=2000) as file_chooser_info:
+                successfully_clicked = False
+                click_exception = None
+                try:
+                    await self._visualized_interact(item_id, "click", timeout=1000, force=False)
+                    successfully_clicked = True
+                except Exception as e_click:
+                    click_exception = e_click
+                    if self._is_unstable_element_exception(e_click):
+                        try:
+                            await self._visualized_interact(item_id, "click", timeout=1000, force=True)
+                            successfully_clicked = True
+                        except Exception as e_click_force:
+                            click_exception = e_click_force
+                            raise e_click_force
+                    else:
+                        raise e_click
+
+            file_chooser = await file_chooser_info.value
+            await file_chooser.set_files(files)
+        except playwright._impl._api_types.TimeoutError as e:
+            if not successfully_clicked:
+                raise click_exception
+            else:
+                raise e
@@ -0,0 +1,245 @@
+import ast
+import asyncio
+import inspect
+import logging
+from typing import Any, Tuple, Dict
+from playwright.async_api import async_playwright
+from src.pywebagent.env.actions import EnvState, get_marked_element_locator
+from src.pywebagent.env.async_actions import AsyncActions
+from src.pywebagent.env.browser import BaseBrowserEnv, WebpageObservation, PlanStep, PLAN_CHECK_TIMEOUT
+from src.pywebagent.env.settle import PageSettler
+from src.pywebagent.env.pool import AsyncBrowserPool
+from src.pywebagent.image import ImagePipeline
+from src.pywebagent.tracing import count, span, traced
+
+logger = logging.getLogger(__name__)
+
+
+class _AwaitActions(ast.NodeTransformer):
+    """Awaits every `actions.<name>(...)` call, since the async actions are coroutines."""
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        func = node.func
+        if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id == "actions":
+            return ast.copy_location(ast.Await(value=node), node)
+        return node
+
+
+def compile_step_code(module: ast.Module):
+    """
+    Compiles code written for the sync `Actions` into code that evaluates to a coroutine. Line numbers
+    are those of the given code, so execution errors point at the same line as in the sync environment.
+    """
+    module = _AwaitActions().visit(module)
+    ast.fix_missing_locations(module)
+    return compile(module, "<string>", "exec", flags=ast.PyCF_ALLOW_TOP_LEVEL_AWAIT)
+
+
+class AsyncBrowserEnv(BaseBrowserEnv):
+    """
+    `BrowserEnv` on the async playwright api, with the same observations and steps.
+    Pass `browser` to share one Chromium process between many environments, each of them
+    then only creates its own context, or `pool` to lease contexts from a browser pool.
+    """
+
+    def __init__(
+        self,
+        headless: bool = True,
+        settler: PageSettler = None,
+        incremental_marking: bool = False,
+        browser=None,
+        pool: AsyncBrowserPool = None,
+        image_pipeline: ImagePipeline = None,
+        highlight_actions: bool = False,
+    ):
+        super().__init__(
+            settler=settler,
+            incremental_marking=incremental_marking,
+            image_pipeline=image_pipeline,
+            highlight_actions=highlight_actions,
+        )
+        self.headless = headless
+        self.browser = browser
+        self.pool = pool
+        self._owns_browser = browser is None and pool is None
+        self.context_manager = None
+        self.playwright = None
+        self.context = None
+
+    async def _launch(self):
+        self.context_manager = async_playwright()
+        self.playwright = await self.context_manager.__aenter__()
+        self.browser = await self.playwright.chromium.launch(
+            channel="chrome",
+            headless=self.headless,
+        )
+
+    @traced("env.step")
+    async def step(self, code, marked_elements: list = []) -> WebpageObservation:
+        actions = AsyncActions(
+            self.page, marked_elements, self.env_state, browser=self.browser, pool=self.pool, highlight=self.highlight_actions
+        )
+        context = {"actions": actions}
+        plan_step = None
+        try:
+            error_message = None
+            start_url = self.page.url
+            for index, plan_step in enumerate(self._get_plan(code, marked_elements)):
+                if index > 0:
+                    reason = await self._check_plan_step(start_url, plan_step)
+                    if reason is not None:
+                        error_message = self._plan_stopped_message(plan_step, reason)
+                        break
+                if plan_step.action is not None:
+                    result = plan_step.action.dispatch(actions)
+                else:
+                    result = eval(compile_step_code(plan_step.module), context, context)
+                if inspect.iscoroutine(result):
+                    await result
+        except Exception as e:
+            if plan_step is not None and plan_step.action is not None:
+                error_message = self._get_action_error_message(plan_step, e)
+            else:
+                error_message = self._get_execution_error_message(code if isinstance(code, str) else "", e)
+        finally:
+            await self._remove_elements_marks()
+
+        settle_time = await self._wait_for_settle()
+
+        # if a new page was opened, switch to it
+        if len(self.context.pages) > 1:
+            await self.page.close()
+            self.page = self.context.pages[-1]
+            settle_time += await self._wait_for_settle()
+
+        self.env_state.timeframe += 1
+        obs = await self.get_observation()
+        obs.settle_time = settle_time
+        obs.error_message = error_message
+        return obs
+
+    @traced("env.settle")
+    async def _wait_for_settle(self) -> float:
+        return self._log_settle_result(await self.settler.wait_async(self.page))
+
+    async def _check_plan_step(self, start_url: str, plan_step: PlanStep):
+        if self.page.url != start_url or len(self.context.pages) > 1:
+            return "the page changed"
+        element = plan_step.element
+        if element is None:
+            return None
+        try:
+            await get_marked_element_locator(element).wait_for(state="visible", timeout=PLAN_CHECK_TIMEOUT)
+        except Exception:
+            return f"element {element['id']} is no longer visible"
+        return None
+
+    async def _evaluate_in_frames(self, frames: list, script: str, args: list) -> list:
+        return await asyncio.gather(
+            *[frame.evaluate(script, arg) for frame, arg in zip(frames, args)],
+            return_exceptions=True,
+        )
+
+    @traced("env.mark_elements")
+    async def _mark_elements(self):
+        frames = self.page.frames
+        collected = await self._evaluate_in_frames(frames, self._mark_elements_js_script, self._mark_collect_args(frames))
+        frames_to_draw = self._frames_to_draw(frames, collected)
+        drawn = await self._evaluate_in_frames(
+            [frame for frame, _, _ in frames_to_draw],
+            self._mark_elements_js_script,
+            [{"phase": "draw", "offset": offset} for _, _, offset in frames_to_draw],
+        )
+        return self._stitch_marked_elements(frames, frames_to_draw, drawn)
+
+    @traced("env.remove_marks")
+    async def _remove_elements_marks(self):
+        frames = self.page.frames
+        results = await self._evaluate_in_frames(frames, self.remove_elements_marks_js_script, [None] * len(frames))
+        for frame, result in zip(frames, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Exception while running removal script in frame {frame.name}: {result}")
+                if "Target closed" in str(result):
+                    return
+
+    @traced("env.get_observation")
+    async def get_observation(self) -> WebpageObservation:
+        marked_elements = await self._mark_elements()
+        with span("env.screenshot"):
+            screenshot = await self.page.screenshot(**self.image_pipeline.screenshot_options())
+            count("screenshot_bytes", len(screenshot))
+
+        return WebpageObservation(
+            url=self.page.url,
+            error_message=None,
+            screenshot=screenshot,
+            marked_elements=marked_elements,
+            env_state=self.env_state,
+        )
+
+    @traced("env.reset")
+    async def reset(self, url, storage_state: dict = None, scroll: tuple = None) -> Tuple[WebpageObservation, Dict[str, Any]]:
+        await self._close_context()
+        context_options = dict(self._context_options(), storage_state=storage_state)
+        if self.pool is not None:
+            self.context = await self.pool.lease(**context_options)
+        else:
+            if self.browser is None:
+                await self._launch()
+            self.context = await self.browser.new_context(**context_options)
+        self.page = await self.context.new_page()
+        self.context.on("page", self.settler.attach)
+        self._marked_elements_cache = {}
+
+        #  Overrides the standard file picker function in the browser with a custom implementation
+        # for file selection. This allows filechooser events to be triggered from the python code.
+        await self.page.add_init_script(self.override_file_chooser_js_script)
+
+        self.settler.attach(self.page)
+
+        await self.page.goto(url)
+        logger.info("Waiting for page to load...")
+        settle_time = await self._wait_for_settle()
+        logger.info("Page loaded")
+        if scroll is not None:
+            await self.page.evaluate("([x, y]) => window.scrollTo(x, y)", list(scroll))
+        self.env_state = EnvState()
+        obs = await self.get_observation()
+        obs.settle_time = settle_time
+        return obs
+
+    async def fork(self) -> Tuple["AsyncBrowserEnv", WebpageObservation]:
+        """
+        A new environment on the same browser or pool, in a context with the cookies and local storage
+        of this one, at the same url and scroll position. State that is not stored, such as typed text
+        or the in-memory state of the page scripts, is not carried over.
+        """
+        storage_state = await self.context.storage_state()
+        scroll = await self.page.evaluate("() => [window.scrollX, window.scrollY]")
+        env = AsyncBrowserEnv(
+            headless=self.headless,
+            settler=self.settler,
+            browser=self.browser,
+            pool=self.pool,
+            image_pipeline=self.image_pipeline,
+            highlight_actions=self.highlight_actions,
+        )
+        obs = await env.reset(self.page.url, storage_state=storage_state, scroll=scroll)
+        return env, obs
+
+    async def _close_context(self):
+        if self.context is None:
+            return
+        if self.pool is not None:
+            await self.pool.release(self.context)
+        else:
+            await self.context.close()
+        self.context = None
+
+    async def close(self):
+        await self._close_context()
+        if self._owns_browser and self.browser is not None:
+            await self.browser.close()
+            await self.context_manager.__aexit__(None, None, None)
+            self.browser = None
@@ -1,15 +1,30 @@
 import os
+import re
+import ast
 from pathlib import Path
 import traceback
-import time
 import logging
 from dataclasses import dataclass
-from typing import Any, Tuple, Dict
+from typing import Any, Tuple, Dict, NamedTuple
 from playwright.sync_api import sync_playwright
-from src.pywebagent.env.actions import Actions, EnvState
+from src.pywebagent.env.actions import (
+    Actions,
+    EnvState,
+    ELEMENT_ACTIONS,
+    MARK_ID_ATTRIBUTE,
+    get_action_call,
+    get_marked_element_locator,
+)
+from src.pywebagent.env.action_schema import Action, actions_to_code
+from src.pywebagent.env.settle import PageSettler, DomQuietSettler
+from src.pywebagent.env.pool import BrowserPool
+from src.pywebagent.image import ImagePipeline
+from src.pywebagent.tracing import count, span, traced
 
 logger = logging.getLogger(__name__)
 
+PLAN_CHECK_TIMEOUT = 2000  # ms to wait for the target of the next action of a plan to show up
+
 JS_DIRECTORY = Path(os.path.dirname(os.path.realpath(__file__))) / "../js"
 
 
@@ -20,17 +35,36 @@ class WebpageObservation:
     screenshot: bytes
     marked_elements: Dict[str, Any]
     env_state: EnvState = None
+    settle_time: float = 0.0  # seconds spent waiting for the page to settle before this observation
 
 
-class BrowserEnv:
-    def __init__(self, headless: bool = True):
-        # headless = 'new' if headless else False TODO make this work
-        self.context_manager = sync_playwright()
-        self.playwright = self.context_manager.__enter__()
-        self.browser = self.playwright.chromium.launch(
-            channel="chrome",
-            headless=headless,
-        )
+class PlanStep(NamedTuple):
+    """Part of the executed code that ends with one action call, or one typed action."""
+    module: ast.Module
+    line: str  # the action call, for error messages
+    element: dict = None  # the marked element the action targets
+    action: Action = None  # the typed action, dispatched without executing code
+
+
+class BaseBrowserEnv:
+    """State and page-independent logic shared by the sync and the async browser environments."""
+
+    def __init__(
+        self,
+        settler: PageSettler = None,
+        incremental_marking: bool = False,
+        image_pipeline: ImagePipeline = None,
+        highlight_actions: bool = False,
+    ):
+        self.settler = settler or DomQuietSettler()
+        # Decides the capture format of the screenshots, and prepares them for the prompt
+        self.image_pipeline = image_pipeline or ImagePipeline()
+        # With incremental marking, the page only sends the elements that changed since the
+        # previous observation, the rest is taken from this cache (frame -> key -> element)
+        self.incremental_marking = incremental_marking
+        self._marked_elements_cache = {}
+        # Highlights the element of every action while it runs, for debugging and screen recordings
+        self.highlight_actions = highlight_actions
 
         with open(JS_DIRECTORY / "mark_borders.js", 'r') as file:
             self._mark_elements_js_script = file.read()
@@ -38,85 +72,286 @@ class BrowserEnv:
             self.remove_elements_marks_js_script = file.read()
         with open(JS_DIRECTORY / "override_file_chooser.js", 'r') as file:
             self.override_file_chooser_js_script = file.read()
-        
-    def step(self, code: str, marked_elements: list = []) -> WebpageObservation:
+
+    @staticmethod
+    def _context_options() -> dict:
+        geolocation = {"longitude": -122.417168, "latitude": 37.785834}  # USA
+        return dict(
+            viewport={"width": 1600, "height": 900},
+            storage_state=None,
+            geolocation=geolocation,
+            device_scale_factor=1,
+        )
+
+    @staticmethod
+    def _get_execution_error_message(code: str, e: Exception) -> str:
+        # Extract exception line number and rethrow it with it
+        _, _, exc_tb = traceback.sys.exc_info()
+        line_of_code = "N/A"
+        while exc_tb is not None:
+            frame = exc_tb.tb_frame
+            lineno = exc_tb.tb_lineno
+            if frame.f_code.co_name == "<module>" and frame.f_code.co_filename == "<string>":
+                line_of_code = code.split('\n')[lineno - 1].lstrip()
+                break
+            exc_tb = exc_tb.tb_next
+
+        error_message = f"Error in execution of script. At line: \"{line_of_code}\". Error: \"{e}\""
+        logger.warning(error_message)
+        return error_message
+
+    @staticmethod
+    def _split_plan(code: str, marked_elements: dict) -> list:
+        """
+        Splits the code into plan steps, each ending with a top level action call, so the actions of a
+        plan can be checked one by one. Raises before anything runs if an action targets an element
+        that is not marked, or if the plan finishes the task before its last action.
+        """
+        lines = code.split('\n')
+        steps = []
+        statements = []
+        for statement in ast.parse(code).body:
+            statements.append(statement)
+            call = get_action_call(statement)
+            if call is None:
+                continue
+            element = None
+            if call.func.attr in ELEMENT_ACTIONS and call.args and isinstance(call.args[0], ast.Constant):
+                element_id = call.args[0].value
+                if element_id not in marked_elements:
+                    raise Exception(f"Element with id {element_id} is not marked in the webpage.")
+                element = marked_elements[element_id]
+            if steps and get_action_call(steps[-1].module.body[-1]).func.attr == "finish":
+                raise Exception("actions.finish must be the last action of the code")
+            line = lines[statement.lineno - 1].strip()
+            steps.append(PlanStep(ast.Module(body=statements, type_ignores=[]), line, element))
+            statements = []
+        if statements:  # trailing statements without action
+            steps.append(PlanStep(ast.Module(body=statements, type_ignores=[]), lines[statements[0].lineno - 1].strip()))
+        return steps
+
+    @staticmethod
+    def _split_actions(actions: list, marked_elements: dict) -> list:
+        """`_split_plan` for a list of typed actions, with the same checks."""
+        steps = []
+        for action in actions:
+            element = None
+            element_id = getattr(action, "element_id", None)
+            if element_id is not None:
+                if element_id not in marked_elements:
+                    raise Exception(f"Element with id {element_id} is not marked in the webpage.")
+                element = marked_elements[element_id]
+            if steps and steps[-1].action.name == "finish":
+                raise Exception("finish must be the last action")
+            steps.append(PlanStep(None, action.to_code(), element, action))
+        return steps
+
+    def _get_plan(self, code, marked_elements: dict) -> list:
+        if isinstance(code, str):
+            logger.info(f"Executing code: {code}")
+            return self._split_plan(code, marked_elements)
+        logger.info(f"Executing actions: {actions_to_code(code)}")
+        return self._split_actions(code, marked_elements)
+
+    @staticmethod
+    def _get_action_error_message(plan_step: PlanStep, e: Exception) -> str:
+        error_message = f"Error in execution of action: \"{plan_step.line}\". Error: \"{e}\""
+        logger.warning(error_message)
+        return error_message
+
+    @staticmethod
+    def _plan_stopped_message(plan_step: PlanStep, reason: str) -> str:
+        error_message = f"Stopped before line: \"{plan_step.line}\", because {reason}. The actions before it were executed."
+        logger.warning(error_message)
+        return error_message
+
+    @staticmethod
+    def _log_settle_result(result) -> float:
+        if result.settled:
+            logger.info(f"Page settled after {result.elapsed:.2f}s")
+        else:
+            logger.warning(f"Page did not settle after {result.elapsed:.2f}s "
+                           f"({result.pending_requests} requests pending), observing anyway")
+        return result.elapsed
+
+    def _mark_collect_args(self, frames: list) -> list:
+        return [
+            {
+                "phase": "collect",
+                "incremental": self.incremental_marking,
+                "resend": frame not in self._marked_elements_cache,
+            }
+            for frame in frames
+        ]
+
+    def _frames_to_draw(self, frames: list, collected: list) -> list:
+        """Returns (frame, collected elements, id offset) for every frame with elements to mark."""
+        counter = 0
+        frames_to_draw = []
+        for frame, result in zip(frames, collected):
+            if isinstance(result, Exception):
+                logger.warning(f"Exception while running script in frame {frame.name or frame.url}: {result}")
+                self._marked_elements_cache.pop(frame, None)
+            elif result["elements"]:
+                frames_to_draw.append((frame, result, counter))
+                counter += len(result["elements"])
+        return frames_to_draw
+
+    def _stitch_marked_elements(self, frames: list, frames_to_draw: list, drawn: list) -> dict:
+        marked_elements = []
+        for (frame, result, offset), htmls in zip(frames_to_draw, drawn):
+            if isinstance(htmls, Exception):
+                logger.warning(f"Exception while marking elements in frame {frame.name or frame.url}: {htmls}")
+                self._marked_elements_cache.pop(frame, None)
+                continue
+            marked_elements.extend(self._build_frame_elements(frame, result, htmls, offset))
+
+        marked_elements = {element['id']: element for element in marked_elements}
+        for frame in set(self._marked_elements_cache) - set(frames):
+            del self._marked_elements_cache[frame]
+        return marked_elements
+
+    def _build_frame_elements(self, frame, collected: dict, htmls: list, offset: int) -> list:
+        """
+        Assigns the final ids to the elements marked in a frame. With incremental marking, the elements
+        the page reported as unchanged are completed from the previous observation of the frame.
+        """
+        cache = {} if collected["reset"] else self._marked_elements_cache.get(frame, {})
+        iframe_name = frame.name or frame.url  # Use the frame's name or URL as an identifier
+        elements = []
+        for index, (element, html) in enumerate(zip(collected["elements"], htmls)):
+            element_id = offset + index
+            if element.get("unchanged"):
+                cached = cache[element["key"]]
+                html = re.sub(r"item_id__\d+__", f"item_id__{element_id}__", cached["html"], count=1)
+                html = re.sub(rf'{MARK_ID_ATTRIBUTE}="\d+"', f'{MARK_ID_ATTRIBUTE}="{element_id}"', html, count=1)
+                element = dict(cached, rect=element["rect"])
+            element.update(id=element_id, html=html, iframe=frame, iframe_name=iframe_name)
+            elements.append(element)
+
+        if self.incremental_marking:
+            self._marked_elements_cache[frame] = {element["key"]: element for element in elements}
+            sent = sum(1 for element in collected["elements"] if not element.get("unchanged"))
+            logger.debug(f"Incremental marking received {sent}/{len(elements)} elements from frame {iframe_name}")
+        return elements
+
+
+class BrowserEnv(BaseBrowserEnv):
+    def __init__(
+        self,
+        headless: bool = True,
+        settler: PageSettler = None,
+        incremental_marking: bool = False,
+        browser=None,
+        pool: BrowserPool = None,
+        image_pipeline: ImagePipeline = None,
+        highlight_actions: bool = False,
+    ):
+        super().__init__(
+            settler=settler,
+            incremental_marking=incremental_marking,
+            image_pipeline=image_pipeline,
+            highlight_actions=highlight_actions,
+        )
+        # With a pool, contexts are leased from its warm browsers instead of launching a browser,
+        # with a `browser` of the same thread, contexts are created in it
+        self.pool = pool
+        self.context = None
+        self.context_manager = None
+        self.browser = browser
+        self._owns_browser = browser is None and pool is None
+        if self._owns_browser:
+            # headless = 'new' if headless else False TODO make this work
+            self.context_manager = sync_playwright()
+            self.playwright = self.context_manager.__enter__()
+            self.browser = self.playwright.chromium.launch(
+                channel="chrome",
+                headless=headless,
+            )
+
+    @traced("env.step")
+    def step(self, code, marked_elements: list = []) -> WebpageObservation:
+        """Executes `code`, python code calling `actions`, or a list of typed `Action`s dispatched directly."""
         #self.env_state.log_history = []  # Clear log history to have logs only for the current step
-        actions = Actions(self.page, marked_elements, self.env_state)
+        actions = Actions(
+            self.page, marked_elements, self.env_state, browser=self.browser, pool=self.pool, highlight=self.highlight_actions
+        )
         context = {"actions": actions}
+        plan_step = None
         try:
             error_message = None
-            logger.info(f"Executing code: {code}")
-            exec(code, context, context)
+            # Several actions run one by one, with a quick check of the page instead of an observation between them
+            start_url = self.page.url
+            for index, plan_step in enumerate(self._get_plan(code, marked_elements)):
+                if index > 0:
+                    reason = self._check_plan_step(start_url, plan_step)
+                    if reason is not None:
+                        error_message = self._plan_stopped_message(plan_step, reason)
+                        break
+                if plan_step.action is not None:
+                    plan_step.action.dispatch(actions)
+                else:
+                    exec(compile(plan_step.module, "<string>", "exec"), context, context)
         except Exception as e:
-            # Extract exception line number and rethrow it with it
-            _, _, exc_tb = traceback.sys.exc_info()
-            line_of_code = "N/A"
-            while exc_tb is not None:
-                frame = exc_tb.tb_frame
-                lineno = exc_tb.tb_lineno
-                if frame.f_code.co_name == "<module>" and frame.f_code.co_filename == "<string>":
-                    line_of_code = code.split('\n')[lineno - 1].lstrip()
-                    break
-                exc_tb = exc_tb.tb_next
-
-            error_message = f"Error in execution of script. At line: \"{line_of_code}\". Error: \"{e}\""
-            logger.warning(error_message)
+            if plan_step is not None and plan_step.action is not None:
+                error_message = self._get_action_error_message(plan_step, e)
+            else:
+                error_message = self._get_execution_error_message(code if isinstance(code, str) else "", e)
         finally:
             self._remove_elements_marks()
 
-        try:
-            self.page.wait_for_load_state("networkidle", timeout=5000)
-        except Exception as e:
-            logger.warning(f"Exception while waiting for load state: {e}")
-
-        self.env_state.timeframe += 1
-        time.sleep(2)
-        obs = self.get_observation()
+        settle_time = self._wait_for_settle()
 
         # if a new page was opened, switch to it
         if len(self.context.pages) > 1:
             self.page.close()
             self.page = self.context.pages[-1]
-            try:
-                self.page.wait_for_load_state("networkidle", timeout=5000)
-            except Exception as e:
-                logger.warning(f"Exception while waiting for load state: {e}")
-            obs = self.get_observation()
+            settle_time += self._wait_for_settle()
 
+        self.env_state.timeframe += 1
+        obs = self.get_observation()
+        obs.settle_time = settle_time
         obs.error_message = error_message
         return obs
+
+    @traced("env.settle")
+    def _wait_for_settle(self) -> float:
+        return self._log_settle_result(self.settler.wait(self.page))
+
+    def _check_plan_step(self, start_url: str, plan_step: PlanStep):
+        """Returns why the next action of a plan should not run, or None if it can."""
+        if self.page.url != start_url or len(self.context.pages) > 1:
+            return "the page changed"
+        element = plan_step.element
+        if element is None:
+            return None
+        try:
+            get_marked_element_locator(element).wait_for(state="visible", timeout=PLAN_CHECK_TIMEOUT)
+        except Exception:
+            return f"element {element['id']} is no longer visible"
+        return None
     
+    @traced("env.mark_elements")
     def _mark_elements(self):
-        def run_script_in_frame(frame, counter, iframe_name=None):
-            # Modify the script to start with the specific counter
-            modified_script = self._mark_elements_js_script.replace(
-                'let counter = 0;', f'let counter = {counter};')
-
+        # The frames are marked one after the other, so the ids offset of each frame is known
+        # before it is evaluated and the page collects and draws its marks in a single call
+        frames = self.page.frames
+        counter = 0
+        frames_to_draw, drawn = [], []
+        for frame, args in zip(frames, self._mark_collect_args(frames)):
             try:
-                elements = frame.evaluate(modified_script)
+                result = frame.evaluate(self._mark_elements_js_script, dict(args, phase="mark", offset=counter))
             except Exception as e:
-                # log exception
-                logger.warning(f"Exception while running script in frame {iframe_name}: {e}")
-                elements = []
-
-            # Add iframe origin information to each element
-            for element in elements:
-                element['iframe'] = frame
-                element['iframe_name'] = iframe_name
-
-            return elements
-
-        counter = 0
-        marked_elements = []
-        for frame in self.page.frames:
-            iframe_name = frame.name or frame.url  # Use the frame's name or URL as an identifier
-            marked_elements_iframe = run_script_in_frame(frame, counter, iframe_name=iframe_name)
-            marked_elements.extend(marked_elements_iframe)
-            counter += len(marked_elements_iframe)
+                logger.warning(f"Exception while running script in frame {frame.name or frame.url}: {e}")
+                self._marked_elements_cache.pop(frame, None)
+                continue
+            if result["elements"]:
+                frames_to_draw.append((frame, result, counter))
+                drawn.append(result["htmls"])
+                counter += len(result["elements"])
+        return self._stitch_marked_elements(frames, frames_to_draw, drawn)
 
-        marked_elements = {element['id']: element for element in marked_elements}
-        return marked_elements
-    
+    @traced("env.remove_marks")
     def _remove_elements_marks(self):
         for frame in self.page.frames:
             try:
@@ -124,11 +359,14 @@ class BrowserEnv:
             except Exception as e:
                 logger.warning(f"Exception while running removal script in frame {frame.name}: {e}")
                 if "Target closed" in str(e):
-                    return 
-    
+                    return
+
+    @traced("env.get_observation")
     def get_observation(self) -> WebpageObservation:
         marked_elements = self._mark_elements()
-        screenshot = self.page.screenshot()
+        with span("env.screenshot"):
+            screenshot = self.page.screenshot(**self.image_pipeline.screenshot_options())
+            count("screenshot_bytes", len(screenshot))
 
         return WebpageObservation(
             url=self.page.url,
@@ -138,32 +376,45 @@ class BrowserEnv:
             env_state = self.env_state,
         )
         
+    @traced("env.reset")
     def reset(self, url) -> Tuple[WebpageObservation, Dict[str, Any]]:
-        geolocation = {"longitude": -122.417168, "latitude": 37.785834}  # USA
-        self.context = self.browser.new_context(
-            viewport={"width": 1600, "height": 900},
-            storage_state=None,
-            geolocation=geolocation,
-            device_scale_factor=1,
-        )
+        self._close_context()
+        if self.pool is not None:
+            self.context = self.pool.lease(**self._context_options())
+        else:
+            self.context = self.browser.new_context(**self._context_options())
         self.page = self.context.new_page()
+        self.context.on("page", self.settler.attach)
+        self._marked_elements_cache = {}
 
         #  Overrides the standard file picker function in the browser with a custom implementation 
         # for file selection. This allows filechooser events to be triggered from the python code.
         self.page.add_init_script(self.override_file_chooser_js_script)
 
+        self.settler.attach(self.page)
+
         self.page.goto(url)
         logger.info("Waiting for page to load...")
-        try:
-            self.page.wait_for_load_state("networkidle")
-        except Exception as e:
-            logger.warning(f"Exception while waiting for load state: {e}")
-            # try to wait for "load" state, sometimes the page is stuck with network traffic loading
-            self.page.wait_for_load_state("load")
+        settle_time = self._wait_for_settle()
         logger.info("Page loaded")
         self.env_state = EnvState()
-        return self.get_observation()
+        obs = self.get_observation()
+        obs.settle_time = settle_time
+        return obs
+
+    def _close_context(self):
+        if self.context is None:
+            return
+        if self.pool is not None:
+            self.pool.release(self.context)
+        else:
+            self.context.close()
+        self.context = None
 
     def close(self):
-        self.context_manager.__exit__()
-        self.browser.close()
+        self._close_context()
+        if self._owns_browser and self.browser is not None:
+            self.browser.close()
+            self.context_manager.__exit__(None, None, None)
+            self.browser = None
+
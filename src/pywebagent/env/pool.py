@@ -0,0 +1,279 @@
+import asyncio
+import logging
+import threading
+import weakref
+from contextlib import contextmanager, asynccontextmanager
+from playwright.sync_api import sync_playwright
+from playwright.async_api import async_playwright
+
+logger = logging.getLogger(__name__)
+
+
+class BrowserPoolExhausted(Exception):
+    pass
+
+
+class _PooledBrowser:
+    def __init__(self, browser) -> None:
+        self.browser = browser
+        self.contexts = set()
+        self.uses = 0  # number of contexts served so far
+        self.retired = False
+
+
+class BaseBrowserPool:
+    """
+    Bookkeeping shared by the sync and async pools: a fixed number of warm browsers, each serving
+    up to `max_contexts_per_browser` leased contexts at once. A browser is recycled once it served
+    `max_uses_per_browser` contexts, or when it is found disconnected.
+    """
+
+    def __init__(
+        self,
+        size: int = 1,
+        max_contexts_per_browser: int = 8,
+        max_uses_per_browser: int = 100,
+        headless: bool = True,
+        **launch_options,
+    ) -> None:
+        self.size = size
+        self.max_contexts_per_browser = max_contexts_per_browser
+        self.max_uses_per_browser = max_uses_per_browser
+        self.launch_options = {"channel": "chrome", "headless": headless, **launch_options}
+        self._browsers = []
+        self._owner = {}  # context -> _PooledBrowser
+        self._closed = False
+
+    @property
+    def active_contexts(self) -> int:
+        return len(self._owner)
+
+    def _browsers_to_close(self) -> list:
+        """Drops unhealthy browsers, and retired browsers that no longer serve any context."""
+        to_close = []
+        for pooled in list(self._browsers):
+            if not pooled.browser.is_connected():
+                logger.warning("Browser of the pool disconnected, replacing it")
+                pooled.retired = True
+                for context in pooled.contexts:
+                    self._owner.pop(context, None)
+                pooled.contexts.clear()
+            if pooled.retired and not pooled.contexts:
+                self._browsers.remove(pooled)
+                to_close.append(pooled)
+        return to_close
+
+    def _missing_browsers(self) -> int:
+        return self.size - sum(1 for pooled in self._browsers if not pooled.retired)
+
+    def _pick(self):
+        """Returns the least loaded browser that can serve another context, or None."""
+        candidates = [
+            pooled for pooled in self._browsers
+            if not pooled.retired and len(pooled.contexts) < self.max_contexts_per_browser
+        ]
+        return min(candidates, key=lambda pooled: len(pooled.contexts), default=None)
+
+    def _register(self, pooled: _PooledBrowser, context) -> None:
+        pooled.contexts.add(context)
+        pooled.uses += 1
+        if pooled.uses >= self.max_uses_per_browser:
+            pooled.retired = True
+        self._owner[context] = pooled
+
+    def _unregister(self, context) -> None:
+        pooled = self._owner.pop(context, None)
+        if pooled is not None:
+            pooled.contexts.discard(context)
+
+
+class BrowserPool(BaseBrowserPool):
+    """
+    Pool of browsers for the sync playwright api. Like the sync api itself, a pool must be used
+    from the thread that created it. Leasing never blocks, it raises `BrowserPoolExhausted` when
+    every browser already serves `max_contexts_per_browser` contexts.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.context_manager = None
+        self.playwright = None
+
+    def _start(self):
+        if self.playwright is None:
+            self.context_manager = sync_playwright()
+            self.playwright = self.context_manager.__enter__()
+
+    def _maintain(self):
+        for pooled in self._browsers_to_close():
+            try:
+                pooled.browser.close()
+            except Exception as e:
+                logger.warning(f"Exception while closing a browser of the pool: {e}")
+        for _ in range(self._missing_browsers()):
+            self._browsers.append(_PooledBrowser(self.playwright.chromium.launch(**self.launch_options)))
+
+    def lease(self, **context_options):
+        """Returns a new isolated context, on one of the warm browsers. Return it with `release`."""
+        if self._closed:
+            raise Exception("Browser pool is closed")
+        self._start()
+        self._maintain()
+        pooled = self._pick()
+        if pooled is None:
+            raise BrowserPoolExhausted(f"All {self.size} browsers serve {self.max_contexts_per_browser} contexts")
+        context = pooled.browser.new_context(**context_options)
+        self._register(pooled, context)
+        return context
+
+    def release(self, context) -> None:
+        self._unregister(context)
+        try:
+            context.close()
+        except Exception as e:
+            logger.warning(f"Exception while closing a leased context: {e}")
+        if not self._closed:
+            self._maintain()
+
+    @contextmanager
+    def context(self, **context_options):
+        context = self.lease(**context_options)
+        try:
+            yield context
+        finally:
+            self.release(context)
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        for context in list(self._owner):
+            self.release(context)
+        for pooled in self._browsers:
+            try:
+                pooled.browser.close()
+            except Exception as e:
+                logger.warning(f"Exception while closing a browser of the pool: {e}")
+        self._browsers = []
+        if self.context_manager is not None:
+            self.context_manager.__exit__(None, None, None)
+            self.context_manager = self.playwright = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AsyncBrowserPool(BaseBrowserPool):
+    """Pool of browsers for the async playwright api. Leasing waits for a free slot when the pool is full."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.context_manager = None
+        self.playwright = None
+        self._condition = asyncio.Condition()
+
+    async def _maintain(self):
+        if self.playwright is None:
+            self.context_manager = async_playwright()
+            self.playwright = await self.context_manager.__aenter__()
+        for pooled in self._browsers_to_close():
+            try:
+                await pooled.browser.close()
+            except Exception as e:
+                logger.warning(f"Exception while closing a browser of the pool: {e}")
+        for _ in range(self._missing_browsers()):
+            self._browsers.append(_PooledBrowser(await self.playwright.chromium.launch(**self.launch_options)))
+
+    async def lease(self, **context_options):
+        async with self._condition:
+            while True:
+                if self._closed:
+                    raise Exception("Browser pool is closed")
+                await self._maintain()
+                pooled = self._pick()
+                if pooled is not None:
+                    break
+                await self._condition.wait()
+            context = await pooled.browser.new_context(**context_options)
+            self._register(pooled, context)
+            return context
+
+    async def release(self, context) -> None:
+        try:
+            await context.close()
+        except Exception as e:
+            logger.warning(f"Exception while closing a leased context: {e}")
+        async with self._condition:
+            self._unregister(context)
+            if not self._closed:
+                await self._maintain()
+            self._condition.notify_all()
+
+    @asynccontextmanager
+    async def context(self, **context_options):
+        context = await self.lease(**context_options)
+        try:
+            yield context
+        finally:
+            await self.release(context)
+
+    async def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        for context in list(self._owner):
+            await self.release(context)
+        for pooled in self._browsers:
+            try:
+                await pooled.browser.close()
+            except Exception as e:
+                logger.warning(f"Exception while closing a browser of the pool: {e}")
+        self._browsers = []
+        if self.context_manager is not None:
+            await self.context_manager.__aexit__(None, None, None)
+            self.context_manager = self.playwright = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+def _close_default_pools(pools: dict) -> None:
+    for pool in pools.values():
+        try:
+            pool.close()
+        except Exception as e:
+            logger.warning(f"Exception while closing a default browser pool: {e}")
+
+
+class _ThreadDefaultPools:
+    """
+    Default pools of a thread, per `headless` mode. They are closed when the thread ends and drops
+    its thread local holder, or at exit for the threads still running.
+    """
+
+    def __init__(self) -> None:
+        self.pools = {}
+        weakref.finalize(self, _close_default_pools, self.pools)
+
+
+_default_pools = threading.local()
+
+
+def get_default_browser_pool(headless: bool = False) -> BrowserPool:
+    """
+    Returns the pool `act` uses when none is given, one per thread since the sync api is thread bound,
+    and per `headless` mode.
+    """
+    if not hasattr(_default_pools, "holder"):
+        _default_pools.holder = _ThreadDefaultPools()
+    pools = _default_pools.holder.pools
+    pool = pools.get(headless)
+    if pool is None:
+        pool = pools[headless] = BrowserPool(headless=headless)
+    return pool
@@ -0,0 +1,185 @@
+import os
+import time
+import logging
+from abc import ABC, abstractmethod
+from pathlib import Path
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+JS_DIRECTORY = Path(os.path.dirname(os.path.realpath(__file__))) / "../js"
+
+# Requests of these types may stay open for the whole life of the page
+LONG_LIVED_RESOURCE_TYPES = {"websocket", "eventsource", "media", "manifest", "ping"}
+
+
+@dataclass
+class SettleResult:
+    elapsed: float  # seconds
+    settled: bool  # False if the timeout was reached before the page settled
+    pending_requests: int = 0
+
+
+def run_page_calls(page, calls):
+    """
+    Runs a generator of page calls on a page of the sync playwright api: every call it yields is made
+    on `page`, and its result sent back, or its exception thrown in. Returns what the generator returns.
+    """
+    try:
+        call = next(calls)
+        while True:
+            try:
+                result = call(page)
+            except Exception as e:
+                call = calls.throw(e)
+            else:
+                call = calls.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+
+async def run_page_calls_async(page, calls):
+    """Same as `run_page_calls`, for pages of the async playwright api."""
+    try:
+        call = next(calls)
+        while True:
+            try:
+                result = await call(page)
+            except Exception as e:
+                call = calls.throw(e)
+            else:
+                call = calls.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+
+class PageSettler(ABC):
+    """
+    Decides when a page is ready to be observed after an action.
+    Subclasses implement `wait` and `wait_async`, and may use `attach` to start tracking a newly opened page.
+    The settlers below write their logic once, as a generator of page calls, see `run_page_calls`.
+    """
+
+    def attach(self, page) -> None:
+        pass
+
+    @abstractmethod
+    def wait(self, page) -> SettleResult:
+        pass
+
+    @abstractmethod
+    async def wait_async(self, page) -> SettleResult:
+        """Same as `wait`, for pages of the async playwright api."""
+        pass
+
+
+class FixedDelaySettler(PageSettler):
+    """The original behaviour: wait for network idle and then sleep for a fixed delay."""
+
+    def __init__(self, networkidle_timeout: int = 5000, delay: float = 2) -> None:
+        self.networkidle_timeout = networkidle_timeout
+        self.delay = delay
+
+    def _settle(self):
+        start = time.monotonic()
+        settled = True
+        try:
+            yield lambda page: page.wait_for_load_state("networkidle", timeout=self.networkidle_timeout)
+        except Exception as e:
+            logger.warning(f"Exception while waiting for load state: {e}")
+            settled = False
+        try:
+            yield lambda page: page.wait_for_timeout(self.delay * 1000)
+        except Exception as e:
+            logger.warning(f"Exception while waiting for the delay: {e}")
+        return SettleResult(elapsed=time.monotonic() - start, settled=settled)
+
+    def wait(self, page) -> SettleResult:
+        return run_page_calls(page, self._settle())
+
+    async def wait_async(self, page) -> SettleResult:
+        return await run_page_calls_async(page, self._settle())
+
+
+class DomQuietSettler(PageSettler):
+    """
+    Returns as soon as the DOM stopped changing for a quiet window, the layout is stable
+    and no recent requests are still in flight. Requests older than `request_stale_ms`
+    (analytics beacons, long polling) and long lived request types are not waited for.
+    """
+
+    def __init__(
+        self,
+        quiet_ms: int = 300,
+        timeout_ms: int = 5000,
+        poll_ms: int = 50,
+        request_stale_ms: int = 2000,
+    ) -> None:
+        self.quiet_ms = quiet_ms
+        self.timeout_ms = timeout_ms
+        self.poll_ms = poll_ms
+        self.request_stale_ms = request_stale_ms
+        self._pending_requests = {}  # page -> {request: start time}
+
+        with open(JS_DIRECTORY / "wait_for_settle.js", 'r') as file:
+            self._wait_for_settle_js_script = file.read()
+
+    def attach(self, page) -> None:
+        if page in self._pending_requests:
+            return
+        pending = self._pending_requests[page] = {}
+
+        def on_request(request):
+            if request.resource_type not in LONG_LIVED_RESOURCE_TYPES:
+                pending[request] = time.monotonic()
+
+        def on_request_done(request):
+            pending.pop(request, None)
+
+        page.on("request", on_request)
+        page.on("requestfinished", on_request_done)
+        page.on("requestfailed", on_request_done)
+        page.on("close", lambda _: self._pending_requests.pop(page, None))
+
+    def _count_fresh_requests(self, page) -> int:
+        now = time.monotonic()
+        pending = self._pending_requests.get(page, {})
+        return sum(1 for started in pending.values() if (now - started) * 1000 < self.request_stale_ms)
+
+    def _settle_args(self, remaining_ms: float) -> dict:
+        return {"quietMs": self.quiet_ms, "timeoutMs": remaining_ms, "pollMs": self.poll_ms}
+
+    def _settle(self, page):
+        self.attach(page)
+        start = time.monotonic()
+        deadline = start + self.timeout_ms / 1000
+
+        settled = False
+        pending_requests = 0
+        while not settled:
+            remaining_ms = (deadline - time.monotonic()) * 1000
+            if remaining_ms <= 0:
+                break
+            settle_args = self._settle_args(remaining_ms)
+            try:
+                result = yield lambda page: page.evaluate(self._wait_for_settle_js_script, settle_args)
+            except Exception as e:
+                # Usually the execution context was destroyed by a navigation, wait for the new document
+                logger.info(f"Page changed while waiting for it to settle: {e}")
+                try:
+                    yield lambda page: page.wait_for_load_state("domcontentloaded", timeout=max(remaining_ms, 1))
+                except Exception as e:
+                    logger.warning(f"Exception while waiting for load state: {e}")
+                    break
+                continue
+
+            pending_requests = self._count_fresh_requests(page)
+            settled = result["settled"] and pending_requests == 0
+
+        return SettleResult(elapsed=time.monotonic() - start, settled=settled, pending_requests=pending_requests)
+
+    def wait(self, page) -> SettleResult:
+        return run_page_calls(page, self._settle(page))
+
+    async def wait_async(self, page) -> SettleResult:
+        return await run_page_calls_async(page, self._settle(page))
@@ -0,0 +1,216 @@
+import io
+import math
+import base64
+import logging
+from dataclasses import dataclass
+
+try:
+    from PIL import Image
+except ImportError:  # The screenshots are then sent as captured, in the capture format
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# How OpenAI models bill images: a low detail image is a fixed cost, a high detail one is fitted in
+# 2048x2048, scaled so its shortest side is at most 768px, and billed per 512px tile.
+TILE_SIZE = 512
+MAX_SIDE = 2048
+MAX_SHORT_SIDE = 768
+BASE_TOKENS = 85
+TOKENS_PER_TILE = 170
+
+MIME_TYPES = {"jpeg": "image/jpeg", "webp": "image/webp", "png": "image/png"}
+
+
+def get_provider_size(width: int, height: int) -> tuple:
+    """The size a high detail image is scaled to by the provider before it is split into tiles."""
+    scale = min(1, MAX_SIDE / max(width, height))
+    scale = min(scale, MAX_SHORT_SIDE / min(width * scale, height * scale))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def get_image_tokens(width: int, height: int, detail: str) -> int:
+    if detail == "low":
+        return BASE_TOKENS
+    width, height = get_provider_size(width, height)
+    return BASE_TOKENS + TOKENS_PER_TILE * math.ceil(width / TILE_SIZE) * math.ceil(height / TILE_SIZE)
+
+
+def get_image_size(data: bytes) -> tuple:
+    """Reads the size of a png or jpeg from its header, without decoding it."""
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return int.from_bytes(data[16:20], "big"), int.from_bytes(data[20:24], "big")
+    if data[:2] == b"\xff\xd8":
+        # Walk the jpeg segments up to the start of frame, which holds the size
+        index = 2
+        while index + 9 < len(data):
+            marker = data[index + 1]
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                return int.from_bytes(data[index + 7:index + 9], "big"), int.from_bytes(data[index + 5:index + 7], "big")
+            index += 2 + int.from_bytes(data[index + 2:index + 4], "big")
+    if Image is not None:
+        return Image.open(io.BytesIO(data)).size
+    raise ValueError("Unknown image format")
+
+
+@dataclass
+class ImageStats:
+    original_bytes: int
+    bytes: int
+    original_tokens: int
+    tokens: int
+
+    def __str__(self) -> str:
+        return (
+            f"{self.original_bytes / 1024:.0f}KB -> {self.bytes / 1024:.0f}KB, "
+            f"{self.original_tokens} -> {self.tokens} tokens"
+        )
+
+
+@dataclass
+class ProcessedImage:
+    data: bytes
+    mime_type: str
+    detail: str
+    width: int
+    height: int
+    stats: ImageStats
+
+    def to_content(self) -> dict:
+        """The image as an `image_url` content part of a chat message."""
+        base64_image = base64.b64encode(self.data).decode("utf-8")
+        return {
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:{self.mime_type};base64,{base64_image}",
+                "detail": self.detail,
+            },
+        }
+
+
+class ImagePipeline:
+    """
+    Prepares the screenshot of an observation for the vision prompt: downscales it to at most
+    `max_tiles` provider tiles, and encodes it as jpeg or webp. With `crop`, it is first cropped to the
+    region of the marked elements, which also hides unmarked content such as messages and prices. With `detail="auto"`, low detail is used when the image fits a single tile without shrinking
+    the element labels below `min_scale`, and high detail otherwise.
+    Without pillow, only the capture format and quality apply.
+    """
+
+    def __init__(
+        self,
+        format: str = "jpeg",
+        quality: int = 80,
+        detail: str = "auto",
+        max_tiles: int = 4,
+        min_scale: float = 0.6,
+        crop: bool = False,
+        crop_padding: int = 48,
+        min_crop_saving: float = 0.2,
+    ) -> None:
+        if format not in MIME_TYPES:
+            raise ValueError(f"Unsupported image format {format}")
+        if detail not in ("low", "high", "auto"):
+            raise ValueError("detail must be 'low', 'high' or 'auto'")
+        self.format = format
+        self.quality = quality
+        self.detail = detail
+        self.max_tiles = max_tiles
+        self.min_scale = min_scale
+        self.crop = crop
+        self.crop_padding = crop_padding
+        self.min_crop_saving = min_crop_saving
+
+    def screenshot_options(self) -> dict:
+        """Arguments of `page.screenshot`. The page encodes jpeg itself when pillow is not there to do it."""
+        if Image is None and self.format == "jpeg":
+            return {"type": "jpeg", "quality": self.quality}
+        return {"type": "png"}
+
+    def _get_crop_box(self, width: int, height: int, marked_elements: dict):
+        """Bounding box of the marked elements of the main frame, or None if cropping does not pay off."""
+        rects = []
+        for element in marked_elements.values():
+            rect = element.get("rect")
+            iframe = element.get("iframe")
+            if rect is None or (iframe is not None and iframe.parent_frame is not None):
+                return None  # The position of elements of child frames in the page is unknown
+            rects.append(rect)
+        if not rects:
+            return None
+
+        left = max(0, int(min(rect["x"] for rect in rects)) - self.crop_padding)
+        top = max(0, int(min(rect["y"] for rect in rects)) - self.crop_padding)
+        right = min(width, int(max(rect["x"] + rect["width"] for rect in rects)) + self.crop_padding)
+        bottom = min(height, int(max(rect["y"] + rect["height"] for rect in rects)) + self.crop_padding)
+        if right <= left or bottom <= top:
+            return None
+        if (right - left) * (bottom - top) > (1 - self.min_crop_saving) * width * height:
+            return None
+        return left, top, right, bottom
+
+    def _get_target_size(self, width: int, height: int) -> tuple:
+        """The largest size under the provider's own downscaling that fits in `max_tiles` tiles."""
+        target_width, target_height = get_provider_size(width, height)
+        scale = target_width / width
+        min_scale = min(self.min_scale, scale)
+        while math.ceil(target_width / TILE_SIZE) * math.ceil(target_height / TILE_SIZE) > self.max_tiles:
+            # Drop one column or one row of tiles, whichever keeps more of the resolution
+            columns, rows = math.ceil(target_width / TILE_SIZE), math.ceil(target_height / TILE_SIZE)
+            candidates = [(columns - 1) * TILE_SIZE / width, (rows - 1) * TILE_SIZE / height]
+            next_scale = max(candidate for candidate in candidates if candidate > 0)
+            if next_scale < min_scale:
+                break
+            scale = next_scale
+            target_width, target_height = max(1, math.floor(width * scale)), max(1, math.floor(height * scale))
+        return target_width, target_height
+
+    def _get_detail(self, width: int, height: int) -> str:
+        if self.detail != "auto":
+            return self.detail
+        return "low" if TILE_SIZE / max(width, height) >= self.min_scale else "high"
+
+    def process(self, screenshot: bytes, marked_elements: dict = None) -> ProcessedImage:
+        original_width, original_height = get_image_size(screenshot)
+        original_tokens = get_image_tokens(original_width, original_height, "high")
+
+        if Image is None:
+            mime_type = MIME_TYPES["jpeg"] if screenshot[:2] == b"\xff\xd8" else MIME_TYPES["png"]
+            detail = self._get_detail(original_width, original_height)
+            stats = ImageStats(
+                original_bytes=len(screenshot),
+                bytes=len(screenshot),
+                original_tokens=original_tokens,
+                tokens=get_image_tokens(original_width, original_height, detail),
+            )
+            return ProcessedImage(screenshot, mime_type, detail, original_width, original_height, stats)
+
+        image = Image.open(io.BytesIO(screenshot))
+        if self.crop and marked_elements:
+            crop_box = self._get_crop_box(image.width, image.height, marked_elements)
+            if crop_box is not None:
+                image = image.crop(crop_box)
+
+        detail = self._get_detail(image.width, image.height)
+        if detail == "low":
+            scale = min(1, TILE_SIZE / max(image.width, image.height))
+            target_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        else:
+            target_size = self._get_target_size(image.width, image.height)
+        if target_size != image.size:
+            image = image.resize(target_size, Image.LANCZOS)
+
+        output = io.BytesIO()
+        if self.format == "png":
+            image.save(output, format="PNG", optimize=True)
+        else:
+            image.convert("RGB").save(output, format=self.format.upper(), quality=self.quality)
+        data = output.getvalue()
+
+        stats = ImageStats(
+            original_bytes=len(screenshot),
+            bytes=len(data),
+            original_tokens=original_tokens,
+            tokens=get_image_tokens(image.width, image.height, detail),
+        )
+        return ProcessedImage(data, MIME_TYPES[self.format], detail, image.width, image.height, stats)
@@ -1,18 +1,43 @@
-(function() {
+(options) => {
+    // All layout reads (rects, computed styles, hit tests) happen before any DOM write,
+    // and every rect is read at most once per element, so marking never thrashes layout.
+    options = options || {};
+    const scrollX = window.scrollX;
+    const scrollY = window.scrollY;
+    const viewportWidth = document.documentElement.clientWidth;
+    const viewportHeight = document.documentElement.clientHeight;
+
+    const rectCache = new Map();
+    const styleCache = new Map();
+
     function getAdjustedBoundingClientRect(element) {
-        const rect = element.getBoundingClientRect();
-        return {
-            top: rect.top + window.scrollY,
-            left: rect.left + window.scrollX,
-            bottom: rect.bottom + window.scrollY,
-            right: rect.right + window.scrollX,
-            width: rect.width,
-            height: rect.height
-        };
+        let rect = rectCache.get(element);
+        if (rect === undefined) {
+            const clientRect = element.getBoundingClientRect();
+            rect = {
+                top: clientRect.top + scrollY,
+                left: clientRect.left + scrollX,
+                bottom: clientRect.bottom + scrollY,
+                right: clientRect.right + scrollX,
+                width: clientRect.width,
+                height: clientRect.height
+            };
+            rectCache.set(element, rect);
+        }
+        return rect;
+    }
+
+    function getComputedStyleCached(element) {
+        let style = styleCache.get(element);
+        if (style === undefined) {
+            style = window.getComputedStyle(element);
+            styleCache.set(element, style);
+        }
+        return style;
     }
 
     function getAdjustedElementFromPoint(x, y) {
-        return document.elementFromPoint(x - window.scrollX, y - window.scrollY);
+        return document.elementFromPoint(x - scrollX, y - scrollY);
     }
 
     function getXPathForElement(element) {
@@ -20,15 +45,15 @@
         if (element.tagName === 'BODY') {
             return '/html/body';
         }
-    
+
         // Initialize an array to store the path parts
         const paths = [];
-    
+
         // Iterate up the DOM tree
         for (; element && element.nodeType === Node.ELEMENT_NODE; element = element.parentNode) {
             let index = 0;
             let hasFollowingSibling = false;
-    
+
             // Iterate over previous siblings to calculate the index
             for (let sibling = element.previousSibling; sibling; sibling = sibling.previousSibling) {
                 if (sibling.nodeType === Node.DOCUMENT_TYPE_NODE) {
@@ -38,244 +63,468 @@
                     index++;
                 }
             }
-    
+
             // Check for following siblings with the same tag name
             for (let sibling = element.nextSibling; sibling && !hasFollowingSibling; sibling = sibling.nextSibling) {
                 if (sibling.nodeName === element.nodeName) {
                     hasFollowingSibling = true;
                 }
             }
-    
+
             // Build the XPath part for this element
             const tagName = element.nodeName.toLowerCase();
             const pathIndex = (index || hasFollowingSibling) ? `[${index + 1}]` : '';
             paths.splice(0, 0, tagName + pathIndex);
         }
-    
+
         return paths.length ? '/' + paths.join('/') : null;
-    }    
-
-  function createLabel(rect, id) {
-      const label = document.createElement('div');
-      let labelLeft = rect.left - 16; // Your original calculation
-      if (labelLeft < 0) {
-          labelLeft = 0;
-      }
-  
-      Object.assign(label.style, {
-          position: 'absolute',
-          color: 'white',
-          backgroundColor: 'green',
-          fontSize: '15.5px',
-          padding: '2px 4px',
-          zIndex: '10000',
-          pointerEvents: 'none',
-          top: `${rect.top + 2}px`, // rect.top < 20 ? `${rect.bottom + 2}px` : `${rect.top - 16}px`,
-          left: `${labelLeft}px`,
-          opacity: '0.8',
-          //fontWeight: 'bold', // Makes the text bold
-        //   border: '2px solid red', // Red border
-        //   textShadow: ' -1px -1px 0 black, 1px -1px 0 black, -1px 1px 0 black, 1px 1px 0 black' // Red border effect around text
-
-      });
-      label.id = `item_id_label__${id}`;
-      label.textContent = id.toString();
-      document.body.appendChild(label);
-  }
-
-  function getIntersectionRect(rect, rect2) {
-    const intersectionRect = {
-        top: Math.max(rect.top, rect2.top),
-        left: Math.max(rect.left, rect2.left),
-        right: Math.min(rect.right, rect2.right),
-        bottom: Math.min(rect.bottom, rect2.bottom)
-    };
-    intersectionRect.width = intersectionRect.right - intersectionRect.left;
-    intersectionRect.height = intersectionRect.bottom - intersectionRect.top;
-    return intersectionRect;
-  }
-
-  // Checks if rects of one element is contained in another element
-  function isRectContainedInElement(element, element2) {
-    const rect = getAdjustedBoundingClientRect(element);
-    const rect2 = getAdjustedBoundingClientRect(element2);
-    const intersectionRect = getIntersectionRect(rect, rect2);
-    return (intersectionRect.width >= 0.9 * rect2.width 
-        && intersectionRect.height >= 0.9 * rect2.height);
-  }
-
-  function isPrioritisedElement(elem) {
-    return ['INPUT', 'SELECT', 'A', 'BUTTON', 'TEXTAREA'].includes(elem.tagName) || (elem.onclick !== null);
-  }
-
-  function createBorder(element, id) {
-      let rect = getAdjustedBoundingClientRect(element);
-      const topElement = getAdjustedElementFromPoint(rect.left, rect.top);
-      if (topElement) {
-        const rect2 = getAdjustedBoundingClientRect(topElement);
+    }
+
+    function createLabel(rect, id) {
+        const label = document.createElement('div');
+        let labelLeft = rect.left - 16;
+        if (labelLeft < 0) {
+            labelLeft = 0;
+        }
+
+        Object.assign(label.style, {
+            position: 'absolute',
+            color: 'white',
+            backgroundColor: 'green',
+            fontSize: '15.5px',
+            padding: '2px 4px',
+            zIndex: '10000',
+            pointerEvents: 'none',
+            top: `${rect.top + 2}px`,
+            left: `${labelLeft}px`,
+            opacity: '0.8',
+        });
+        label.id = `item_id_label__${id}`;
+        label.textContent = id.toString();
+        return label;
+    }
+
+    function getIntersectionRect(rect, rect2) {
+        const intersectionRect = {
+            top: Math.max(rect.top, rect2.top),
+            left: Math.max(rect.left, rect2.left),
+            right: Math.min(rect.right, rect2.right),
+            bottom: Math.min(rect.bottom, rect2.bottom)
+        };
+        intersectionRect.width = intersectionRect.right - intersectionRect.left;
+        intersectionRect.height = intersectionRect.bottom - intersectionRect.top;
+        return intersectionRect;
+    }
+
+    // Checks if rects of one element is contained in another element
+    function isRectContainedInRect(rect, rect2) {
         const intersectionRect = getIntersectionRect(rect, rect2);
-        // If intersection exists, use it
-        if (intersectionRect.width > 1 && intersectionRect.height > 1) {
-            rect = intersectionRect;
+        return (intersectionRect.width >= 0.9 * rect2.width
+            && intersectionRect.height >= 0.9 * rect2.height);
+    }
+
+    function isPrioritisedElement(elem) {
+        return ['INPUT', 'SELECT', 'A', 'BUTTON', 'TEXTAREA'].includes(elem.tagName) || (elem.onclick !== null);
+    }
+
+    // Only reads layout, the border itself is created by createBorder
+    function getBorderRect(element) {
+        let rect = getAdjustedBoundingClientRect(element);
+        const topElement = getAdjustedElementFromPoint(rect.left, rect.top);
+        if (topElement) {
+            const rect2 = getAdjustedBoundingClientRect(topElement);
+            const intersectionRect = getIntersectionRect(rect, rect2);
+            // If intersection exists, use it
+            if (intersectionRect.width > 1 && intersectionRect.height > 1) {
+                rect = intersectionRect;
+            }
         }
+        return rect;
+    }
+
+    function createBorder(rect, id) {
+        const border = document.createElement('div');
+        const eps = 2;
+        Object.assign(border.style, {
+            position: 'absolute',
+            border: '2px solid green',
+            width: `${rect.width + eps}px`,
+            height: `${rect.height + eps}px`,
+            left: `${rect.left - eps}px`,
+            top: `${rect.top - eps}px`,
+            zIndex: '9999',
+            pointerEvents: 'none'
+        });
+        border.id = `item_id_border__${id}`; // Assign a unique ID to the border
+        return border;
     }
-      const border = document.createElement('div');
-      const pos = rect;
-      const eps = 2;
-      Object.assign(border.style, {
-          position: 'absolute',
-          border: '2px solid green',
-          width: `${rect.width + eps}px`,
-          height: `${rect.height + eps}px`,
-          left: `${pos.left - eps}px`,
-          top: `${pos.top - eps}px`,
-          zIndex: '9999',
-          pointerEvents: 'none'
-      });
-      border.id = `item_id_border__${id}`; // Assign a unique ID to the border
-      document.body.appendChild(border);
-      createLabel(rect, id);
-  }
-
-  function isElementVisible(element) {
-      const style = window.getComputedStyle(element);
-      return !(style.display === 'none' || style.visibility === 'hidden' ||
-               element.offsetWidth === 0 || element.offsetHeight === 0 || 
-               element.getClientRects().length === 0);
-  }
-
-  function isElementMouseAccessible(element) {
-    const rect = getAdjustedBoundingClientRect(element);
-    if (rect.width < 2 || rect.height < 2) {
-      return false;
-    }
-
-    function AccessibleFromLoc(element, x, y) {
-        const topElement = getAdjustedElementFromPoint(x, y);
-        if (topElement === null) {
-            // console.log('topElement is null');
+
+    function isElementVisible(element) {
+        const style = getComputedStyleCached(element);
+        return !(style.display === 'none' || style.visibility === 'hidden' ||
+                 element.offsetWidth === 0 || element.offsetHeight === 0 ||
+                 element.getClientRects().length === 0);
+    }
+
+    function isElementMouseAccessible(element) {
+        const rect = getAdjustedBoundingClientRect(element);
+        if (rect.width < 2 || rect.height < 2) {
             return false;
         }
-        if (topElement !== element && !topElement.contains(element)) {
-            // console.log('topElement does not contain element', topElement, element);
-            return false;
+
+        function AccessibleFromLoc(element, x, y) {
+            const topElement = getAdjustedElementFromPoint(x, y);
+            if (topElement === null) {
+                return false;
+            }
+            if (topElement !== element && !topElement.contains(element)) {
+                return false;
+            }
+            return true;
         }
-        // if direct child of topElement, then accessible
-
-        return true;
-    }
-
-    return (AccessibleFromLoc(element, rect.left, rect.top) ) 
-        || AccessibleFromLoc(element, rect.right, rect.top) 
-        || AccessibleFromLoc(element, rect.left, rect.bottom) 
-        || AccessibleFromLoc(element, rect.right, rect.bottom) 
-        || AccessibleFromLoc(element, rect.left + rect.width / 2, rect.top + rect.height / 2);
-  }
-  
-  function isElementInViewport(element) {
-    const rect = getAdjustedBoundingClientRect(element);
-    return (rect.bottom < document.documentElement.clientHeight + window.scrollY 
-        && rect.right < document.documentElement.clientWidth + window.scrollX 
-        && rect.top >= window.scrollY 
-        && rect.left >= window.scrollX);
-  }
-
-  function isElementInteractable(element) {
-    const rect = getAdjustedBoundingClientRect(element);
-    cursor = window.getComputedStyle(element).cursor;
-
-    const centerX = rect.left;
-    const centerY = rect.top;
-    const topElement = getAdjustedElementFromPoint(centerX, centerY);
-    cursor_from_point = 'n/a'
-    if (topElement) {
-        cursor_from_point =  window.getComputedStyle(topElement).cursor;
-    }
-
-    // return (['pointer', 'hand', 'text'].includes(cursor) 
-    //     && ['pointer', 'auto', 'hand', 'text'].includes(cursor_from_point));
-    const hasOnClickHandler = !!element.onclick;
-    const isFocusable = element.tabIndex >= 0;
-    return (['pointer', 'hand', 'text'].includes(cursor)
-        && ['pointer', 'auto', 'hand', 'text'].includes(cursor_from_point)) ||
-        hasOnClickHandler || isFocusable;
-  }
-
-
-  function isMarkableElement(element) {
-    return (isElementInViewport(element) && isElementVisible(element) && isElementMouseAccessible(element) && isElementInteractable(element));
-  }
-
-  function findRelatedMarkedElement(element, markedElements) {
-    containing_element_index = markedElements.findIndex(e => e.contains(element));
-    intersecting_element_index = markedElements.findIndex(e => isRectContainedInElement(e, element));
-    element_index = markedElements.length;
-
-    if (containing_element_index !== -1) {
-        containing_element = markedElements[containing_element_index];
-        if ((isPrioritisedElement(element)) && !isPrioritisedElement(containing_element)) {
-            console.log("removing element by dom tree hirarchy", containing_element, "because of element", element);
-            return containing_element_index;
-        } else {
-            return element_index;
+
+        return AccessibleFromLoc(element, rect.left, rect.top)
+            || AccessibleFromLoc(element, rect.right, rect.top)
+            || AccessibleFromLoc(element, rect.left, rect.bottom)
+            || AccessibleFromLoc(element, rect.right, rect.bottom)
+            || AccessibleFromLoc(element, rect.left + rect.width / 2, rect.top + rect.height / 2);
+    }
+
+    function isElementInViewport(element) {
+        const rect = getAdjustedBoundingClientRect(element);
+        return (rect.bottom < viewportHeight + scrollY
+            && rect.right < viewportWidth + scrollX
+            && rect.top >= scrollY
+            && rect.left >= scrollX);
+    }
+
+    function isElementInteractable(element) {
+        const rect = getAdjustedBoundingClientRect(element);
+        const cursor = getComputedStyleCached(element).cursor;
+
+        const topElement = getAdjustedElementFromPoint(rect.left, rect.top);
+        let cursor_from_point = 'n/a';
+        if (topElement) {
+            cursor_from_point = getComputedStyleCached(topElement).cursor;
         }
-    } else if (intersecting_element_index !== -1) {
-        intersecting_element = markedElements[intersecting_element_index];
-        if ((isPrioritisedElement(element)) && !isPrioritisedElement(intersecting_element)) {
-            console.log("removing element by intersection", intersecting_element, "because of element", element);
-            return intersecting_element_index;
-        } else {
-            return element_index;
+
+        const hasOnClickHandler = !!element.onclick;
+        const isFocusable = element.tabIndex >= 0;
+        return (['pointer', 'hand', 'text'].includes(cursor)
+            && ['pointer', 'auto', 'hand', 'text'].includes(cursor_from_point)) ||
+            hasOnClickHandler || isFocusable;
+    }
+
+    function isMarkableElement(element) {
+        return (isElementInViewport(element) && isElementVisible(element) && isElementMouseAccessible(element) && isElementInteractable(element));
+    }
+
+    // Uniform grid over the page, every marked element is registered in the cells its rect
+    // overlaps, so looking for an intersecting marked element only visits nearby elements.
+    const GRID_CELL_SIZE = 256;
+    const grid = new Map();
+
+    function forEachCell(rect, callback) {
+        const firstColumn = Math.floor(rect.left / GRID_CELL_SIZE);
+        const lastColumn = Math.floor(rect.right / GRID_CELL_SIZE);
+        const firstRow = Math.floor(rect.top / GRID_CELL_SIZE);
+        const lastRow = Math.floor(rect.bottom / GRID_CELL_SIZE);
+        for (let column = firstColumn; column <= lastColumn; column++) {
+            for (let row = firstRow; row <= lastRow; row++) {
+                callback(`${column}:${row}`);
+            }
         }
     }
 
-    return -1;
-  }
+    // Marked elements, by insertion order. Removed entries are only flagged, so the
+    // order of the remaining ones is the order of the original array based implementation.
+    const markedEntries = [];
+    const markedEntryByElement = new Map();
 
-  // Main code - mark elements that can be interacted
-  const markedElements = [];
-  const allElements = document.querySelectorAll('body *');
-  allElements.forEach(element => {
-    if (isMarkableElement(element)) {
-        remove_elem_index = findRelatedMarkedElement(element, markedElements);
+    function addMarkedEntry(element) {
+        const entry = { element: element, rect: getAdjustedBoundingClientRect(element), order: markedEntries.length, removed: false };
+        markedEntries.push(entry);
+        markedEntryByElement.set(element, entry);
+        forEachCell(entry.rect, key => {
+            let cell = grid.get(key);
+            if (cell === undefined) {
+                cell = [];
+                grid.set(key, cell);
+            }
+            cell.push(entry);
+        });
+    }
+
+    function removeMarkedEntry(entry) {
+        entry.removed = true;
+        markedEntryByElement.delete(entry.element);
+    }
 
-        markedElements.push(element);
-        // Remove element because of containing / intersecting element that's already marked
-        if (remove_elem_index !== -1) {
-            markedElements.splice(remove_elem_index, 1);
+    // A marked element that contains this one must be one of its ancestors, since elements are
+    // visited in document order. At most one marked ancestor exists at any time.
+    function findContainingMarkedEntry(element) {
+        for (let node = element.parentElement; node; node = node.parentElement) {
+            const entry = markedEntryByElement.get(node);
+            if (entry !== undefined) {
+                return entry;
+            }
         }
+        return null;
+    }
 
+    function findIntersectingMarkedEntry(element) {
+        const rect = getAdjustedBoundingClientRect(element);
+        let found = null;
+        forEachCell(rect, key => {
+            const cell = grid.get(key);
+            if (cell === undefined) {
+                return;
+            }
+            for (const entry of cell) {
+                if (!entry.removed && (found === null || entry.order < found.order) && isRectContainedInRect(entry.rect, rect)) {
+                    found = entry;
+                }
+            }
+        });
+        return found;
+    }
+
+    // Returns the marked entry to remove because of the new element, the new element itself
+    // (it should not be marked), or null if the element is unrelated to any marked element.
+    function findRelatedMarkedEntry(element) {
+        const related = findContainingMarkedEntry(element) || findIntersectingMarkedEntry(element);
+        if (related === null) {
+            return null;
+        }
+        if (isPrioritisedElement(element) && !isPrioritisedElement(related.element)) {
+            return related;
+        }
+        return element;
     }
-  });
-
-  // Mark the elements
-  markedElementsMetadata = [];
-  let counter = 0;  // NOTE: changed from outside the script at browser.py
-  for (let i = 0; i < markedElements.length; i++) {
-    const element = markedElements[i];
-    let originalLabel = element.getAttribute('aria-label');
-    let newLabel = `item_id__${counter}__`;
-
-    if (originalLabel && originalLabel.includes('item_id__')) {
-        originalLabel = originalLabel.replace(/item_id__\d+__/, '').trim();
-    }
-
-    if (originalLabel) {
-        newLabel = `${originalLabel} ${newLabel}`;
-    }  
-    element.setAttribute('aria-label', newLabel); 
-    createBorder(element, counter);
-    markedElementsMetadata.push({
-        id: counter, 
-        tag: element.tagName, 
-        class: element.className, 
-        xpath: getXPathForElement(element),
-        html: element.outerHTML, // Adding the HTML of the element
-        element: element, // Store the actual element
-        old_aria_label: originalLabel
+
+    // Page side registry used by incremental marking. It gives every marked element a stable
+    // key, and records which subtrees changed since the previous observation.
+    function getIncrementalState() {
+        let state = window.__pywebagent;
+        if (state === undefined) {
+            state = window.__pywebagent = {
+                keys: new WeakMap(),
+                nextKey: 0,
+                dirtyRoots: new Set(),
+                fullPassNeeded: true,
+                markable: [],
+                sentKeys: new Set(),
+                viewport: null,
+                incrementalPasses: 0,
+            };
+            state.observer = new MutationObserver(records => {
+                for (const record of records) {
+                    let target = record.type === 'characterData' ? record.target.parentElement : record.target;
+                    if (target === document) {
+                        target = document.documentElement;
+                    }
+                    if (!target || (document.head && document.head.contains(target))) {
+                        continue;
+                    }
+                    // Changes to the root elements may move everything, e.g. change every xpath
+                    if (target === document.documentElement || target === document.body) {
+                        state.fullPassNeeded = true;
+                    }
+                    state.dirtyRoots.add(target);
+                }
+            });
+            state.observer.observe(document, { childList: true, subtree: true, attributes: true, characterData: true });
+        }
+        return state;
+    }
+
+    function getElementKey(state, element) {
+        let key = state.keys.get(element);
+        if (key === undefined) {
+            key = state.nextKey++;
+            state.keys.set(element, key);
+        }
+        return key;
+    }
+
+    function createDirtyCheck(state) {
+        const dirtyCache = new Map();
+        return function isInDirtySubtree(element) {
+            const visited = [];
+            let result = false;
+            for (let node = element; node; node = node.parentElement) {
+                if (dirtyCache.has(node)) {
+                    result = dirtyCache.get(node);
+                    break;
+                }
+                visited.push(node);
+                if (state.dirtyRoots.has(node)) {
+                    result = true;
+                    break;
+                }
+            }
+            visited.forEach(node => dirtyCache.set(node, result));
+            return result;
+        };
+    }
+
+    function sortInDocumentOrder(elements) {
+        return elements.sort((a, b) => (a.compareDocumentPosition(b) & Node.DOCUMENT_POSITION_FOLLOWING) ? -1 : 1);
+    }
+
+    // Elements that may be marked. An incremental pass only evaluates the changed subtrees,
+    // and re-checks the elements that were markable in the previous pass.
+    function findMarkableElements(state, isInDirtySubtree) {
+        if (state === null || state.fullPassNeeded) {
+            return Array.from(document.querySelectorAll('body *')).filter(isMarkableElement);
+        }
+
+        const candidates = new Set();
+        state.markable.forEach(element => {
+            if (element.isConnected && !isInDirtySubtree(element)) {
+                candidates.add(element);
+            }
+        });
+        state.dirtyRoots.forEach(root => {
+            if (!root.isConnected || (root.parentElement && isInDirtySubtree(root.parentElement))) {
+                return;  // Removed, or covered by a dirty ancestor
+            }
+            candidates.add(root);
+            root.querySelectorAll('*').forEach(element => candidates.add(element));
+        });
+        return sortInDocumentOrder(Array.from(candidates).filter(isMarkableElement));
+    }
+
+    // Second phase: write the marks found by the collect phase. Ids start at `offset`, which is
+    // only known once every frame of the page reported how many elements it marked.
+    function drawMarks(offset) {
+        const pending = window.__pywebagentPendingMarks;
+        delete window.__pywebagentPendingMarks;
+        if (pending === undefined) {
+            return [];
+        }
+
+        // The ids of the previous observation are superseded
+        document.querySelectorAll('[data-pywebagent-id]').forEach(element => element.removeAttribute('data-pywebagent-id'));
+
+        const htmls = [];
+        const marks = document.createDocumentFragment();
+        for (let i = 0; i < pending.elements.length; i++) {
+            const element = pending.elements[i];
+            const id = offset + i;
+            // Actions find the element by this id in a single lookup
+            element.setAttribute('data-pywebagent-id', id);
+            const originalLabel = pending.originalLabels[i];
+            let newLabel = `item_id__${id}__`;
+            if (originalLabel) {
+                newLabel = `${originalLabel} ${newLabel}`;
+            }
+            element.setAttribute('aria-label', newLabel);
+            marks.appendChild(createBorder(pending.borderRects[i], id));
+            marks.appendChild(createLabel(pending.borderRects[i], id));
+            // Unchanged elements are already known to python
+            htmls.push(pending.unchanged[i] ? null : element.outerHTML);
+        }
+        document.body.appendChild(marks);
+
+        // Forget the mutations caused by marking
+        if (window.__pywebagent !== undefined) {
+            window.__pywebagent.observer.takeRecords();
+        }
+        return htmls;
+    }
+
+    if (options.phase === 'draw') {
+        return drawMarks(options.offset || 0);
+    }
+
+    // First phase: find the elements to mark, only reading from the DOM
+    let state = null;
+    let registryReset = false;
+    if (options.incremental) {
+        registryReset = window.__pywebagent === undefined;
+        state = getIncrementalState();
+        if (options.resend) {
+            state.sentKeys.clear();
+        }
+        const viewport = `${scrollX},${scrollY},${viewportWidth},${viewportHeight}`;
+        if (state.viewport !== viewport || state.incrementalPasses >= (options.maxIncrementalPasses || 10)) {
+            state.fullPassNeeded = true;
+        }
+        state.viewport = viewport;
+    }
+    const isInDirtySubtree = state === null ? (element => true) : createDirtyCheck(state);
+
+    // Main code - mark elements that can be interacted
+    const markableElements = findMarkableElements(state, isInDirtySubtree);
+    markableElements.forEach(element => {
+        const related = findRelatedMarkedEntry(element);
+        // Skip the element, or remove the marked element it replaces
+        if (related === element) {
+            return;
+        }
+        if (related !== null) {
+            removeMarkedEntry(related);
+        }
+        addMarkedEntry(element);
     });
-    counter++;
-  }
+    const markedElements = markedEntries.filter(entry => !entry.removed).map(entry => entry.element);
+
+    const markedElementsMetadata = [];
+    const pending = { elements: markedElements, borderRects: [], originalLabels: [], unchanged: [] };
+    for (const element of markedElements) {
+        let originalLabel = element.getAttribute('aria-label');
+        if (originalLabel && originalLabel.includes('item_id__')) {
+            originalLabel = originalLabel.replace(/item_id__\d+__/, '').trim();
+        }
+        const borderRect = getBorderRect(element);
+        pending.borderRects.push(borderRect);
+        pending.originalLabels.push(originalLabel);
+
+        // Position in the viewport of the frame, where the element shows in the screenshot
+        const metadata = {
+            rect: {
+                x: borderRect.left - scrollX,
+                y: borderRect.top - scrollY,
+                width: borderRect.width,
+                height: borderRect.height
+            }
+        };
+        let unchanged = false;
+        if (state !== null) {
+            // Only elements that are new to python, or changed since they were sent, are sent in full
+            metadata.key = getElementKey(state, element);
+            unchanged = state.sentKeys.has(metadata.key) && !isInDirtySubtree(element);
+        }
+        pending.unchanged.push(unchanged);
+        if (unchanged) {
+            metadata.unchanged = true;
+        } else {
+            Object.assign(metadata, {
+                tag: element.tagName,
+                class: element.className,
+                xpath: getXPathForElement(element),
+                old_aria_label: originalLabel,
+                text: (element.textContent || '').replace(/\s+/g, ' ').trim().slice(0, 100)
+            });
+        }
+        markedElementsMetadata.push(metadata);
+    }
+    window.__pywebagentPendingMarks = pending;
 
-  return markedElementsMetadata;
-})();
\ No newline at end of file
+    if (state !== null) {
+        // Start tracking changes for the next observation
+        state.dirtyRoots.clear();
+        state.incrementalPasses = state.fullPassNeeded ? 0 : state.incrementalPasses + 1;
+        state.fullPassNeeded = false;
+        state.markable = markableElements;
+        state.sentKeys = new Set(markedElementsMetadata.map(metadata => metadata.key));
+    }
+
+    // Both phases in one call, when the caller already knows the offset of the frame
+    if (options.phase === 'mark') {
+        const htmls = drawMarks(options.offset || 0);
+        return { reset: registryReset, elements: markedElementsMetadata, htmls: htmls };
+    }
+    return { reset: registryReset, elements: markedElementsMetadata };
+}
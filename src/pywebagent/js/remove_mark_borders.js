@@ -12,4 +12,12 @@
             element.parentNode.removeChild(element);
         }
     });
+
+    // The ids of the marked elements are released with their marks
+    document.querySelectorAll('[data-pywebagent-id]').forEach(element => element.removeAttribute('data-pywebagent-id'));
+
+    // Removing the marks is not a change of the page for incremental marking
+    if (window.__pywebagent !== undefined) {
+        window.__pywebagent.observer.takeRecords();
+    }
   })();
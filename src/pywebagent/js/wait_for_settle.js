@@ -0,0 +1,45 @@
+async ({ quietMs, timeoutMs, pollMs }) => {
+    // Resolves once the DOM stopped changing for `quietMs` and the document layout
+    // (scroll size) stayed the same for that window, or once `timeoutMs` passed.
+    const start = performance.now();
+    let lastChange = start;
+    let mutations = 0;
+
+    const observer = new MutationObserver((records) => {
+        mutations += records.length;
+        lastChange = performance.now();
+    });
+    // Attribute changes are not observed on purpose, animated carousels and banners
+    // toggle styles forever. Structural changes show up in the layout signature anyway.
+    observer.observe(document, { childList: true, subtree: true, characterData: true });
+
+    function layoutSignature() {
+        const root = document.documentElement;
+        if (!root) {
+            return '';
+        }
+        return `${root.scrollWidth}x${root.scrollHeight}:${document.body ? document.body.childElementCount : 0}`;
+    }
+
+    let lastLayout = layoutSignature();
+
+    return await new Promise((resolve) => {
+        function check() {
+            const now = performance.now();
+            const layout = layoutSignature();
+            if (layout !== lastLayout) {
+                lastLayout = layout;
+                lastChange = now;
+            }
+
+            const settled = document.readyState !== 'loading' && now - lastChange >= quietMs;
+            if (settled || now - start >= timeoutMs) {
+                observer.disconnect();
+                resolve({ settled: settled, elapsed: now - start, mutations: mutations });
+                return;
+            }
+            setTimeout(check, pollMs);
+        }
+        check();
+    });
+}
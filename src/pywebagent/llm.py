@@ -1,58 +1,90 @@
-import requests
 import json
 from groq import Groq
 import os
+from src.pywebagent.llm_clients import get_client_registry
 
 
-def llama_405b(prompt: str, provider="baseten"):
-  if provider == "baseten":
-    s = requests.Session()
-    with s.post(
-        "https://model-7wlxp82w.api.baseten.co/production/predict",
-        headers={"Authorization": "Api-Key QLk2AhIS.ay5p1g5DPDeAcNqveNziEOmh2hW42b6Q"},
+def _baseten_stream(model_url: str, api_key: str, prompt: str):
+  """Yields the text of the completion as the model streams it."""
+  registry = get_client_registry()
+
+  def request():
+    response = registry.session("baseten").post(
+        model_url,
+        headers={"Authorization": f"Api-Key {api_key}"},
         data=json.dumps({
           "prompt": prompt,
           "stream": True,
           "max_tokens": 1024
         }),
-        stream=False,
-    ) as response:
-        return str(response.content)
+        stream=True,
+    )
+    if not response.ok:
+      response.close()
+      response.raise_for_status()
+    return response
+
+  with registry.limit("baseten"):
+    with registry.scheduler.call(model_url, request) as response:
+      response.encoding = response.encoding or "utf-8"
+      for chunk in response.iter_content(chunk_size=None, decode_unicode=True):
+        if chunk:
+          yield chunk
+
+
+def _baseten_predict(model_url: str, api_key: str, prompt: str, stream: bool):
+  chunks = _baseten_stream(model_url, api_key, prompt)
+  return chunks if stream else "".join(chunks)
+
+
+def llama_405b(prompt: str, provider="baseten", stream=False):
+  """Returns the completion, or an iterator over its text chunks if `stream` is True."""
+  if provider == "baseten":
+    return _baseten_predict(
+        "https://model-7wlxp82w.api.baseten.co/production/predict",
+        "QLk2AhIS.ay5p1g5DPDeAcNqveNziEOmh2hW42b6Q",
+        prompt,
+        stream,
+    )
   elif provider == "groq":
     raise ValueError("Not implemented")
   else:
      raise ValueError("Invalid provider")
   
-def llama_70b(prompt: str, provider="baseten"):
+def llama_70b(prompt: str, provider="baseten", stream=False):
+  """Returns the completion, or an iterator over its text chunks if `stream` is True."""
   if provider == "baseten":
-    s = requests.Session()
-    with s.post(
+    return _baseten_predict(
         "https://model-jwd78r4w.api.baseten.co/production/predict",
-        headers={"Authorization": "Api-Key vB3H7OSq.HCfqgTyxgyYKAp5palSauFwCV5UzAxSp"},
-        data=json.dumps({
-          "prompt": prompt,
-          "stream": True,
-          "max_tokens": 1024
-        }),
-        stream=False,
-    ) as resp:
-        resp.content
+        "vB3H7OSq.HCfqgTyxgyYKAp5palSauFwCV5UzAxSp",
+        prompt,
+        stream,
+    )
   elif provider == "groq":
-    client = Groq(
+    registry = get_client_registry()
+    client = registry.client("groq", lambda: Groq(
         api_key=os.environ.get("GROQ_API_KEY"),
-    )
+        http_client=registry.http_client(),
+        max_retries=0,  # retried by the scheduler
+    ))
 
-    chat_completion = client.chat.completions.create(
-        messages=[
-            {
-                "role": "user",
-                "content": prompt,
-            }
-        ],
-        model="llama-3.1-70b-versatile",
-    )
+    def request():
+      with registry.limit("groq"):
+        return client.chat.completions.create(
+            messages=[
+                {
+                    "role": "user",
+                    "content": prompt,
+                }
+            ],
+            model="llama-3.1-70b-versatile",
+            stream=stream,
+        )
+
+    chat_completion = registry.scheduler.call("llama-3.1-70b-versatile", request)
 
+    if stream:
+      return (chunk.choices[0].delta.content or "" for chunk in chat_completion)
     return chat_completion.choices[0].message.content
   else:
      raise ValueError("Invalid provider")
-  
\ No newline at end of file
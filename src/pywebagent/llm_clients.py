@@ -0,0 +1,214 @@
+import os
+import atexit
+import asyncio
+import logging
+import threading
+import importlib.util
+from contextlib import contextmanager, asynccontextmanager
+from weakref import WeakKeyDictionary
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from openai import OpenAI, AsyncOpenAI
+from langchain.chat_models import ChatOpenAI
+from src.pywebagent.ratelimit import RateLimitScheduler
+from src.pywebagent.prompt_cache import UsageObservingCompletions, AsyncUsageObservingCompletions
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of concurrent requests per provider, when not configured otherwise
+DEFAULT_CONCURRENCY = int(os.environ.get("PYWEBAGENT_LLM_CONCURRENCY", 8))
+
+
+class LLMClientRegistry:
+    """
+    Process wide LLM clients, so every agent loop reuses the same keep-alive connections instead of
+    paying for a TLS handshake per call. HTTP/2 is used when the optional `h2` package is installed.
+    Each provider also gets a concurrency limit, see `limit` and `async_limit`, and the rate limit
+    budgets reported by the responses are tracked by the `scheduler` which retries the calls.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 32,
+        max_keepalive_connections: int = 16,
+        keepalive_expiry: float = 60,
+        timeout: float = 120,
+        concurrency: dict = None,
+    ) -> None:
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = timeout
+        self.http2 = importlib.util.find_spec("h2") is not None
+        self.concurrency = concurrency or {}
+        self.scheduler = RateLimitScheduler()
+
+        self._lock = threading.RLock()
+        self._http_client = None
+        self._openai = None
+        self._chat_models = {}
+        self._sessions = {}
+        self._clients = {}
+        self._semaphores = {}
+        # Async clients and semaphores are bound to the event loop they are first used on
+        self._async_http_clients = WeakKeyDictionary()
+        self._async_openai = WeakKeyDictionary()
+        self._async_chat_models = WeakKeyDictionary()
+        self._async_semaphores = WeakKeyDictionary()
+
+    def _get_http_client(self) -> httpx.Client:
+        if self._http_client is None:
+            self._http_client = httpx.Client(
+                http2=self.http2,
+                limits=self.limits,
+                timeout=self.timeout,
+                event_hooks={"response": [self.scheduler.observe_response]},
+            )
+        return self._http_client
+
+    def http_client(self) -> httpx.Client:
+        with self._lock:
+            return self._get_http_client()
+
+    def async_http_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        client = self._async_http_clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(
+                http2=self.http2,
+                limits=self.limits,
+                timeout=self.timeout,
+                event_hooks={"response": [self.scheduler.aobserve_response]},
+            )
+            self._async_http_clients[loop] = client
+        return client
+
+    def openai(self) -> OpenAI:
+        with self._lock:
+            if self._openai is None:
+                # Retries are left to the scheduler, which shares the rate limit state between callers
+                self._openai = OpenAI(
+                    api_key=os.environ.get("OPENAI_API_KEY"),
+                    http_client=self._get_http_client(),
+                    max_retries=0,
+                )
+            return self._openai
+
+    def async_openai(self) -> AsyncOpenAI:
+        loop = asyncio.get_running_loop()
+        client = self._async_openai.get(loop)
+        if client is None:
+            client = AsyncOpenAI(
+                api_key=os.environ.get("OPENAI_API_KEY"),
+                http_client=self.async_http_client(),
+                max_retries=0,
+            )
+            self._async_openai[loop] = client
+        return client
+
+    def chat_model(self, **params) -> ChatOpenAI:
+        """
+        A langchain `ChatOpenAI` on the shared openai clients, cached by its parameters.
+        Inside an event loop the model also gets the async client of that loop.
+        """
+        key = tuple(sorted(params.items()))
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        models = self._chat_models if loop is None else self._async_chat_models.setdefault(loop, {})
+        model = models.get(key)
+        if model is None:
+            # langchain drops the usage of streamed completions, the wrappers report it to `record_usage`
+            clients = {"client": UsageObservingCompletions(self.openai().chat.completions)}
+            if loop is not None:
+                clients["async_client"] = AsyncUsageObservingCompletions(self.async_openai().chat.completions)
+            model = models[key] = ChatOpenAI(**params, **clients)
+        return model
+
+    def session(self, provider: str) -> requests.Session:
+        """A keep-alive `requests` session for providers called through plain http."""
+        with self._lock:
+            session = self._sessions.get(provider)
+            if session is None:
+                session = requests.Session()
+                pool_size = self.concurrency.get(provider, DEFAULT_CONCURRENCY)
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._sessions[provider] = session
+            return session
+
+    def client(self, key, factory):
+        """Returns the client cached under `key`, creating it with `factory` on first use."""
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self._clients[key] = factory()
+            return client
+
+    @contextmanager
+    def limit(self, provider: str):
+        with self._lock:
+            semaphore = self._semaphores.get(provider)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.concurrency.get(provider, DEFAULT_CONCURRENCY))
+                self._semaphores[provider] = semaphore
+        with semaphore:
+            yield
+
+    @asynccontextmanager
+    async def async_limit(self, provider: str):
+        semaphores = self._async_semaphores.setdefault(asyncio.get_running_loop(), {})
+        semaphore = semaphores.get(provider)
+        if semaphore is None:
+            semaphore = semaphores[provider] = asyncio.Semaphore(self.concurrency.get(provider, DEFAULT_CONCURRENCY))
+        async with semaphore:
+            yield
+
+    def close(self) -> None:
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+            for client in self._clients.values():
+                close = getattr(client, "close", None)
+                if callable(close):
+                    try:
+                        close()
+                    except Exception as e:
+                        logger.warning(f"Exception while closing LLM client: {e}")
+            self._clients.clear()
+            if self._http_client is not None:
+                self._http_client.close()
+                self._http_client = None
+            self._openai = None
+            self._chat_models.clear()
+
+    async def aclose(self) -> None:
+        """Closes the async clients of the running event loop, and all sync clients."""
+        loop = asyncio.get_running_loop()
+        self._async_openai.pop(loop, None)
+        self._async_chat_models.pop(loop, None)
+        client = self._async_http_clients.pop(loop, None)
+        if client is not None:
+            await client.aclose()
+        self.close()
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_client_registry() -> LLMClientRegistry:
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = LLMClientRegistry()
+            atexit.register(_registry.close)
+        return _registry
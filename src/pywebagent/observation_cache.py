@@ -0,0 +1,164 @@
+import io
+import json
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import NamedTuple
+
+try:
+    from PIL import Image
+except ImportError:  # Screenshots are then only equal when their bytes are
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("off", "text_only", "reuse")
+
+
+def get_perceptual_hash(screenshot: bytes, hash_size: int = 8) -> int:
+    """
+    Difference hash of a screenshot: one bit per pair of horizontally adjacent pixels of a
+    `hash_size` grayscale thumbnail. Near identical screenshots have hashes a few bits apart.
+    """
+    if Image is None:
+        return int.from_bytes(hashlib.sha1(screenshot).digest()[:8], "big")
+    image = Image.open(io.BytesIO(screenshot)).convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = list(image.getdata())
+    bits = 0
+    for row in range(hash_size):
+        for column in range(hash_size):
+            left = pixels[row * (hash_size + 1) + column]
+            right = pixels[row * (hash_size + 1) + column + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+def get_hash_distance(hash1: int, hash2: int) -> int:
+    if Image is None:
+        return 0 if hash1 == hash2 else 64
+    return bin(hash1 ^ hash2).count("1")
+
+
+def get_dom_signature(marked_elements: dict) -> str:
+    """Digest of the tags and xpaths of the marked elements, in id order."""
+    digest = hashlib.sha1()
+    for element_id in sorted(marked_elements):
+        element = marked_elements[element_id]
+        digest.update(f"{element['tag']}|{element['xpath']}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ObservationFingerprint(NamedTuple):
+    task: str
+    url: str
+    dom_signature: str
+    error_message: str
+    perceptual_hash: int
+
+    @property
+    def key(self) -> tuple:
+        return self.task, self.url, self.dom_signature, self.error_message
+
+
+class CacheLookup(NamedTuple):
+    fingerprint: ObservationFingerprint
+    visual_change: bool  # False if the page looks the same as in the previous observation of the task
+    code: str = None  # a previous decision to reuse, instead of calling the llm
+
+
+class ObservationCache:
+    """
+    Remembers the observations an agent decided on, to avoid sending the llm a page it already saw.
+    Observations match when the task, url, marked elements and error are the same, and the screenshots
+    are at most `max_distance` bits of perceptual hash apart. Policies:
+    - "text_only": an observation that looks like the previous one is sent without its screenshot,
+      with a note that the last action changed nothing visible. Url and marked elements must match too.
+    - "reuse": additionally, the code decided for a matching observation is executed again without
+      calling the llm, unless that same code was just executed and changed nothing, and at most
+      `max_reuse_streak` times in a row.
+    - "off": every observation is sent in full.
+    """
+
+    def __init__(
+        self,
+        policy: str = "text_only",
+        max_distance: int = 4,
+        max_entries: int = 256,
+        max_text_only_streak: int = 1,
+        max_reuse_streak: int = 3,
+    ) -> None:
+        if policy not in POLICIES:
+            raise ValueError(f"policy must be one of {POLICIES}")
+        self.policy = policy
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.max_text_only_streak = max_text_only_streak
+        self.max_reuse_streak = max_reuse_streak
+        self._entries = OrderedDict()  # fingerprint key -> [(perceptual hash, code)]
+        self._last = {}  # task -> (fingerprint, code) of the last decision
+        self._text_only_streaks = {}  # task -> number of consecutive observations sent without screenshot
+        self._reuse_streaks = {}  # task -> number of consecutive steps decided by the cache
+        self.hits = 0
+        self.text_only = 0
+
+    @staticmethod
+    def _get_task_key(task) -> str:
+        return f"{task.task}\n{json.dumps(task.args, sort_keys=True, default=str)}"
+
+    def _looks_the_same(self, fingerprint: ObservationFingerprint, other: ObservationFingerprint) -> bool:
+        return (
+            (fingerprint.url, fingerprint.dom_signature) == (other.url, other.dom_signature)
+            and get_hash_distance(fingerprint.perceptual_hash, other.perceptual_hash) <= self.max_distance
+        )
+
+    def lookup(self, task, observation) -> CacheLookup:
+        if self.policy == "off":
+            return CacheLookup(None, visual_change=True)
+
+        fingerprint = ObservationFingerprint(
+            task=self._get_task_key(task),
+            url=observation.url,
+            dom_signature=get_dom_signature(observation.marked_elements),
+            error_message=observation.error_message,
+            perceptual_hash=get_perceptual_hash(observation.screenshot),
+        )
+        last_fingerprint, last_code = self._last.get(fingerprint.task, (None, None))
+        unchanged = last_fingerprint is not None and self._looks_the_same(fingerprint, last_fingerprint)
+        # The llm does not see past screenshots, so it gets a new one after `max_text_only_streak` blind steps
+        streak = self._text_only_streaks.get(fingerprint.task, 0)
+        visual_change = not unchanged or streak >= self.max_text_only_streak
+        self._text_only_streaks[fingerprint.task] = 0 if visual_change else streak + 1
+        if not visual_change:
+            self.text_only += 1
+
+        if self.policy == "reuse" and self._reuse_streaks.get(fingerprint.task, 0) < self.max_reuse_streak:
+            for perceptual_hash, code in self._entries.get(fingerprint.key, []):
+                if get_hash_distance(fingerprint.perceptual_hash, perceptual_hash) > self.max_distance:
+                    continue
+                if unchanged and code == last_code:
+                    break  # This code is what left the page unchanged, ask the llm instead
+                self.hits += 1
+                self._entries.move_to_end(fingerprint.key)
+                return CacheLookup(fingerprint, visual_change, code)
+
+        return CacheLookup(fingerprint, visual_change)
+
+    def record_hit(self, fingerprint: ObservationFingerprint, code: str) -> None:
+        """Records that the code of a previous decision is executed again for the observation of `fingerprint`."""
+        self._last[fingerprint.task] = (fingerprint, code)
+        self._reuse_streaks[fingerprint.task] = self._reuse_streaks.get(fingerprint.task, 0) + 1
+
+    def store(self, fingerprint: ObservationFingerprint, code: str) -> None:
+        """Records the code decided by the llm for the observation of `fingerprint`."""
+        if fingerprint is None:
+            return
+        self._last[fingerprint.task] = (fingerprint, code)
+        self._reuse_streaks[fingerprint.task] = 0
+        if self.policy != "reuse":
+            return
+        entries = self._entries.setdefault(fingerprint.key, [])
+        entries.insert(0, (fingerprint.perceptual_hash, code))
+        del entries[4:]  # a few screenshots variants per page state are enough
+        self._entries.move_to_end(fingerprint.key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
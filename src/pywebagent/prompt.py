@@ -0,0 +1,230 @@
+import re
+import json
+import logging
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:  # Tokens are then estimated from the length of the text
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+CHARS_PER_TOKEN = 4
+ENCODING_NAME = "o200k_base"  # gpt-4o
+# Elements the llm acts on most, kept before the others when the element list is cut
+PRIORITY_TAGS = {"input": 3, "textarea": 3, "select": 3, "button": 2, "a": 1}
+_WORD_PATTERN = re.compile(r"[a-z0-9]{3,}")
+
+
+@lru_cache(maxsize=None)
+def _get_encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding(ENCODING_NAME)
+    except Exception as e:  # e.g. the encoding cannot be downloaded
+        logger.warning(f"Failed to load the {ENCODING_NAME} encoding, estimating tokens from text length: {e}")
+        return None
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate(text: str, max_tokens: int) -> str:
+    """Cuts `text` to about `max_tokens`, marking the cut."""
+    if text is None or estimate_tokens(text) <= max_tokens:
+        return text
+    return text[:max(max_tokens, 1) * CHARS_PER_TOKEN].rstrip() + " [...]"
+
+
+def _get_words(text: str) -> set:
+    return set(_WORD_PATTERN.findall(text.lower()))
+
+
+@lru_cache(maxsize=256)
+def _get_static_prefix(system_prompt: str, task: str, args_json: str) -> str:
+    return f"""{system_prompt}
+    Task:
+    {task}
+
+    Task Arguments:
+    {args_json}
+    """
+
+
+def get_static_prefix(system_prompt: str, task) -> str:
+    """
+    The system prompt followed by the task and its arguments. It is the same on every step of a run,
+    and on every run of the same task, so it is built once and providers can cache it as a prefix.
+    """
+    return _get_static_prefix(system_prompt, task.task, json.dumps(task.args, sort_keys=True, default=str))
+
+
+class HistoryDigest:
+    """
+    Rolling digest of the log entries older than the recent ones sent verbatim. Entries are folded in
+    as they age, shortened, with repeats collapsed, and the oldest lines are dropped once the digest
+    is over `max_tokens`. Only the entries that aged since the previous step are processed.
+    """
+
+    def __init__(self, max_tokens: int = 300, max_entry_tokens: int = 25) -> None:
+        self.max_tokens = max_tokens
+        self.max_entry_tokens = max_entry_tokens
+        self.lines = []  # [entry, repeats]
+        self.dropped = 0
+        self.folded = 0
+        self._history = None
+
+    def _fold(self, entry: str) -> None:
+        entry = truncate(entry, self.max_entry_tokens)
+        if self.lines and self.lines[-1][0] == entry:
+            self.lines[-1][1] += 1
+        else:
+            self.lines.append([entry, 1])
+        while len(self.lines) > 1 and estimate_tokens(self.text) > self.max_tokens:
+            self.dropped += self.lines.pop(0)[1]
+
+    @property
+    def text(self) -> str:
+        lines = [f"{entry} (x{repeats})" if repeats > 1 else entry for entry, repeats in self.lines]
+        if self.dropped:
+            lines.insert(0, f"({self.dropped} earlier actions omitted)")
+        return "\n".join(lines)
+
+    def update(self, log_history: list, num_recent: int) -> str:
+        """Folds in the entries of `log_history` that are no longer among the `num_recent` last ones."""
+        if log_history is not self._history or len(log_history) < self.folded:
+            # Another run, or another environment state
+            self.lines, self.dropped, self.folded = [], 0, 0
+            self._history = log_history
+        older = len(log_history) - num_recent
+        for entry in log_history[self.folded:older]:
+            self._fold(entry)
+        self.folded = max(self.folded, older)
+        return self.text
+
+
+class PromptBudgeter:
+    """
+    Keeps the volatile part of the user message of every step within `max_tokens`. The error is
+    truncated, the `num_recent` last actions are kept intact and older ones go into a bounded
+    `HistoryDigest`, and the marked element list is cut to the elements most relevant to the task, interactive fields
+    first. Elements outside of the `viewport` are never listed. Token counts per section are logged.
+    The task and its arguments go into the static prefix of the system message instead, see `get_static_prefix`.
+    One budgeter follows one run, since the digest is built incrementally.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 1500,
+        num_recent: int = 5,
+        digest_tokens: int = 300,
+        error_tokens: int = 200,
+        min_elements: int = 10,
+        viewport: tuple = (1600, 900),
+    ) -> None:
+        self.max_tokens = max_tokens
+        self.num_recent = num_recent
+        self.error_tokens = error_tokens
+        self.min_elements = min_elements
+        self.viewport = viewport
+        self.digest = HistoryDigest(max_tokens=digest_tokens)
+        self._task_words = {}
+
+    def _is_on_screen(self, element: dict) -> bool:
+        rect = element.get("rect")
+        if rect is None:
+            return True
+        width, height = self.viewport
+        return (
+            rect["x"] + rect["width"] > 0 and rect["y"] + rect["height"] > 0
+            and rect["x"] < width and rect["y"] < height
+        )
+
+    def _get_task_words(self, task) -> set:
+        key = id(task)
+        if key not in self._task_words:
+            self._task_words = {key: _get_words(f"{task.task} {json.dumps(task.args, default=str)}")}
+        return self._task_words[key]
+
+    def _get_relevance(self, element: dict, task_words: set) -> int:
+        element_words = _get_words(f"{element.get('text') or ''} {element.get('old_aria_label') or ''}")
+        return PRIORITY_TAGS.get(element["tag"].lower(), 0) + 2 * len(element_words & task_words)
+
+    def _select_elements(self, task, marked_elements: dict, budget: int) -> tuple:
+        """The element list within `budget` tokens, and the number of elements left out of it."""
+        entries = {
+            element_id: f"({element_id}) - <{element['tag'].lower()}>"
+            for element_id, element in marked_elements.items()
+            if self._is_on_screen(element)
+        }
+        task_words = self._get_task_words(task)
+        ranked = sorted(
+            entries,
+            key=lambda element_id: -self._get_relevance(marked_elements[element_id], task_words),
+        )
+        kept = set()
+        tokens = 0
+        for element_id in ranked:
+            entry_tokens = estimate_tokens(entries[element_id]) + 1
+            if tokens + entry_tokens > budget and len(kept) >= self.min_elements:
+                break
+            kept.add(element_id)
+            tokens += entry_tokens
+        listed = ", ".join(entries[element_id] for element_id in marked_elements if element_id in kept)
+        return listed, len(marked_elements) - len(kept)
+
+    def build(self, task, observation, num_recent: int = None) -> tuple:
+        """
+        The text of the user message for `observation`, and the token count of each of its sections.
+        With `num_recent` 0 no history is sent.
+        """
+        num_recent = self.num_recent if num_recent is None else num_recent
+        error_message = truncate(observation.error_message, self.error_tokens)
+
+        log_history = observation.env_state.log_history or []
+        history = ""
+        if num_recent > 0 and log_history:
+            # The last entries are sent in full, they hold the outcome of the sub-agents of `act` actions
+            recent = "\n".join(log_history[-num_recent:])
+            digest = self.digest.update(log_history, num_recent)
+            history = f"{digest}\n{recent}" if digest else recent
+
+        sections = {
+            "error": estimate_tokens(str(error_message)),
+            "url": estimate_tokens(observation.url),
+            "history": estimate_tokens(history),
+        }
+        element_budget = self.max_tokens - sum(sections.values())
+        marked_elements_tags, omitted = self._select_elements(task, observation.marked_elements, element_budget)
+        if omitted:
+            marked_elements_tags += f" ({omitted} less relevant elements not listed, their labels are still in the screenshot)"
+        sections["elements"] = estimate_tokens(marked_elements_tags)
+
+        text_prompt = f"""
+        Execution error:
+        {error_message}
+
+        URL:
+        {observation.url}
+
+        Marked elements tags:
+        {marked_elements_tags}
+
+        Log of last actions:
+        {history}
+
+    """
+        return text_prompt, sections
+
+    @staticmethod
+    def log_sections(sections: dict, image_tokens: int = 0) -> None:
+        summary = ", ".join(f"{name} {tokens}" for name, tokens in sections.items())
+        logger.info(f"Prompt tokens per section: {summary}, screenshot {image_tokens}")
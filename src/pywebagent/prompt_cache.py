@@ -0,0 +1,183 @@
+import hashlib
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+logger = logging.getLogger(__name__)
+
+# Anthropic models, directly or through LiteLLM, only cache prefixes that end with an explicit breakpoint.
+# OpenAI models cache any repeated prefix of 1024 tokens or more on their own.
+CACHE_CONTROL = {"type": "ephemeral"}
+
+_usage_sink = ContextVar("pywebagent_usage_sink", default=None)
+
+
+def uses_cache_control(model: str) -> bool:
+    return "claude" in model.lower() or model.startswith("anthropic/")
+
+
+def get_prefix_key(prefix: str) -> str:
+    """Short digest of a prompt prefix, sent as `prompt_cache_key` to route its requests to the same cache."""
+    return hashlib.sha256(prefix.encode("utf-8")).hexdigest()[:32]
+
+
+def build_messages(static_prefix: str, volatile_content: list, model: str) -> list:
+    """
+    Chat messages in the OpenAI format: the static prefix alone in the system message, and everything
+    that changes between steps after it, in the user message. The prefix is marked as a cache
+    breakpoint for the models that need one.
+    """
+    prefix_content = {"type": "text", "text": static_prefix}
+    if uses_cache_control(model):
+        prefix_content["cache_control"] = CACHE_CONTROL
+    return [
+        {"role": "system", "content": [prefix_content]},
+        {"role": "user", "content": volatile_content},
+    ]
+
+
+def get_cache_params(static_prefix: str, model: str) -> dict:
+    """Extra request parameters that improve the cache hit rate of the prefix with the provider of `model`."""
+    if uses_cache_control(model):
+        return {}
+    return {"prompt_cache_key": get_prefix_key(static_prefix)}
+
+
+def _get(value, name, default=None):
+    if value is None:
+        return default
+    if isinstance(value, dict):
+        return value.get(name, default)
+    return getattr(value, name, default)
+
+
+def get_cached_tokens(usage) -> int:
+    """Prompt tokens read from the provider's cache, in OpenAI or Anthropic usage reports."""
+    cached_tokens = _get(_get(usage, "prompt_tokens_details"), "cached_tokens")
+    if cached_tokens is None:
+        cached_tokens = _get(usage, "cache_read_input_tokens")
+    return cached_tokens or 0
+
+
+def get_prompt_tokens(usage) -> int:
+    prompt_tokens = _get(usage, "prompt_tokens")
+    if prompt_tokens is None:
+        # Anthropic counts the cached tokens apart from the other input tokens
+        prompt_tokens = (_get(usage, "input_tokens") or 0) + (_get(usage, "cache_read_input_tokens") or 0)
+    return prompt_tokens or 0
+
+
+def get_completion_tokens(usage) -> int:
+    completion_tokens = _get(usage, "completion_tokens")
+    if completion_tokens is None:
+        completion_tokens = _get(usage, "output_tokens")
+    return completion_tokens or 0
+
+
+@contextmanager
+def record_usage():
+    """Collects the usage reports of the completions made in this context, see `UsageObservingCompletions`."""
+    reports = []
+    token = _usage_sink.set(reports)
+    try:
+        yield reports
+    finally:
+        _usage_sink.reset(token)
+
+
+def observe_usage(usage) -> None:
+    reports = _usage_sink.get()
+    if reports is not None and usage is not None:
+        reports.append(usage)
+
+
+class UsageObservingCompletions:
+    """
+    Wraps the `chat.completions` of an openai client, to hand the usage of every completion to
+    `record_usage`, even when a wrapper such as langchain drops the final usage chunk of a stream.
+    """
+
+    def __init__(self, completions) -> None:
+        self._completions = completions
+
+    def __getattr__(self, name):
+        return getattr(self._completions, name)
+
+    def create(self, **kwargs):
+        if kwargs.get("stream"):
+            kwargs.setdefault("stream_options", {"include_usage": True})
+            return self._observe_stream(self._completions.create(**kwargs))
+        response = self._completions.create(**kwargs)
+        observe_usage(response.usage)
+        return response
+
+    @staticmethod
+    def _observe_stream(stream):
+        try:
+            for chunk in stream:
+                observe_usage(chunk.usage)
+                yield chunk
+        finally:
+            stream.close()
+
+
+class AsyncUsageObservingCompletions(UsageObservingCompletions):
+    async def create(self, **kwargs):
+        if kwargs.get("stream"):
+            kwargs.setdefault("stream_options", {"include_usage": True})
+            return self._aobserve_stream(await self._completions.create(**kwargs))
+        response = await self._completions.create(**kwargs)
+        observe_usage(response.usage)
+        return response
+
+    @staticmethod
+    async def _aobserve_stream(stream):
+        try:
+            async for chunk in stream:
+                observe_usage(chunk.usage)
+                yield chunk
+        finally:
+            await stream.close()
+
+
+class PromptCacheStats:
+    """
+    Prompt and cached tokens of every step of a run. A step whose response stream was closed as soon
+    as its action was complete has no usage report, it is counted apart.
+    """
+
+    def __init__(self) -> None:
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.steps = 0
+        self.unreported_steps = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """Share of the prompt tokens that were read from the cache."""
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
+    def record(self, reports: list) -> None:
+        """Records the usage reports of one step."""
+        if not reports:
+            self.unreported_steps += 1
+            logger.info("Prompt cache: no usage reported for this step")
+            return
+        prompt_tokens = sum(get_prompt_tokens(usage) for usage in reports)
+        cached_tokens = sum(get_cached_tokens(usage) for usage in reports)
+        self.prompt_tokens += prompt_tokens
+        self.cached_tokens += cached_tokens
+        self.steps += 1
+        logger.info(
+            f"Prompt cache: {cached_tokens}/{prompt_tokens} prompt tokens cached this step, "
+            f"{self.hit_rate:.0%} over {self.steps} steps"
+        )
+
+    def stats(self) -> dict:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "hit_rate": self.hit_rate,
+            "steps": self.steps,
+            "unreported_steps": self.unreported_steps,
+        }
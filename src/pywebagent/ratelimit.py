@@ -0,0 +1,265 @@
+import re
+import json
+import time
+import random
+import asyncio
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+from dataclasses import dataclass
+
+import httpx
+import openai
+import requests
+
+from src.pywebagent.tracing import count
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+# Connection level failures, usually the cause of the clients' own connection errors
+RETRYABLE_EXCEPTIONS = (
+    openai.APIConnectionError,
+    httpx.TransportError,
+    requests.ConnectionError,
+    requests.Timeout,
+)
+# 429 codes that no amount of waiting fixes
+FATAL_ERROR_CODES = {"insufficient_quota"}
+
+_DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+def parse_duration(value: str) -> float:
+    """Parses the reset durations of the ratelimit headers, such as `20ms`, `1s` or `6m0s`, into seconds."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    matches = _DURATION_PATTERN.findall(value)
+    if not matches:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in matches)
+
+
+def _get_status_code(e: Exception) -> int:
+    status_code = getattr(e, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(e, "response", None), "status_code", None)
+    return status_code
+
+
+def _get_headers(e: Exception):
+    return getattr(getattr(e, "response", None), "headers", None) or {}
+
+
+def is_retryable(e: Exception) -> bool:
+    """Rate limits, timeouts, server errors and dropped connections are retryable, anything else is fatal."""
+    if getattr(e, "code", None) in FATAL_ERROR_CODES:
+        return False
+    status_code = _get_status_code(e)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES or status_code >= 500
+    cause = e
+    while cause is not None:
+        if isinstance(cause, RETRYABLE_EXCEPTIONS):
+            return True
+        cause = cause.__cause__
+    return False
+
+
+def get_retry_after(headers) -> float:
+    """Seconds to wait according to the `Retry-After` headers of a response, or None."""
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass
+class ModelBudget:
+    """What is left of the requests and tokens per minute of a model, as last reported by the provider."""
+    remaining_requests: int = None
+    remaining_tokens: int = None
+    requests_reset_at: float = 0  # time.monotonic() timestamps
+    tokens_reset_at: float = 0
+    blocked_until: float = 0  # set by a rate limited response, for every caller of the model
+
+    def update(self, headers) -> None:
+        now = time.monotonic()
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        if remaining_requests is not None:
+            self.remaining_requests = int(remaining_requests)
+            self.requests_reset_at = now + (parse_duration(headers.get("x-ratelimit-reset-requests")) or 0)
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if remaining_tokens is not None:
+            self.remaining_tokens = int(remaining_tokens)
+            self.tokens_reset_at = now + (parse_duration(headers.get("x-ratelimit-reset-tokens")) or 0)
+
+    def delay(self, estimated_tokens: int) -> float:
+        """Seconds to wait before a request of `estimated_tokens` fits in the budget."""
+        now = time.monotonic()
+        delay = self.blocked_until - now
+        if self.remaining_requests is not None and self.remaining_requests <= 0:
+            delay = max(delay, self.requests_reset_at - now)
+        if self.remaining_tokens is not None and self.remaining_tokens < estimated_tokens:
+            delay = max(delay, self.tokens_reset_at - now)
+        return max(delay, 0)
+
+    def reserve(self, estimated_tokens: int) -> None:
+        # Counted down until the response headers report the actual budget
+        if self.remaining_requests is not None:
+            self.remaining_requests -= 1
+        if self.remaining_tokens is not None:
+            self.remaining_tokens -= estimated_tokens
+
+
+class RateLimitScheduler:
+    """
+    Runs LLM calls within the rate limits of their model. Requests wait while the budget reported by
+    the `x-ratelimit-*` headers is spent, and retryable failures are retried with jittered exponential
+    backoff, or after `Retry-After` when the provider sent one. A rate limited response holds back
+    every caller of the same model, not only the one that got it.
+    """
+
+    def __init__(self, max_attempts: int = 6, base_delay: float = 1, max_delay: float = 60) -> None:
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._budgets = {}
+        self._lock = threading.Lock()
+        self._queue_depth = 0
+        self.retries = 0
+        self.throttled_time = 0.0  # seconds spent waiting, over all the calls
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of calls currently waiting for budget or for a retry."""
+        return self._queue_depth
+
+    def stats(self) -> dict:
+        return {"queue_depth": self._queue_depth, "retries": self.retries, "throttled_time": self.throttled_time}
+
+    def _budget(self, model: str) -> ModelBudget:
+        budget = self._budgets.get(model)
+        if budget is None:
+            budget = self._budgets[model] = ModelBudget()
+        return budget
+
+    def observe(self, model: str, headers) -> None:
+        """Updates the budget of `model` from the headers of one of its responses."""
+        with self._lock:
+            self._budget(model).update(headers)
+
+    def observe_response(self, response: httpx.Response) -> None:
+        """httpx response hook, reads the model from the json body of the request."""
+        if "x-ratelimit-remaining-requests" not in response.headers and "x-ratelimit-remaining-tokens" not in response.headers:
+            return
+        try:
+            model = json.loads(response.request.content)["model"]
+        except Exception:
+            return
+        self.observe(model, response.headers)
+
+    async def aobserve_response(self, response: httpx.Response) -> None:
+        self.observe_response(response)
+
+    def _acquire(self, model: str, estimated_tokens: int) -> float:
+        """Reserves budget and returns 0, or returns how long to wait before trying again."""
+        with self._lock:
+            budget = self._budget(model)
+            delay = budget.delay(estimated_tokens)
+            if delay <= 0:
+                budget.reserve(estimated_tokens)
+            return delay
+
+    def _backoff(self, model: str, attempt: int, e: Exception) -> float:
+        """Returns the delay before the next attempt, or raises if `e` should not be retried."""
+        if not is_retryable(e):
+            raise e
+        if attempt + 1 >= self.max_attempts:
+            raise RateLimitExceeded(f"Giving up on {model} after {self.max_attempts} attempts") from e
+
+        headers = _get_headers(e)
+        # Full jitter, so agents that failed together do not retry together
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = get_retry_after(headers)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        with self._lock:
+            budget = self._budget(model)
+            budget.update(headers)
+            if _get_status_code(e) == 429:
+                budget.blocked_until = max(budget.blocked_until, time.monotonic() + delay)
+            self.retries += 1
+        count("llm_retries", 1)
+        logger.warning(f"Request to {model} failed ({e}), retrying in {delay:.1f}s, {self._queue_depth} calls queued")
+        return delay
+
+    def _enter_queue(self) -> None:
+        with self._lock:
+            self._queue_depth += 1
+
+    def _leave_queue(self, waited: float) -> None:
+        with self._lock:
+            self._queue_depth -= 1
+            self.throttled_time += waited
+        count("llm_throttled_time", waited)
+
+    def call(self, model: str, func, estimated_tokens: int = 0):
+        """Calls `func()` once the budget of `model` allows it, retrying retryable failures."""
+        for attempt in range(self.max_attempts):
+            while (delay := self._acquire(model, estimated_tokens)) > 0:
+                logger.info(f"Rate limit budget of {model} is spent, waiting {delay:.1f}s")
+                self._sleep(delay)
+            try:
+                return func()
+            except Exception as e:
+                delay = self._backoff(model, attempt, e)
+            self._sleep(delay)
+
+    def _sleep(self, delay: float) -> None:
+        self._enter_queue()
+        try:
+            time.sleep(delay)
+        finally:
+            self._leave_queue(delay)
+
+    async def acall(self, model: str, func, estimated_tokens: int = 0):
+        """Same as `call`, for a coroutine function `func`."""
+        for attempt in range(self.max_attempts):
+            while (delay := self._acquire(model, estimated_tokens)) > 0:
+                logger.info(f"Rate limit budget of {model} is spent, waiting {delay:.1f}s")
+                await self._asleep(delay)
+            try:
+                return await func()
+            except Exception as e:
+                delay = self._backoff(model, attempt, e)
+            await self._asleep(delay)
+
+    async def _asleep(self, delay: float) -> None:
+        self._enter_queue()
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self._leave_queue(delay)
@@ -0,0 +1,89 @@
+import re
+import ast
+import logging
+from src.pywebagent.env.actions import get_action_call
+
+logger = logging.getLogger(__name__)
+
+CODE_START_PATTERN = re.compile(r"\nCode:\s*```(?:python)?\n")
+CODE_END_FENCE = "```"
+# Several calls of these actions are allowed in one step to fill forms, so they never end the code early
+FORM_ACTIONS = {"input_text", "combobox_select"}
+
+
+class StreamingCodeParser:
+    """
+    Extracts the `Code:` block of a response while it is being streamed. The code is ready as soon as
+    the first webpage action call is syntactically complete, so the step can run without waiting for the
+    rest of the completion. Form actions wait for the closing fence, since more of them may follow.
+    With `early=False`, as for plans of several actions, the code is always read up to the fence.
+    A stream closed early loses the usage report sent at its end, its tokens are then unknown, see
+    `PromptCacheStats.unreported_steps`.
+    """
+
+    def __init__(self, early: bool = True) -> None:
+        self.allow_early = early
+        self.text = ""
+        self.code = None
+        self.early = False  # True if the code was ready before the closing fence
+        self._code_start = None
+        self._parsed_lines = 0
+
+    @property
+    def ready(self) -> bool:
+        return self.code is not None
+
+    def feed(self, chunk: str) -> bool:
+        """Adds a chunk of the response, returns True once the code is ready."""
+        if self.ready:
+            return True
+        self.text += chunk
+
+        if self._code_start is None:
+            match = CODE_START_PATTERN.search(self.text)
+            if match is None:
+                return False
+            self._code_start = match.end()
+
+        code = self.text[self._code_start:]
+        end = code.find(CODE_END_FENCE)
+        if end != -1:
+            self.code = code[:end]
+            return True
+
+        if self.allow_early:
+            self.code = self._get_first_action_code(code)
+            self.early = self.ready
+        return self.ready
+
+    def _get_first_action_code(self, code: str):
+        # Only complete lines are parsed, a call is complete once the line it ends on is
+        lines = code.splitlines(keepends=True)
+        if lines and not lines[-1].endswith("\n"):
+            lines = lines[:-1]
+        if len(lines) == self._parsed_lines:
+            return None
+        self._parsed_lines = len(lines)
+
+        try:
+            module = ast.parse("".join(lines))
+        except SyntaxError:
+            return None
+
+        for statement in module.body:
+            call = get_action_call(statement)
+            action = call.func.attr if call is not None else None
+            if action in FORM_ACTIONS:
+                return None
+            if action is not None:
+                return "".join(lines[:statement.end_lineno])
+        return None
+
+    def finish(self) -> str:
+        """Returns the code once the response is complete, raises if it has no code block."""
+        if self.ready:
+            return self.code
+        if self._code_start is None:
+            raise Exception("Code not found")
+        self.code = self.text[self._code_start:]
+        return self.code
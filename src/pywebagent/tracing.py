@@ -0,0 +1,220 @@
+import json
+import time
+import logging
+import secrets
+import threading
+import functools
+import inspect
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+_current_tracer = ContextVar("pywebagent_tracer", default=None)
+_current_span = ContextVar("pywebagent_span", default=None)
+
+
+@dataclass
+class Span:
+    name: str
+    span_id: str
+    parent_id: str = None
+    start_ns: int = 0
+    end_ns: int = None
+    thread_id: int = 0
+    attributes: dict = field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        """Seconds, up to now for a span that did not end yet."""
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+
+class Tracer:
+    """
+    Records the spans of an agent run: nested timed sections, with attributes such as token counts.
+    Spans are attached to the tracer active in the current context, see `activate`, and nest in the
+    order they are entered, in threads and in asyncio tasks alike. Traces export as OpenTelemetry
+    OTLP/JSON, or as a Chrome trace file for chrome://tracing and Perfetto.
+    """
+
+    def __init__(self, service_name: str = "pywebagent") -> None:
+        self.service_name = service_name
+        self.trace_id = secrets.token_hex(16)
+        self.spans = []
+        self.counters = defaultdict(float)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def activate(self):
+        """Makes this the tracer of the spans started in the current context."""
+        token = _current_tracer.set(self)
+        try:
+            yield self
+        finally:
+            _current_tracer.reset(token)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        parent = _current_span.get()
+        span = Span(
+            name=name,
+            span_id=secrets.token_hex(8),
+            parent_id=parent.span_id if parent is not None else None,
+            start_ns=time.time_ns(),
+            thread_id=threading.get_ident(),
+            attributes=attributes,
+        )
+        with self._lock:
+            self.spans.append(span)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            _current_span.reset(token)
+
+    def count(self, name: str, value: float) -> None:
+        """Adds `value` to a counter of the current span and of the whole trace."""
+        with self._lock:
+            self.counters[name] += value
+        span = _current_span.get()
+        if span is not None:
+            span.attributes[name] = span.attributes.get(name, 0) + value
+
+    def to_otel_json(self) -> dict:
+        """The spans in the OTLP/JSON format of OpenTelemetry collectors."""
+        def to_value(value):
+            if isinstance(value, bool):
+                return {"boolValue": value}
+            if isinstance(value, int):
+                return {"intValue": str(value)}
+            if isinstance(value, float):
+                return {"doubleValue": value}
+            return {"stringValue": str(value)}
+
+        spans = []
+        for span in self.spans:
+            otel_span = {
+                "traceId": self.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": 1,  # internal
+                "startTimeUnixNano": str(span.start_ns),
+                "endTimeUnixNano": str(span.end_ns or time.time_ns()),
+                "attributes": [{"key": key, "value": to_value(value)} for key, value in span.attributes.items()],
+            }
+            if span.parent_id is not None:
+                otel_span["parentSpanId"] = span.parent_id
+            if "error" in span.attributes:
+                otel_span["status"] = {"code": 2, "message": span.attributes["error"]}
+            spans.append(otel_span)
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+                    "scopeSpans": [{"scope": {"name": "pywebagent"}, "spans": spans}],
+                }
+            ]
+        }
+
+    def to_chrome_trace(self) -> dict:
+        """The spans as complete events of the Chrome trace event format, one track per thread."""
+        events = [
+            {
+                "name": span.name,
+                "ph": "X",
+                "ts": span.start_ns / 1000,
+                "dur": span.duration * 1e6,
+                "pid": 1,
+                "tid": span.thread_id,
+                "args": {key: value if isinstance(value, (int, float, bool)) else str(value) for key, value in span.attributes.items()},
+            }
+            for span in self.spans
+        ]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export(self, path: str, format: str = "chrome") -> None:
+        """Writes the trace to `path`, as a "chrome" trace file or as "otel" json."""
+        if format not in ("chrome", "otel"):
+            raise ValueError("format must be 'chrome' or 'otel'")
+        trace = self.to_chrome_trace() if format == "chrome" else self.to_otel_json()
+        with open(path, "w") as file:
+            json.dump(trace, file)
+        logger.info(f"Wrote {len(self.spans)} spans to {path}")
+
+    def summary(self) -> str:
+        """Time spent per span name, slowest first, followed by the counters of the trace."""
+        durations = defaultdict(list)
+        for span in self.spans:
+            durations[span.name].append(span.duration)
+        lines = [f"{'span':<28}{'count':>7}{'total s':>10}{'mean s':>9}{'max s':>9}"]
+        for name, values in sorted(durations.items(), key=lambda item: -sum(item[1])):
+            lines.append(f"{name:<28}{len(values):>7}{sum(values):>10.2f}{sum(values) / len(values):>9.2f}{max(values):>9.2f}")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name}: {value:g}")
+        return "\n".join(lines)
+
+
+def get_tracer():
+    """The tracer active in the current context, or None."""
+    return _current_tracer.get()
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """A span of the active tracer, or a detached one that is not recorded when there is no tracer."""
+    tracer = _current_tracer.get()
+    if tracer is None:
+        yield Span(name=name, span_id="", attributes=attributes)
+        return
+    with tracer.span(name, **attributes) as current:
+        yield current
+
+
+@contextmanager
+def trace_run(tracer: Tracer = None, name: str = "agent.run", **attributes):
+    """
+    Runs the block in a span of `tracer`, or of the active tracer, or of a new one. A run that is not
+    nested in another traced run, such as the sub-agent of an `act` action, logs the summary of the trace when it ends.
+    """
+    started = _current_tracer.get() is None
+    tracer = tracer or _current_tracer.get() or Tracer()
+    try:
+        with tracer.activate(), tracer.span(name, **attributes) as run_span:
+            yield run_span
+    finally:
+        if started:
+            logger.info(f"Trace of the run:\n{tracer.summary()}")
+
+
+def count(name: str, value: float) -> None:
+    tracer = _current_tracer.get()
+    if tracer is not None:
+        tracer.count(name, value)
+
+
+def traced(name: str):
+    """Decorator that runs a function, or a coroutine function, in a span."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
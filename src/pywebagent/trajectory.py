@@ -0,0 +1,433 @@
+import os
+import re
+import ast
+import json
+import time
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+from urllib.parse import urlparse
+from src.pywebagent.env.actions import ELEMENT_ACTIONS
+
+logger = logging.getLogger(__name__)
+
+
+def get_default_db_path() -> Path:
+    return Path(os.environ.get("PYWEBAGENT_TRAJECTORY_DB", Path.home() / ".cache" / "pywebagent" / "trajectories.db"))
+
+
+def normalize_task(task: str) -> str:
+    return re.sub(r"\s+", " ", task).strip().lower()
+
+
+def get_args_schema(args) -> str:
+    """Shape of the task arguments, without their values: a sorted list of paths."""
+    paths = []
+
+    def walk(value, path):
+        if isinstance(value, dict) and value:
+            for key in value:
+                walk(value[key], f"{path}.{key}" if path else str(key))
+        else:
+            paths.append(path)
+
+    walk(args, "")
+    return ",".join(sorted(paths))
+
+
+def get_domain(url: str) -> str:
+    return urlparse(url).netloc
+
+
+def _get_action_calls(tree):
+    for node in ast.walk(tree):
+        if (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Attribute)
+            and isinstance(node.func.value, ast.Name)
+            and node.func.value.id == "actions"
+        ):
+            yield node
+
+
+def _get_arg_values(args) -> list:
+    """
+    (path, value) of every argument and nested argument value, the deepest first. Numbers are
+    included, a PIN or a card code is as secret as a password. Booleans are left out, they would
+    match every flag of the actions, such as `clear_before_input`.
+    """
+    values = []
+
+    def walk(value, path):
+        if isinstance(value, dict):
+            for key in value:
+                walk(value[key], path + [key])
+        if not path or isinstance(value, bool) or value is None:
+            return
+        if isinstance(value, (int, float)) or value:
+            values.append((path, value))
+
+    walk(args, [])
+    return values
+
+
+class _ParametrizeStep(ast.NodeTransformer):
+    """Replaces marked element ids by `elements[i]`, and task argument values by `args[...]`."""
+
+    def __init__(self, marked_elements: dict, args: dict) -> None:
+        self.marked_elements = marked_elements
+        self.arg_values = _get_arg_values(args)
+        self.locators = []
+        self.recordable = True
+
+    def visit_Call(self, node):
+        if node in self.element_calls:
+            element_id = node.args[0] if node.args else None
+            if not isinstance(element_id, ast.Constant) or element_id.value not in self.marked_elements:
+                self.recordable = False  # e.g. an id computed by the code, it cannot be located again
+            else:
+                node.args[0] = ast.Subscript(
+                    value=ast.Name(id="elements", ctx=ast.Load()),
+                    slice=ast.Constant(len(self.locators)),
+                    ctx=ast.Load(),
+                )
+                self.locators.append(get_locator(self.marked_elements[element_id.value]))
+        return self.generic_visit(node)
+
+    def visit_Subscript(self, node):
+        if isinstance(node.value, ast.Name) and node.value.id == "elements":
+            return node  # the index of a located element, not an argument
+        return self.generic_visit(node)
+
+    @staticmethod
+    def _get_placeholder(path: list):
+        placeholder = ast.Name(id="args", ctx=ast.Load())
+        for key in path:
+            placeholder = ast.Subscript(value=placeholder, slice=ast.Constant(key), ctx=ast.Load())
+        return placeholder
+
+    def _get_text_parts(self, text: str) -> list:
+        """
+        Splits `text` around the argument values it contains, such as the password in the log message
+        "Typing <password> into ...". Returns the parts of an f-string, or [] if there is no value.
+        """
+        placeholders = {}
+        for path, arg_value in self.arg_values:
+            if isinstance(arg_value, (str, int, float)):
+                placeholders.setdefault(str(arg_value), path)
+        if not placeholders:
+            return []
+        # The longest values first, so that a value is not replaced by a shorter value it contains
+        pattern = "|".join(re.escape(value) for value in sorted(placeholders, key=len, reverse=True))
+        parts = re.split(f"({pattern})", text)
+        if len(parts) == 1:
+            return []
+        return [
+            ast.FormattedValue(value=self._get_placeholder(placeholders[part]), conversion=-1, format_spec=None)
+            if index % 2 else ast.Constant(part)
+            for index, part in enumerate(parts) if part
+        ]
+
+    def _visit_literal(self, node):
+        try:
+            value = ast.literal_eval(node)
+        except (ValueError, TypeError, SyntaxError):
+            return self.generic_visit(node)
+        for path, arg_value in self.arg_values:
+            # Compared with their types, so that 1 does not stand for True or 1.0
+            if type(value) is type(arg_value) and value == arg_value:
+                return self._get_placeholder(path)
+            if isinstance(value, str) and isinstance(arg_value, (int, float)) and value == str(arg_value):
+                # A number typed as text, e.g. a PIN
+                return ast.Call(func=ast.Name(id="str", ctx=ast.Load()), args=[self._get_placeholder(path)], keywords=[])
+        if isinstance(value, str):
+            parts = self._get_text_parts(value)
+            return ast.JoinedStr(values=parts) if parts else node
+        if isinstance(value, (list, tuple, dict)):
+            return self.generic_visit(node)  # arguments may be items of the literal
+        return node
+
+    def visit_JoinedStr(self, node):
+        values = []
+        for part in node.values:
+            if isinstance(part, ast.Constant):
+                values.extend(self._get_text_parts(part.value) or [part])
+            else:
+                values.append(self.generic_visit(part))
+        node.values = values
+        return node
+
+    visit_Constant = _visit_literal
+    visit_List = _visit_literal
+    visit_Dict = _visit_literal
+    visit_Tuple = _visit_literal
+
+    def parametrize(self, code: str) -> str:
+        tree = ast.parse(code)
+        self.element_calls = {
+            call for call in _get_action_calls(tree) if call.func.attr in ELEMENT_ACTIONS
+        }
+        return ast.unparse(self.visit(tree))
+
+
+class _InstantiateStep(ast.NodeTransformer):
+    """Inverse of `_ParametrizeStep`, for the elements located in the current observation."""
+
+    def __init__(self, element_ids: list, args: dict) -> None:
+        self.element_ids = element_ids
+        self.args = args
+
+    def visit_Subscript(self, node):
+        path = []
+        value = node
+        while isinstance(value, ast.Subscript) and isinstance(value.slice, ast.Constant):
+            path.insert(0, value.slice.value)
+            value = value.value
+        if isinstance(value, ast.Name) and value.id == "elements":
+            return ast.Constant(self.element_ids[path[0]])
+        if isinstance(value, ast.Name) and value.id == "args":
+            arg_value = self.args
+            for key in path:
+                arg_value = arg_value[key]
+            return ast.parse(repr(arg_value), mode="eval").body
+        return self.generic_visit(node)
+
+    def visit_JoinedStr(self, node):
+        node = self.generic_visit(node)
+        # Back to a plain string once the argument values are in, unless the code itself formats values
+        if all(
+            isinstance(part, ast.Constant)
+            or (isinstance(part, ast.FormattedValue) and isinstance(part.value, ast.Constant)
+                and part.conversion == -1 and part.format_spec is None)
+            for part in node.values
+        ):
+            return ast.Constant("".join(
+                str(part.value.value if isinstance(part, ast.FormattedValue) else part.value) for part in node.values
+            ))
+        return node
+
+
+def _get_frame_id(element: dict) -> str:
+    """Identifies the frame of an element across runs, where frame urls may carry session state."""
+    frame = element.get("iframe")
+    if frame is None:
+        return element.get("iframe_name")
+    if frame.parent_frame is None:
+        return ""
+    if frame.name:
+        return frame.name
+    url = urlparse(frame.url)
+    return f"{url.netloc}{url.path}"
+
+
+def get_locator(element: dict) -> dict:
+    return {
+        "xpath": element.get("xpath"),
+        "tag": element.get("tag"),
+        "aria_label": element.get("old_aria_label"),
+        "text": element.get("text"),
+        "frame": _get_frame_id(element),
+    }
+
+
+def locate_element(locator: dict, marked_elements: dict):
+    """
+    Finds the id of the element `locator` describes in the current observation, or None if it is
+    not there or ambiguous. The xpath alone is not trusted when the label or text of the element changed.
+    """
+    def same_identity(element):
+        return (
+            (not locator["aria_label"] or element.get("old_aria_label") == locator["aria_label"])
+            and (not locator["text"] or element.get("text") == locator["text"])
+        )
+
+    candidates = [
+        element for element in marked_elements.values()
+        if element.get("tag") == locator["tag"]
+        and _get_frame_id(element) == locator["frame"]
+        and same_identity(element)
+    ]
+    by_xpath = [element for element in candidates if element.get("xpath") == locator["xpath"]]
+    if len(by_xpath) == 1:
+        return by_xpath[0]["id"]
+    # The page layout moved, the element is found by its label and text if those are distinctive
+    if locator["aria_label"] or locator["text"]:
+        if len(candidates) == 1:
+            return candidates[0]["id"]
+    return None
+
+
+def _has_page_dependent_output(code: str) -> bool:
+    """True if the step finishes the task with an output, which depends on what the page showed."""
+    for call in _get_action_calls(ast.parse(code)):
+        if call.func.attr == "finish" and len(call.args) > 1:
+            output = call.args[1]
+            if not (isinstance(output, ast.Dict) and not output.keys):
+                return True
+    return False
+
+
+class TrajectoryRun:
+    """
+    Replays the stored trajectory of a task in one run of the agent, and records the steps of the run.
+    Once a step of the stored trajectory cannot be replayed, the rest of the run is left to the llm.
+    """
+
+    def __init__(self, store, key: tuple, args: dict, steps: list) -> None:
+        self.store = store
+        self.key = key
+        self.args = args
+        self._replay_steps = steps or []
+        self._replay_index = 0
+        self._replaying = bool(steps)
+        self.steps = []
+        self.recordable = True
+        self.replayed = 0
+
+    def next_action(self, observation):
+        """The code of the next stored step for `observation`, or None if the llm has to decide."""
+        if not self._replaying:
+            return None
+        if self._replay_index >= len(self._replay_steps):
+            self._replaying = False
+            return None
+
+        step = self._replay_steps[self._replay_index]
+        element_ids = [locate_element(locator, observation.marked_elements) for locator in step["locators"]]
+        code = None
+        if get_domain(observation.url) == step["domain"] and None not in element_ids:
+            code = ast.unparse(_InstantiateStep(element_ids, self.args).visit(ast.parse(step["code"])))
+        if code is None or _has_page_dependent_output(code):
+            logger.info(f"Stored trajectory diverged at step {self._replay_index}, asking the llm from now on")
+            self._replaying = False
+            return None
+
+        logger.info(f"Replaying step {self._replay_index} of the stored trajectory: {code}")
+        self._replay_index += 1
+        self.replayed += 1
+        return code
+
+    def record(self, code: str, marked_elements: dict, url: str, error_message: str) -> None:
+        """Records a step, given the observation it was decided on and the error it caused."""
+        if error_message is not None:
+            if self._replaying:
+                logger.info(f"Replayed step {self._replay_index - 1} failed, asking the llm from now on")
+                self._replaying = False
+            return  # Failed steps are not worth replaying
+        parametrize = _ParametrizeStep(marked_elements, self.args)
+        try:
+            template = parametrize.parametrize(code)
+        except SyntaxError:
+            template = None
+        if template is None or not parametrize.recordable:
+            self.recordable = False
+            return
+        self.steps.append({"code": template, "locators": parametrize.locators, "domain": get_domain(url)})
+
+    def finish(self, succeeded: bool) -> None:
+        if self.store is None:
+            return
+        if succeeded and self.recordable and self.steps:
+            self.store.save(self.key, self.steps)
+            logger.info(f"Stored trajectory of {len(self.steps)} steps, {self.replayed} were replayed")
+        elif self.replayed:
+            self.store.record_failure(self.key)
+
+
+class TrajectoryStore:
+    """
+    SQLite store of the successful trajectories of the agent, keyed by (domain, normalized task,
+    arguments schema). Element ids are stored as locators, and argument values as placeholders,
+    so a trajectory is replayed on fresh pages and with other argument values.
+    """
+
+    def __init__(self, path=None) -> None:
+        self.path = str(path or get_default_db_path())
+        if self.path != ":memory:":
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS trajectories (
+                    domain TEXT NOT NULL,
+                    task TEXT NOT NULL,
+                    args_schema TEXT NOT NULL,
+                    steps TEXT NOT NULL,
+                    successes INTEGER NOT NULL DEFAULT 0,
+                    failures INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (domain, task, args_schema)
+                )
+                """
+            )
+
+    @staticmethod
+    def get_key(url: str, task: str, args: dict) -> tuple:
+        return get_domain(url), normalize_task(task), get_args_schema(args)
+
+    def load(self, key: tuple):
+        """The steps stored for `key`, unless the trajectory failed more often than it succeeded."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT steps, successes, failures FROM trajectories WHERE domain = ? AND task = ? AND args_schema = ?",
+                key,
+            ).fetchone()
+        if row is None or row[2] > row[1]:
+            return None
+        return json.loads(row[0])
+
+    def save(self, key: tuple, steps: list) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                """
+                INSERT INTO trajectories (domain, task, args_schema, steps, successes, failures, updated_at)
+                VALUES (?, ?, ?, ?, 1, 0, ?)
+                ON CONFLICT (domain, task, args_schema) DO UPDATE SET
+                    successes = CASE WHEN steps = excluded.steps THEN successes + 1 ELSE 1 END,
+                    failures = CASE WHEN steps = excluded.steps THEN failures ELSE 0 END,
+                    steps = excluded.steps,
+                    updated_at = excluded.updated_at
+                """,
+                (*key, json.dumps(steps), time.time()),
+            )
+
+    def record_failure(self, key: tuple) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE trajectories SET failures = failures + 1 WHERE domain = ? AND task = ? AND args_schema = ?",
+                key,
+            )
+
+    def start(self, url: str, task) -> TrajectoryRun:
+        """Starts a run of `task`, replaying its stored trajectory if there is one."""
+        key = self.get_key(url, task.task, task.args)
+        steps = self.load(key)
+        if steps:
+            logger.info(f"Found a stored trajectory of {len(steps)} steps for this task")
+        return TrajectoryRun(self, key, task.args, steps)
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def start_trajectory(store, url: str, task) -> TrajectoryRun:
+    """Starts a run with `store`, or with nothing replayed nor stored if `store` is None."""
+    if store is None:
+        return TrajectoryRun(None, None, task.args, None)
+    return store.start(url, task)
+
+
+def get_default_trajectory_store() -> TrajectoryStore:
+    """A store in ~/.cache/pywebagent/trajectories.db, or in the file set by PYWEBAGENT_TRAJECTORY_DB."""
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = TrajectoryStore()
+        return _default_store
@@ -0,0 +1,100 @@
+import inspect
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from src.pywebagent import agent
+from src.pywebagent.env.action_schema import (
+    Act,
+    ComboboxSelect,
+    Click,
+    Finish,
+    InputText,
+    InvalidActionError,
+    Scroll,
+    UploadFiles,
+    parse_tool_calls,
+)
+from src.pywebagent.env.actions import Actions, EnvState
+
+ACTIONS = [
+    Click(element_id=3, log_message="Clicking on the login button"),
+    InputText(element_id=4, text="jane", clear_before_input=True, log_message="Typing the name"),
+    UploadFiles(element_id=5, files=["cv.pdf"], log_message="Uploading the cv"),
+    Scroll(direction="down", log_message="Scrolling down"),
+    ComboboxSelect(element_id=6, option="France", log_message="Selecting the country"),
+    Finish(did_succeed=True, output={"id": 1}, reason="Done"),
+    Act(url="https://mail.example.com", task="Get the code", log_message="Reading the email", args={"user": "jane"}),
+]
+
+
+def get_tool_call(name: str, arguments: str) -> dict:
+    return {"id": "call_0", "type": "function", "function": {"name": name, "arguments": arguments}}
+
+
+class RecordingActions:
+    """Records the calls, after checking them against the signatures of `Actions`."""
+
+    def __init__(self) -> None:
+        self.calls = []
+
+    def __getattr__(self, name):
+        def record(*args, **kwargs):
+            inspect.signature(getattr(Actions, name)).bind(self, *args, **kwargs)
+            self.calls.append((name, args, kwargs))
+        return record
+
+
+def test_tool_calls_are_parsed_in_order():
+    actions = parse_tool_calls([
+        get_tool_call("input_text", json.dumps({"element_id": 4, "text": "jane", "clear_before_input": True, "log_message": "Typing"})),
+        SimpleNamespace(function=SimpleNamespace(name="click", arguments='{"element_id": 3, "log_message": "Clicking"}')),
+    ])
+    assert actions == [
+        InputText(element_id=4, text="jane", clear_before_input=True, log_message="Typing"),
+        Click(element_id=3, log_message="Clicking"),
+    ]
+
+
+def test_unknown_tool_is_invalid():
+    with pytest.raises(InvalidActionError, match="Unknown action"):
+        parse_tool_calls([get_tool_call("navigate", '{"url": "https://example.com"}')])
+
+
+def test_malformed_arguments_are_invalid():
+    with pytest.raises(InvalidActionError, match="Invalid arguments for click"):
+        parse_tool_calls([get_tool_call("click", '{"element_id": 3, "log_message": ')])
+    with pytest.raises(InvalidActionError, match="Invalid arguments for click"):
+        parse_tool_calls([get_tool_call("click", '{"element_id": 3, "log_message": "x", "force": true}')])
+    with pytest.raises(InvalidActionError, match="no action"):
+        parse_tool_calls([])
+
+
+@pytest.mark.parametrize("action", ACTIONS, ids=lambda action: action.name)
+def test_every_action_is_dispatched_to_its_method(action):
+    actions = RecordingActions()
+    action.dispatch(actions)
+    name, args, kwargs = actions.calls[0]
+    assert name == action.name
+    assert args == action.call_args()
+    assert kwargs == action.call_kwargs()
+
+
+def test_act_arguments_are_task_arguments(monkeypatch):
+    calls = []
+
+    def fake_act(url, task, **kwargs):
+        calls.append(kwargs)
+        return SimpleNamespace(succeeded=True, output={"code": "1234"}, status="SUCCESS")
+
+    monkeypatch.setattr(agent, "act", fake_act)
+    page = SimpleNamespace(url="https://shop.example.com/login")
+    actions = Actions(page, {}, EnvState(log_history=[]))
+    action = Act(
+        url="https://mail.example.com", task="Get the code", log_message="Reading the email",
+        args={"user": "jane", "max_actions": 1000, "num_history": 5},
+    )
+    assert action.dispatch(actions) == {"code": "1234"}
+    assert calls[0]["task_args"] == {"user": "jane", "max_actions": 1000, "num_history": 5}
+    assert calls[0]["num_history"] == 0 and "max_actions" not in calls[0]
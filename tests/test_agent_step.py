@@ -0,0 +1,141 @@
+import asyncio
+import io
+
+from langchain.schema import HumanMessage
+from PIL import Image
+
+from src.pywebagent import agent
+from src.pywebagent.agent import Task, calculate_next_action, calculate_next_action_async, generate_user_message
+from src.pywebagent.env.actions import EnvState
+from src.pywebagent.env.browser import WebpageObservation
+from src.pywebagent.observation_cache import ObservationCache
+from src.pywebagent.prompt_cache import PromptCacheStats
+
+RESPONSE = """Explanation:
+The search field is empty, I type the query.
+Code:
+```python
+actions.input_text(1, "shoes", True, "Typing the query")
+```"""
+
+
+class Chunk:
+    def __init__(self, content) -> None:
+        self.content = content
+
+
+class Stream(list):
+    def close(self) -> None:
+        pass
+
+
+class AsyncStream:
+    def __init__(self, chunks) -> None:
+        self.chunks = iter(chunks)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.chunks)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def aclose(self) -> None:
+        pass
+
+
+class StubLLM:
+    """Stand-in for the chat model, streaming a fixed response in small chunks."""
+
+    model_name = "gpt-4o"
+    temperature = 1
+    max_tokens = 2000
+
+    def __init__(self) -> None:
+        self.messages = None
+        self.calls = 0
+
+    def stream(self, messages, **kwargs):
+        self.messages = messages
+        self.calls += 1
+        return Stream(Chunk(RESPONSE[i:i + 7]) for i in range(0, len(RESPONSE), 7))
+
+    def astream(self, messages, **kwargs):
+        return AsyncStream(self.stream(messages, **kwargs))
+
+
+def get_screenshot() -> bytes:
+    data = io.BytesIO()
+    Image.new("RGB", (1600, 900), "white").save(data, format="PNG")
+    return data.getvalue()
+
+
+def get_observation(url="https://example.com") -> WebpageObservation:
+    env_state = EnvState()
+    env_state.log_history = ["Opened the page"]
+    return WebpageObservation(
+        url=url,
+        error_message=None,
+        screenshot=get_screenshot(),
+        marked_elements={
+            0: {"id": 0, "tag": "A", "text": "Home", "xpath": "/html/body/a", "rect": {"x": 10, "y": 10, "width": 50, "height": 20}},
+            1: {"id": 1, "tag": "INPUT", "text": "", "xpath": "/html/body/input", "rect": {"x": 100, "y": 10, "width": 300, "height": 30}},
+        },
+        env_state=env_state,
+    )
+
+
+def test_user_message_has_text_and_screenshot():
+    message = generate_user_message(Task("Search for shoes", {}), get_observation(), num_history=5)
+    assert isinstance(message, HumanMessage)
+    text, image = message.content
+    assert "https://example.com" in text["text"]
+    assert "Opened the page" in text["text"]
+    assert image["type"] == "image_url"
+
+
+def test_next_action_from_streamed_response(monkeypatch):
+    llm = StubLLM()
+    monkeypatch.setattr(agent, "get_llm", lambda: llm)
+    stats = PromptCacheStats()
+    code = calculate_next_action(Task("Search for shoes", {}), get_observation(), 5, prompt_cache_stats=stats)
+    assert code.strip() == 'actions.input_text(1, "shoes", True, "Typing the query")'
+    system_message, user_message = llm.messages
+    assert "Search for shoes" in system_message.content
+    assert stats.unreported_steps == 1
+
+
+def test_async_next_action_matches_the_sync_one(monkeypatch):
+    llm = StubLLM()
+    monkeypatch.setattr(agent, "get_llm", lambda: llm)
+    task = Task("Search for shoes", {})
+    code = asyncio.run(calculate_next_action_async(task, get_observation(), 5))
+    assert code == calculate_next_action(task, get_observation(), 5)
+
+
+def test_recent_history_is_not_truncated():
+    observation = get_observation()
+    sub_agent_result = "Sub-agent finished: " + "the order was placed and confirmed by email " * 10
+    observation.env_state.log_history = ["Opened the page", sub_agent_result]
+    message = generate_user_message(Task("Search for shoes", {}), observation, num_history=5)
+    assert sub_agent_result in message.content[0]["text"]
+
+
+def test_reused_code_that_changes_nothing_is_not_reused_again(monkeypatch):
+    llm = StubLLM()
+    monkeypatch.setattr(agent, "get_llm", lambda: llm)
+    task = Task("Search for shoes", {})
+    cache = ObservationCache(policy="reuse")
+    home, results = get_observation(), get_observation(url="https://example.com/results")
+
+    code = calculate_next_action(task, home, 5, observation_cache=cache)
+    calculate_next_action(task, results, 5, observation_cache=cache)
+    assert llm.calls == 2
+    # Back on the home page, its previous decision is reused
+    assert calculate_next_action(task, home, 5, observation_cache=cache) == code
+    assert llm.calls == 2
+    # The reused code left the page as it was, the llm decides again
+    calculate_next_action(task, home, 5, observation_cache=cache)
+    assert llm.calls == 3
@@ -0,0 +1,41 @@
+import io
+from types import SimpleNamespace
+
+from PIL import Image
+
+from src.pywebagent.agent_candidate_list import score_outcome
+
+
+def get_screenshot(color: str) -> bytes:
+    data = io.BytesIO()
+    image = Image.new("RGB", (160, 90), "white")
+    image.paste(color, (0, 0, 80, 90))
+    image.save(data, format="PNG")
+    return data.getvalue()
+
+
+def get_observation(url="https://example.com", xpaths=("/a", "/b"), color="white", error_message=None):
+    return SimpleNamespace(
+        url=url,
+        marked_elements={i: {"xpath": xpath} for i, xpath in enumerate(xpaths)},
+        screenshot=get_screenshot(color),
+        error_message=error_message,
+    )
+
+
+def test_navigation_does_not_outweigh_the_rank():
+    before = get_observation()
+    typed = get_observation(xpaths=("/a", "/b", "/c"))
+    navigated = get_observation(url="https://ads.example.com", xpaths=("/x",), color="black")
+    assert score_outcome(before, typed, 0, 4) > score_outcome(before, navigated, 1, 4)
+
+
+def test_a_no_op_loses_to_a_large_change():
+    before = get_observation()
+    navigated = get_observation(url="https://example.com/results", xpaths=("/x",), color="black")
+    assert score_outcome(before, navigated, 1, 4) > score_outcome(before, before, 0, 4)
+
+
+def test_failed_candidates_score_lowest():
+    before = get_observation()
+    assert score_outcome(before, get_observation(error_message="Timeout"), 0, 4) == float("-inf")
@@ -0,0 +1,26 @@
+import threading
+
+from src.pywebagent.env.pool import get_default_browser_pool
+
+
+def test_default_pools_are_kept_per_headless_mode_and_thread():
+    headed = get_default_browser_pool(headless=False)
+    headless = get_default_browser_pool(headless=True)
+    assert headed is get_default_browser_pool(headless=False)
+    assert headless is not headed
+    assert headless.launch_options["headless"] and not headed.launch_options["headless"]
+
+    other_thread_pools = []
+    thread = threading.Thread(target=lambda: other_thread_pools.append(get_default_browser_pool(headless=False)))
+    thread.start()
+    thread.join()
+    assert other_thread_pools[0] is not headed
+
+
+def test_default_pool_of_a_worker_thread_is_closed_when_the_thread_ends():
+    worker_pools = []
+    thread = threading.Thread(target=lambda: worker_pools.append(get_default_browser_pool(headless=True)))
+    thread.start()
+    thread.join()
+    assert worker_pools[0]._closed
+    assert not get_default_browser_pool(headless=True)._closed
@@ -0,0 +1,92 @@
+import json
+
+from src.pywebagent.prompt import get_static_prefix
+from src.pywebagent.prompt_cache import (
+    PromptCacheStats,
+    UsageObservingCompletions,
+    build_messages,
+    get_cache_params,
+    record_usage,
+)
+
+SYSTEM_PROMPT = "You are an AI agent that controls a webpage using python code. " * 200
+
+
+class Task:
+    def __init__(self, task, args) -> None:
+        self.task = task
+        self.args = args
+
+
+class CachingProvider:
+    """Stand-in for a provider that caches prompt prefixes of 1024 tokens or more, in blocks of 128."""
+
+    MIN_PREFIX = 1024
+    BLOCK = 128
+
+    def __init__(self) -> None:
+        self.cached = set()
+
+    def complete(self, messages: list) -> dict:
+        text = json.dumps(messages)
+        tokens = [text[i:i + 4] for i in range(0, len(text), 4)]
+        cached_tokens = 0
+        for end in range(self.MIN_PREFIX, len(tokens) + 1, self.BLOCK):
+            prefix = "".join(tokens[:end])
+            if prefix in self.cached:
+                cached_tokens = end
+            self.cached.add(prefix)
+        return {"prompt_tokens": len(tokens), "prompt_tokens_details": {"cached_tokens": cached_tokens}}
+
+
+def run_steps(provider, task, num_steps, stats):
+    prefix = get_static_prefix(SYSTEM_PROMPT, task)
+    for step in range(num_steps):
+        volatile = [{"type": "text", "text": f"URL: https://example.com/{step}\nLog of last actions: step {step}"}]
+        stats.record([provider.complete(build_messages(prefix, volatile, "gpt-4o"))])
+
+
+def test_static_prefix_is_cached_across_steps():
+    provider = CachingProvider()
+    stats = PromptCacheStats()
+    run_steps(provider, Task("Buy a pair of shoes", {"size": 42}), 10, stats)
+    assert stats.steps == 10
+    assert stats.hit_rate > 0.8
+
+
+def test_static_prefix_is_cached_across_runs():
+    provider = CachingProvider()
+    run_steps(provider, Task("Buy a pair of shoes", {"size": 42}), 1, PromptCacheStats())
+    stats = PromptCacheStats()
+    run_steps(provider, Task("Buy a pair of shoes", {"size": 42}), 1, stats)
+    assert stats.hit_rate > 0.9
+
+
+def test_cache_params():
+    assert "prompt_cache_key" in get_cache_params(SYSTEM_PROMPT, "gpt-4o")
+    assert get_cache_params(SYSTEM_PROMPT, "anthropic/claude-3-5-sonnet") == {}
+    messages = build_messages("prefix", [], "anthropic/claude-3-5-sonnet")
+    assert messages[0]["content"][0]["cache_control"] == {"type": "ephemeral"}
+
+
+def test_streamed_usage_is_recorded():
+    class Chunk:
+        def __init__(self, usage=None) -> None:
+            self.usage = usage
+
+    class Stream(list):
+        def close(self) -> None:
+            pass
+
+    class Completions:
+        def create(self, **kwargs):
+            assert kwargs["stream_options"] == {"include_usage": True}
+            return Stream([Chunk(), Chunk({"prompt_tokens": 2000, "prompt_tokens_details": {"cached_tokens": 1536}})])
+
+    completions = UsageObservingCompletions(Completions())
+    with record_usage() as reports:
+        list(completions.create(stream=True))
+    stats = PromptCacheStats()
+    stats.record(reports)
+    assert stats.cached_tokens == 1536
+    assert stats.hit_rate == 0.768
@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from src.pywebagent.env.settle import DomQuietSettler, FixedDelaySettler, PageSettler
+
+
+class FakePage:
+    """A page whose first evaluation fails as if it navigated, and that settles afterwards."""
+
+    def __init__(self) -> None:
+        self.calls = []
+
+    def on(self, event, handler) -> None:
+        pass
+
+    def evaluate(self, script, args):
+        self.calls.append("evaluate")
+        if self.calls.count("evaluate") == 1:
+            raise Exception("Execution context was destroyed")
+        return {"settled": True}
+
+    def wait_for_load_state(self, state, timeout):
+        self.calls.append(state)
+
+    def wait_for_timeout(self, timeout):
+        self.calls.append("timeout")
+
+
+class AsyncFakePage(FakePage):
+    async def evaluate(self, script, args):
+        return FakePage.evaluate(self, script, args)
+
+    async def wait_for_load_state(self, state, timeout):
+        return FakePage.wait_for_load_state(self, state, timeout)
+
+    async def wait_for_timeout(self, timeout):
+        return FakePage.wait_for_timeout(self, timeout)
+
+
+def test_dom_quiet_settler_waits_for_the_new_document():
+    page = FakePage()
+    result = DomQuietSettler().wait(page)
+    assert result.settled
+    assert page.calls == ["evaluate", "domcontentloaded", "evaluate"]
+
+
+def test_sync_and_async_settlers_make_the_same_calls():
+    for settler in (DomQuietSettler(), FixedDelaySettler(delay=0)):
+        page, async_page = FakePage(), AsyncFakePage()
+        result = settler.wait(page)
+        async_result = asyncio.run(settler.wait_async(async_page))
+        assert page.calls == async_page.calls
+        assert result.settled == async_result.settled
+
+
+def test_settlers_must_implement_both_waits():
+    class SyncOnlySettler(PageSettler):
+        def wait(self, page):
+            pass
+
+    with pytest.raises(TypeError):
+        SyncOnlySettler()
@@ -0,0 +1,81 @@
+import ast
+
+from src.pywebagent.agent import Task
+from src.pywebagent.trajectory import TrajectoryStore, _InstantiateStep, _ParametrizeStep, start_trajectory
+
+MARKED_ELEMENTS = {
+    3: {"id": 3, "tag": "INPUT", "text": "", "rect": {"x": 10, "y": 10, "width": 200, "height": 30}},
+}
+
+
+def parametrize(code: str, args: dict) -> str:
+    return _ParametrizeStep(MARKED_ELEMENTS, args).parametrize(code)
+
+
+def instantiate(template: str, args: dict) -> str:
+    return ast.unparse(_InstantiateStep([7, 7, 7], args).visit(ast.parse(template)))
+
+
+def test_string_and_numeric_arguments_are_parametrized():
+    args = {"name": "Jane", "card": {"cvc": 123, "pin": 4321}}
+    template = parametrize(
+        "actions.input_text(3, 'Jane', True, 'Name')\n"
+        "actions.input_text(3, '4321', True, 'PIN')\n"
+        "actions.input_text(3, 123, True, 'CVC')",
+        args,
+    )
+    assert "Jane" not in template and "4321" not in template and "123" not in template
+    assert "args['card']['pin']" in template
+    code = instantiate(template, {"name": "John", "card": {"cvc": 987, "pin": 1111}})
+    assert "actions.input_text(7, 'John', True, 'Name')" in code
+    assert "str(1111)" in code
+    assert "actions.input_text(7, 987, True, 'CVC')" in code
+
+
+def test_flags_and_element_indexes_are_not_parametrized():
+    template = parametrize("actions.input_text(3, 'x', True, 'Query')", {"flag": True, "count": 0})
+    assert template == "actions.input_text(elements[0], 'x', True, 'Query')"
+
+
+def test_items_of_a_literal_are_parametrized():
+    template = parametrize("actions.combobox_select(3, ['red', 'Jane'])", {"name": "Jane"})
+    assert template == "actions.combobox_select(elements[0], ['red', args['name']])"
+
+
+def test_argument_values_inside_strings_are_parametrized():
+    template = parametrize(
+        "actions.input_text(3, 'hunter2', True, 'Typing hunter2 for jane into the password field')",
+        {"user": {"name": "jane", "password": "hunter2"}},
+    )
+    assert "hunter2" not in template and "jane" not in template
+    code = instantiate(template, {"user": {"name": "john", "password": "s3cret"}})
+    assert code == "actions.input_text(7, 's3cret', True, 'Typing s3cret for john into the password field')"
+
+
+def test_no_argument_value_is_stored():
+    store = TrajectoryStore(":memory:")
+    run = store.start("https://example.com/login", Task("Log in", {"password": "hunter2", "pin": 4321}))
+    run.record(
+        "actions.input_text(3, 'hunter2', True, 'Typing hunter2 into the password field')\n"
+        "actions.input_text(3, '4321', True, f'Typing the PIN 4321 for {3}')",
+        MARKED_ELEMENTS, "https://example.com/login", None,
+    )
+    run.finish(succeeded=True)
+    (steps,) = store._connection.execute("SELECT steps FROM trajectories").fetchone()
+    assert "hunter2" not in steps and "4321" not in steps
+    store.close()
+
+
+def test_nothing_is_stored_without_a_store():
+    task = Task("Fill the form", {"pin": 4321})
+    run = start_trajectory(None, "https://example.com", task)
+    assert run.next_action(None) is None
+    run.record("actions.input_text(3, '4321', True, 'PIN')", MARKED_ELEMENTS, "https://example.com", None)
+    run.finish(succeeded=True)
+
+
+def test_store_path_is_read_when_created(monkeypatch, tmp_path):
+    monkeypatch.setenv("PYWEBAGENT_TRAJECTORY_DB", str(tmp_path / "trajectories.db"))
+    store = TrajectoryStore()
+    assert store.path == str(tmp_path / "trajectories.db")
+    store.close()